@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+Load test of the navigator (gfam/urls.py) or gfam2 (gfam2/urls.py) on a
+local server, with machine-readable results to compare runs.
+
+    manage.py generate_synthetic_data --sequences 1000000    # gfam only
+    ./benchmark_load.py --settings settings [--site gfam] \\
+        [--concurrency 8] [--requests 200] [--output results.json]
+
+The site runs in a child process, a threaded WSGI server with
+gfam2.profiling.ProfilingMiddleware timing every request.  Every URL
+pattern of the site gets --requests requests, made from --concurrency
+threads, with paths drawn from the data in the database (or the gfam2
+catalog).  Patterns no path can be made for, like the admin, are listed
+as skipped.  For every pattern the JSON has
+
+    requests, errors, status    counts, errors being failed connections
+    throughput                  requests per second
+    latency                     p50, p95, p99 and max in ms, client side
+    queries, sql                p50, p95, p99 of the queries, and of the
+                                time in them in ms, per request, server side
+
+and the peak RSS of the server and of the driver in KB.
+"""
+
+import httplib
+import optparse
+import os.path
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+SITES = {'gfam': 'urls', 'gfam2': 'gfam2.urls'}
+STATS_URL = '/_benchmark_stats'
+SAMPLE = 1000
+TIMEOUT = 60
+PERCENTILES = (50, 95, 99)
+
+
+# -- server ------------------------------------------------------------------
+
+def serve(options):
+    """Run the site on options.port with every request profiled."""
+    from django.conf import settings
+    settings.ROOT_URLCONF = SITES[options.site]
+    settings.DEBUG = False
+    settings.PROFILING_SAMPLE_RATE = 1.0
+    settings.PROFILING_STATS_URL = STATS_URL
+    settings.INTERNAL_IPS = ('127.0.0.1',)
+    from settings_profiling import profiled
+    settings.MIDDLEWARE_CLASSES = profiled(settings.MIDDLEWARE_CLASSES)
+
+    import SocketServer
+    from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, \
+      make_server
+    from django.core.handlers.wsgi import WSGIHandler
+
+    class Server(SocketServer.ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+    class Handler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    make_server('127.0.0.1', options.port, WSGIHandler(), Server,
+                Handler).serve_forever()
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_server(options):
+    command = [sys.executable, os.path.abspath(__file__), '--serve',
+      '--port', str(options.port), '--site', options.site,
+      '--settings', options.settings]
+    server = subprocess.Popen(command, stdout=open(os.devnull, 'w'))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            sys.exit("The server exited with status %d" % server.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', options.port), 1).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.terminate()
+    sys.exit("The server did not start")
+
+
+# -- paths -------------------------------------------------------------------
+
+def gfam_paths(rng):
+    """{url pattern: function returning a path} for gfam/urls.py."""
+    from django.db import connection
+    from navigator.models import FamilyBuild, FamilyBuildMethod
+
+    def sample(sql):
+        cursor = connection.cursor()
+        cursor.execute(sql + " ORDER BY random() LIMIT %d" % SAMPLE)
+        return cursor.fetchall()
+
+    builds = list(FamilyBuild.objects.values_list('pk', flat=True))
+    methods = list(FamilyBuildMethod.objects.values_list('pk', flat=True))
+    families = sample("SELECT DISTINCT family_build_id, instance_node_id "
+      "FROM family_member")
+    sequences = [row[0] for row in sample("SELECT sequence_id FROM sequence")]
+    featured = [row[0] for row in sample("SELECT sequence_id "
+      "FROM feature_track")] or sequences
+    terms = []
+    for accession, description in sample("SELECT accession, description "
+      "FROM sequence_information"):
+        terms.append(accession[:rng.randint(3, len(accession))])
+        terms.extend(description.split()[:2])
+    connection.close()
+    if not builds or not sequences:
+        sys.exit("No builds or sequences; run manage.py "
+                 "generate_synthetic_data first")
+
+    def ids(count):
+        return ','.join(str(rng.choice(featured)) for i in range(count))
+
+    return {
+        r'^gene-structure/(.*)\.png':
+            lambda: '/gene-structure/%d.png' % rng.choice(featured),
+        r'^gene-structure$': lambda: '/gene-structure?ids=' + ids(10),
+        r'^tracks$': lambda: '/tracks?ids=' + ids(50),
+        r'^b([0-9]+)/family/(.*)\.fasta':
+            lambda: '/b%d/family/%d.fasta' % rng.choice(families),
+        r'^sequence/([0-9]+)\.fasta$':
+            lambda: '/sequence/%d.fasta' % rng.choice(sequences),
+        r'^sequence/([0-9]+)/similar$':
+            lambda: '/sequence/%d/similar' % rng.choice(sequences),
+        r'^b([0-9]+)/families$':
+            lambda: '/b%d/families' % rng.choice(builds),
+        r'^search$': lambda: '/search?q=' + urllib2.quote(rng.choice(terms)),
+        r'^method/(.*)': lambda: '/method/%d' % rng.choice(methods),
+        r'^methods$': lambda: '/methods',
+        r'^$': lambda: '/',
+    }
+
+
+def gfam2_paths(rng):
+    """{url pattern: function returning a path} for gfam2/urls.py."""
+    from gfam2 import views
+    families = [f.abbrev for f in views.catalog.families()]
+    genes = [m.accession for f in families for m in views.catalog.members(f)]
+
+    def window():
+        row, column = rng.randint(1, 1000), rng.randint(1, 2000)
+        return 'rows=%d-%d&columns=%d-%d' % (row, row + 99, column,
+                                             column + 199)
+
+    return {
+        r'^/?$': lambda: '/',
+        r'^families/?$': lambda: '/families',
+        r'^summary/([a-z,A-Z,0-9]*)$':
+            lambda: '/summary/' + rng.choice(families),
+        r'^tree/([a-z,A-Z,0-9]*)$': lambda: '/tree/' + rng.choice(families),
+        r'^tree/([a-z,A-Z,0-9]*)\.svg$':
+            lambda: '/tree/%s.svg' % rng.choice(families),
+        r'^structure/([a-z,A-Z,0-9]*)$':
+            lambda: '/structure/' + rng.choice(families),
+        r'^alignment/([a-z,A-Z,0-9]*)\.(json|fasta)$':
+            lambda: '/alignment/%s.json?%s' % (rng.choice(families),
+                                                window()),
+        r'^([a-z,A-Z,0-9,.]*)()$': lambda: '/' + rng.choice(genes),
+        r'^([a-z,A-Z,0-9]*)/(protein)$':
+            lambda: '/%s/protein' % rng.choice(genes),
+        r'^([a-z,A-Z,0-9]*)/(dna)$': lambda: '/%s/dna' % rng.choice(genes),
+    }
+
+
+def url_patterns(site):
+    from django.conf import settings
+    from django.core import urlresolvers
+    settings.ROOT_URLCONF = SITES[site]
+    return [p.regex.pattern
+            for p in urlresolvers.get_resolver(None).url_patterns]
+
+
+# -- driver ------------------------------------------------------------------
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+    result = dict(("p%d" % p, values[min(len(values) - 1,
+      len(values) * p // 100)]) for p in PERCENTILES)
+    result['max'] = values[-1]
+    return result
+
+
+def fetch(url):
+    """(status, bytes) of a GET of url; status None if it failed."""
+    try:
+        f = urllib2.urlopen(url, timeout=TIMEOUT)
+    except urllib2.HTTPError, e:
+        f = e
+    except (urllib2.URLError, httplib.HTTPException, socket.error):
+        return None, 0
+    try:
+        return f.code, len(f.read())
+    except (httplib.HTTPException, socket.error):
+        return None, 0
+    finally:
+        f.close()
+
+
+def run(base, paths, concurrency):
+    """Request paths from concurrency threads; returns the pattern's row."""
+    lock = threading.Lock()
+    pending = list(reversed(paths))
+    latencies, status = [], {}
+    received = [0]
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                path = pending.pop()
+            start = time.time()
+            code, size = fetch(base + path)
+            elapsed = (time.time() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                status[str(code)] = status.get(str(code), 0) + 1
+                received[0] += size
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - start
+    return {
+        'requests': len(paths),
+        'errors': status.get('None', 0),
+        'status': status,
+        'bytes': received[0],
+        'throughput': round(len(paths) / wall, 2),
+        'latency': dict((k, round(v, 2))
+                        for k, v in percentiles(latencies).items()),
+    }
+
+
+def table_counts():
+    from django.db import connection
+    cursor = connection.cursor()
+    counts = {}
+    for table in ('family_build', 'family_member', 'sequence',
+                  'sequence_information', 'sequence_feature'):
+        cursor.execute("SELECT count(*) FROM " + table)
+        counts[table] = cursor.fetchone()[0]
+    connection.close()
+    return counts
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--site", choices=sorted(SITES), default='gfam',
+                      help="gfam or gfam2 [default: %default]")
+    parser.add_option("--settings",
+                      help="Django settings module of the site (default: "
+                           "settings for gfam, gfam2.settings for gfam2)")
+    parser.add_option("--concurrency", type="int", default=8,
+                      help="requests in flight [default: %default]")
+    parser.add_option("--requests", type="int", default=200,
+                      help="requests per URL pattern [default: %default]")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--output", help="write the JSON here, not to stdout")
+    parser.add_option("--serve", action="store_true", help=optparse.SUPPRESS_HELP)
+    parser.add_option("--port", type="int", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if options.settings is None:
+        options.settings = options.site == 'gfam' and 'settings' or \
+          'gfam2.settings'
+    os.environ['DJANGO_SETTINGS_MODULE'] = options.settings
+    if options.serve:
+        return serve(options)
+
+    from django.conf import settings
+    from django.utils import simplejson
+    rng = random.Random(options.seed)
+    patterns = url_patterns(options.site)
+    if options.site == 'gfam':
+        makers = gfam_paths(rng)
+        data = table_counts()
+    else:
+        makers = gfam2_paths(rng)
+        data = None
+
+    options.port = free_port()
+    server = start_server(options)
+    base = 'http://127.0.0.1:%d' % options.port
+    results = {}
+    try:
+        for pattern in patterns:
+            if pattern in makers:
+                paths = [makers[pattern]() for i in range(options.requests)]
+                results[pattern] = run(base, paths, options.concurrency)
+                print >> sys.stderr, "%-45s %8.1f req/s" % (pattern,
+                  results[pattern]['throughput'])
+        stats = simplejson.loads(urllib2.urlopen(base + STATS_URL).read())
+    finally:
+        server.terminate()
+        server.wait()
+
+    for pattern, row in results.items():
+        server_side = stats.get(pattern, {})
+        row['queries'] = server_side.get('queries')
+        row['sql'] = server_side.get('sql') and dict((k, round(v * 1000, 2))
+          for k, v in server_side['sql'].items())
+    report = {
+        'site': options.site,
+        'settings': options.settings,
+        'database': settings.DATABASES['default']['ENGINE'],
+        'data': data,
+        'concurrency': options.concurrency,
+        'requests_per_pattern': options.requests,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'patterns': results,
+        'skipped': [p for p in patterns if p not in makers],
+        'server_peak_rss_kb':
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'driver_peak_rss_kb':
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    text = simplejson.dumps(report, indent=1, sort_keys=True)
+    if options.output:
+        open(options.output, 'w').write(text + '\n')
+    else:
+        print text
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Query latency of the navigator search index (navigator/search.py) on
+synthetic sequence_information rows.
+
+    ./benchmark_search.py [--records 1000000] [--queries 2000] [--index PATH]
+
+The index is built once at PATH and reused while it has --records rows.
+Accessions look like Arabidopsis gene ids (At3g01420.1) and descriptions
+draw their words from a vocabulary with a skewed frequency, so a few
+words match a large share of the rows as "protein" does in UniProt.
+Reports p50, p95 and p99 latency per kind of query.
+"""
+
+import optparse
+import os.path
+import random
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+WORDS = ['protein', 'putative', 'family', 'domain', 'hydrolase', 'kinase',
+  'transferase', 'glycosyl', 'synthase', 'xylan', 'cellulose', 'pectin',
+  'methylesterase', 'expansin', 'lyase', 'peroxidase', 'laccase',
+  'arabinosyl', 'galacturonosyl', 'xyloglucan', 'endotransglucosylase',
+  'mannan', 'callose', 'chitinase', 'cinnamoyl', 'reductase', 'oxidase',
+  'binding', 'receptor', 'like', 'subunit', 'alpha', 'beta', 'uncharacterized']
+
+
+def word(rng):
+    # Word i is drawn with probability proportional to 1 / (i + 1)
+    return WORDS[min(int(rng.paretovariate(1.0)) - 1, len(WORDS) - 1)]
+
+
+def accession(i):
+    return 'At%dg%05d.%d' % (i % 5 + 1, i // 5 % 100000, i % 3 + 1)
+
+
+def synthetic_rows(count, seed=0):
+    rng = random.Random(seed)
+    for i in xrange(1, count + 1):
+        name = '%s%d' % (rng.choice(WORDS)[:3].upper(), i % 9999)
+        description = ' '.join(word(rng) for j in range(rng.randint(2, 8)))
+        yield (i, i, accession(i), '%s_ARATH' % name, name,
+          description.capitalize(), '', name, description)
+
+
+def configure(path):
+    from django.conf import settings
+    settings.configure(SEARCH_INDEX_PATH=path)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--records", type="int", default=1000000)
+    parser.add_option("--queries", type="int", default=2000,
+                      help="queries of each kind")
+    parser.add_option("--index", default=os.path.join(tempfile.gettempdir(),
+                      'gfam-search-benchmark.sqlite'),
+                      help="index file [default: %default]")
+    options, args = parser.parse_args()
+
+    configure(options.index)
+    from navigator import search
+
+    index = search.SearchIndex(options.index)
+    if len(index) != options.records:
+        index.close()
+        os.remove(options.index)
+        index = search.SearchIndex(options.index)
+        start = time.time()
+        index.add(synthetic_rows(options.records))
+        print "indexed %d records in %.1f s (%s, %.0f MB)" % (
+          options.records, time.time() - start,
+          search.FTS5 and 'FTS5' or 'FTS4',
+          os.path.getsize(options.index) / 1e6)
+
+    rng = random.Random(1)
+    kinds = [
+      ('prefix', index.prefix, lambda: accession(
+        rng.randint(1, options.records))[:rng.randint(4, 8)]),
+      ('keyword', index.keywords, lambda: word(rng)),
+      ('keywords', index.keywords, lambda: '%s %s' % (word(rng), word(rng))),
+      ('search', index.search, lambda: rng.choice([
+        accession(rng.randint(1, options.records))[:6],
+        '%s %s' % (word(rng), word(rng))])),
+    ]
+    print "%-9s %8s %8s %8s %8s" % ('query', 'p50 ms', 'p95 ms', 'p99 ms',
+                                    'max ms')
+    for name, func, make in kinds:
+        queries = [make() for i in range(options.queries)]
+        times = []
+        for q in queries:
+            start = time.time()
+            func(q)
+            times.append((time.time() - start) * 1000)
+        print "%-9s %8.2f %8.2f %8.2f %8.2f" % (name, percentile(times, 50),
+          percentile(times, 95), percentile(times, 99), max(times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Pfam domains of the protein sequences, scanned once per checksum.
+
+annotate() runs hmmscan (HMMER 3) with the Pfam HMM library
+settings.PFAM_DATABASE over the protein sequences whose SEGUID has no
+pfam_scan row for the release, or a row for an older release, and stores
+each domain hit as a feature, as tools/add_domains.pl did for the Perl
+site:
+
+    sequence_feature   primary_tag PFAM, ranked after the sequence's others
+    sequence_location  the envelope of the domain, strand 1
+    sequence_tag       family (the Pfam accession), evalue (independent
+                       E-value) and description
+
+A sequence's PFAM features are replaced when it is scanned.  Scans run
+BATCH_SIZE sequences at a time in a pool of PROCESSES worker processes.
+Each batch is written in one transaction with its pfam_scan rows, so a
+run that stops resumes where it left off, and once the database has been
+scanned a refresh only scans the sequences it added.
+"""
+
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from navigator.loader import allocate_ids, insert_rows, select_in
+from navigator.models import *
+from navigator.residues import fetch_sequences
+
+HMMSCAN = getattr(settings, 'PFAM_HMMSCAN', 'hmmscan')
+DATABASE = getattr(settings, 'PFAM_DATABASE', None)
+# Pfam's gathering thresholds decide which hits are domains
+OPTIONS = getattr(settings, 'PFAM_HMMSCAN_OPTIONS', ['--cut_ga'])
+PROCESSES = getattr(settings, 'PFAM_PROCESSES', multiprocessing.cpu_count())
+BATCH_SIZE = 500
+
+PRIMARY_TAG = 'PFAM'
+
+SEQUENCE = Sequence._meta.db_table
+FEATURE = SequenceFeature._meta.db_table
+LOCATION = SequenceLocation._meta.db_table
+TAG = SequenceTag._meta.db_table
+SCAN = PfamScan._meta.db_table
+
+
+class AnnotationError(Exception):
+	pass
+
+
+def release_of(database):
+	"""Default release name of an HMM library: its name, size and mtime."""
+	st = os.stat(database)
+	return "%s:%d:%d" % (os.path.basename(database), st.st_size, st.st_mtime)
+
+
+def read_domtblout(f):
+	"""
+	Parse a hmmscan --domtblout table into [(query name, Pfam accession,
+	start, end, evalue, description)].
+	"""
+	hits = []
+	for line in f:
+		if line.startswith('#') or not line.strip():
+			continue
+		fields = line.split(None, 22)
+		if len(fields) < 22:
+			raise AnnotationError("Not a --domtblout line: %r" % line)
+		family = fields[1] != '-' and fields[1].split('.')[0] or fields[0]
+		description = len(fields) > 22 and fields[22].strip() or ''
+		hits.append((fields[3], family, int(fields[19]), int(fields[20]),
+		  float(fields[12]), description))
+	return hits
+
+
+def pending(release):
+	"""[(sequence_id, seguid)] of the proteins not scanned for release."""
+	cursor = connection.cursor()
+	cursor.execute("SELECT s.sequence_id, s.seguid FROM " + SEQUENCE + " s " +
+	  "LEFT JOIN " + SCAN + " p ON p.seguid = s.seguid " +
+	  "WHERE s.alphabet = 'protein' " +
+	  "AND (p.seguid IS NULL OR p.release <> %s) " +
+	  "ORDER BY s.sequence_id", [release])
+	return cursor.fetchall()
+
+
+def scan(database, sequence_ids):
+	"""hmmscan a batch of sequences; returns read_domtblout() hits."""
+	sequences = fetch_sequences(sequence_ids)
+	directory = tempfile.mkdtemp(prefix='pfam')
+	try:
+		fasta = os.path.join(directory, 'batch.fasta')
+		table = os.path.join(directory, 'batch.domtbl')
+		with open(fasta, 'w') as f:
+			for sequence_id in sequence_ids:
+				f.write(">%d\n%s\n" % (sequence_id,
+				  sequences.get(sequence_id, '')))
+		process = subprocess.Popen([HMMSCAN, '--cpu', '1', '--noali',
+		  '-o', os.devnull, '--domtblout', table] + list(OPTIONS) +
+		  [database, fasta], stderr=subprocess.PIPE)
+		error = process.communicate()[1]
+		if process.returncode != 0:
+			raise AnnotationError("%s failed: %s" % (HMMSCAN, error.strip()))
+		with open(table) as f:
+			return read_domtblout(f)
+	finally:
+		shutil.rmtree(directory)
+
+
+def _run(task):
+	"""Scan one batch; run in the worker processes."""
+	database, batch = task
+	return batch, scan(database, [sequence_id for sequence_id, s in batch])
+
+
+def _map(tasks, processes):
+	if processes <= 1:
+		for task in tasks:
+			yield _run(task)
+		return
+	# The workers are forked and must not share this connection
+	connection.close()
+	pool = multiprocessing.Pool(processes)
+	try:
+		for result in pool.imap_unordered(_run, tasks):
+			yield result
+	finally:
+		pool.close()
+		pool.join()
+
+
+def _delete_in(cursor, table, column, values):
+	values = list(values)
+	for i in xrange(0, len(values), BATCH_SIZE):
+		batch = values[i:i + BATCH_SIZE]
+		cursor.execute("DELETE FROM " + table + " WHERE " + column + " IN (" +
+		  ",".join(["%s"] * len(batch)) + ")", batch)
+	transaction.set_dirty()
+
+
+def store_hits(cursor, batch, hits, release):
+	"""
+	Replace the PFAM features of the sequences of batch, [(sequence_id,
+	seguid)], with hits, and record them as scanned for release.
+	Returns the number of domains stored.
+	"""
+	sequence_ids = [sequence_id for sequence_id, s in batch]
+	old = [row[0] for row in select_in(cursor, "SELECT sequence_feature_id " +
+	  "FROM " + FEATURE + " WHERE primary_tag = %s AND sequence_id IN",
+	  sequence_ids, [PRIMARY_TAG])]
+	_delete_in(cursor, TAG, 'sequence_feature_id', old)
+	_delete_in(cursor, LOCATION, 'sequence_feature_id', old)
+	_delete_in(cursor, FEATURE, 'sequence_feature_id', old)
+
+	ranks = dict.fromkeys(sequence_ids, 0)
+	for sequence_id, rank in select_in(cursor, "SELECT sequence_id, rank " +
+	  "FROM " + FEATURE + " WHERE sequence_id IN", sequence_ids):
+		ranks[sequence_id] = max(ranks[sequence_id], rank or 0)
+	hits = sorted((int(hit[0]),) + tuple(hit[1:]) for hit in hits)
+
+	feature_ids = allocate_ids(cursor, SequenceFeature, len(hits))
+	features, locations, tags = [], [], []
+	for feature_id, (sequence_id, family, start, end, evalue, description) \
+	  in zip(feature_ids, hits):
+		ranks[sequence_id] += 1
+		features.append((feature_id, sequence_id, ranks[sequence_id],
+		  PRIMARY_TAG))
+		locations.append((feature_id, 1, start, end, 1))
+		tags.extend([(feature_id, 'family', family),
+		  (feature_id, 'evalue', '%g' % evalue),
+		  (feature_id, 'description', description[:256])])
+	insert_rows(cursor, SequenceFeature,
+	  ['sequence_feature_id', 'sequence_id', 'rank', 'primary_tag'], features)
+	insert_rows(cursor, SequenceLocation,
+	  ['sequence_location_id', 'sequence_feature_id', 'rank', 'start_pos',
+	   'end_pos', 'strand'],
+	  [(i,) + row for i, row in zip(allocate_ids(cursor, SequenceLocation,
+	    len(locations)), locations)])
+	insert_rows(cursor, SequenceTag,
+	  ['sequence_tag_id', 'sequence_feature_id', 'name', 'value'],
+	  [(i,) + row for i, row in zip(allocate_ids(cursor, SequenceTag,
+	    len(tags)), tags)])
+
+	domains = {}
+	for hit in hits:
+		domains[hit[0]] = domains.get(hit[0], 0) + 1
+	_delete_in(cursor, SCAN, 'seguid', [s for sequence_id, s in batch])
+	insert_rows(cursor, PfamScan, ['seguid', 'release', 'domains'],
+	  [(s, release, domains.get(sequence_id, 0))
+	   for sequence_id, s in batch])
+	return len(hits)
+
+
+@transaction.commit_manually
+def annotate(database=None, release=None, processes=None,
+             batch_size=BATCH_SIZE):
+	"""
+	Scan the proteins not yet scanned against release (by default
+	release_of(database)).  Returns counts of the 'sequences' scanned and
+	'domains' found, and the 'sequence_ids' scanned.
+	"""
+	if database is None:
+		database = DATABASE
+	if not database or not os.path.exists(database):
+		raise AnnotationError("No Pfam HMM library %s; set PFAM_DATABASE" %
+		  (database or ''))
+	if release is None:
+		release = release_of(database)
+	if processes is None:
+		processes = PROCESSES
+
+	todo = pending(release)
+	transaction.commit()
+	tasks = [(database, todo[i:i + batch_size])
+	  for i in xrange(0, len(todo), batch_size)]
+	counts = {'sequences': 0, 'domains': 0, 'sequence_ids': []}
+	try:
+		for batch, hits in _map(tasks, processes):
+			cursor = connection.cursor()
+			counts['domains'] += store_hits(cursor, batch, hits, release)
+			transaction.commit()
+			counts['sequences'] += len(batch)
+			counts['sequence_ids'].extend(sequence_id
+			  for sequence_id, s in batch)
+	except:
+		transaction.rollback()
+		raise
+	return counts
@@ -0,0 +1,116 @@
+"""
+HTTP caching of navigator pages.
+
+A FamilyBuild never changes once it is loaded, so every page under
+b<id>/ is identified by the build id and family_build_timestamp alone:
+
+    ETag           "b<id>-<timestamp>-<PAGE_VERSION>"
+    Last-Modified  family_build_timestamp
+    Cache-Control  public, max-age=BUILD_MAX_AGE (a week by default)
+
+build_page() serves a view that way.  The stamp of a build is read from
+the database once per process; after that a conditional GET is answered
+with 304 without a query.
+
+Pages over all builds (the build list, methods, sequences, search)
+change when a build is added.  site_page() stamps them with the number
+of builds and the newest timestamp, kept in the Django cache for
+SITE_MAX_AGE seconds, which is also their max-age.  The loader commands
+call builds_changed(), which with a shared cache backend makes the new
+build show at once.
+
+A view marked with gzip_variant() sends its body gzipped to clients that
+accept it.  The gzipped body is a different entity, so its ETag gets a
+"-gzip" suffix and the identity body keeps the plain one.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from navigator import streaming
+from navigator.models import FamilyBuild
+
+BUILD_MAX_AGE = getattr(settings, 'BUILD_CACHE_MAX_AGE', 7 * 24 * 3600)
+SITE_MAX_AGE = getattr(settings, 'SITE_CACHE_MAX_AGE', 300)
+
+# Part of every ETag; bump when templates or page formats change
+PAGE_VERSION = 1
+
+SITE_KEY = 'gfam.navigator.builds'
+
+# {build_id: (etag, timestamp)}
+_builds = {}
+
+
+def build_stamp(build_id):
+	"""(etag, timestamp) of a build, or None if there is no such build."""
+	stamp = _builds.get(build_id)
+	if stamp is None:
+		timestamps = FamilyBuild.objects.filter(pk=build_id) \
+		  .values_list('family_build_timestamp', flat=True)
+		if not timestamps:
+			return None
+		stamp = _builds[build_id] = ("b%d-%s-%d" % (build_id,
+		  timestamps[0].strftime('%Y%m%d%H%M%S'), PAGE_VERSION), timestamps[0])
+	return stamp
+
+
+def site_stamp():
+	"""(etag, timestamp) of the set of builds."""
+	stamp = cache.get(SITE_KEY)
+	if stamp is None:
+		row = FamilyBuild.objects.aggregate(count=Count('pk'),
+		  last=Max('family_build_timestamp'))
+		stamp = ("s%d-%s-%d" % (row['count'],
+		  row['last'] and row['last'].strftime('%Y%m%d%H%M%S') or '0',
+		  PAGE_VERSION), row['last'])
+		cache.set(SITE_KEY, stamp, SITE_MAX_AGE)
+	return stamp
+
+
+def builds_changed():
+	"""Forget the site stamp, after builds were added."""
+	cache.delete(SITE_KEY)
+
+
+def _cached(view, stamp, max_age):
+	gzipped = getattr(view, 'gzip_variant', False)
+
+	def etag(request, *q):
+		tag = (stamp(*q) or (None, None))[0]
+		if tag and gzipped and streaming.accepts_gzip(request):
+			tag += '-gzip'
+		return tag
+
+	def last_modified(request, *q):
+		return (stamp(*q) or (None, None))[1]
+
+	conditional = condition(etag, last_modified)(view)
+
+	def wrapper(request, *q):
+		response = conditional(request, *q)
+		if response.status_code in (200, 304) and response.has_header('ETag'):
+			patch_cache_control(response, public=True, max_age=max_age)
+		return response
+	wrapper.__name__ = view.__name__
+	wrapper.__doc__ = view.__doc__
+	return wrapper
+
+
+def gzip_variant(view):
+	"""Mark a view that gzips its response when the client accepts it."""
+	view.gzip_variant = True
+	return view
+
+
+def build_page(view):
+	"""Cache a view whose first URL argument is a build id."""
+	return _cached(view, lambda *q: build_stamp(int(q[0])), BUILD_MAX_AGE)
+
+
+def site_page(view):
+	"""Cache a view whose content changes when builds are added."""
+	return _cached(view, lambda *q: site_stamp(), SITE_MAX_AGE)
@@ -0,0 +1,214 @@
+"""
+Static export of a family build.
+
+export_build() writes everything the navigator serves for one build into
+a directory laid out like its URLs, so that a plain file server can
+answer them and Django is left with search and the other dynamic pages:
+
+    index.html                      the build list (/)
+    b<id>/families                  the families page
+    b<id>/family/<node>.fasta       family FASTA downloads
+    gene-structure/<sequence>.png   gene structures of the members
+    b<id>/index.json                what was exported, see below
+
+Pages are rendered by the views themselves, so they match what Django
+serves.  The FASTA files and images, which are most of the work, are
+written by a pool of PROCESSES worker processes.
+
+b<id>/index.json maps every exported path to [digest, content type,
+bytes], where the digest is of the inputs of the file: the rendered
+page, the member rows of a family, or the structure digest of an image.
+Exporting the build again only rewrites files whose digest changed, and
+removes the files under b<id>/ that are no longer exported.  Images are
+shared by every build a sequence is in and are never removed.
+"""
+
+import hashlib
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpRequest
+from django.utils import simplejson
+
+from navigator import caching, genestructure, streaming
+from navigator.models import *
+
+PROCESSES = getattr(settings, 'EXPORT_PROCESSES', multiprocessing.cpu_count())
+
+MEMBER = FamilyMember._meta.db_table
+INFO = SequenceInformation._meta.db_table
+FEATURE = SequenceFeature._meta.db_table
+
+HTML = 'text/html; charset=utf-8'
+FASTA = 'text/plain'
+PNG = 'image/png'
+
+
+def _digest(*parts):
+	h = hashlib.sha1()
+	h.update(repr((caching.PAGE_VERSION,) + parts))
+	return h.hexdigest()
+
+
+def _write(root, path, data=None, source=None):
+	"""
+	Write data, or copy the file source, to root/path under a temporary
+	name and rename it, so the file server never sends a partial file.
+	"""
+	target = os.path.join(root, path)
+	genestructure._makedirs(os.path.dirname(target))
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+	with os.fdopen(fd, 'wb') as f:
+		if source is None:
+			f.write(data)
+		else:
+			with open(source, 'rb') as s:
+				shutil.copyfileobj(s, f)
+	os.chmod(tmp, 0644)
+	os.rename(tmp, target)
+	return os.path.getsize(target)
+
+
+def _render(view, *args):
+	return "".join(view(HttpRequest(), *[str(a) for a in args]))
+
+
+def family_digests(build_id):
+	"""Yield (instance_node_id, digest of its FASTA headers) of a build."""
+	rows = streaming.iter_query("SELECT m.instance_node_id, m.sequence_id, " +
+	  "i.accession, i.display, i.description " +
+	  "FROM " + MEMBER + " m " +
+	  "JOIN " + INFO + " i ON i.sequence_id = m.sequence_id " +
+	  "WHERE m.family_build_id = %s " +
+	  "ORDER BY m.instance_node_id, i.accession, m.sequence_id", [build_id])
+	for node_id, group in itertools.groupby(rows, lambda row: row[0]):
+		yield node_id, _digest([row[1:] for row in group])
+
+
+def structure_sequences(build_id):
+	"""Ids of the members of a build that have features."""
+	cursor = connection.cursor()
+	cursor.execute("SELECT DISTINCT m.sequence_id FROM " + MEMBER + " m " +
+	  "WHERE m.family_build_id = %s AND EXISTS (SELECT 1 FROM " + FEATURE +
+	  " f WHERE f.sequence_id = m.sequence_id) ORDER BY m.sequence_id",
+	  [build_id])
+	return [row[0] for row in cursor.fetchall()]
+
+
+def _run(task):
+	"""
+	Export one FASTA file or image; run in the worker processes.
+	Returns (path, digest, type, bytes, written), or (path, None, error)
+	when an image cannot be drawn, for whatever reason, so that one bad
+	sequence does not stop the export.
+	"""
+	kind, root, path, arg, digest = task
+	if kind == 'fasta':
+		build_id, node_id = arg
+		from navigator import views
+		size = _write(root, path, _render(views.family_fasta, build_id, node_id))
+		return path, digest, FASTA, size, True
+
+	sequence_id = arg
+	try:
+		new = genestructure.structure_digest(sequence_id,
+		  genestructure.structure_rows(sequence_id))
+		target = os.path.join(root, path)
+		if new == digest and os.path.exists(target):
+			return path, digest, PNG, os.path.getsize(target), False
+		source, new = genestructure.cached_png(sequence_id)
+		return path, new, PNG, _write(root, path, source=source), True
+	except Exception, e:
+		return path, None, "%s: %s" % (e.__class__.__name__, e)
+
+
+def _map(tasks, processes):
+	if processes <= 1:
+		for task in tasks:
+			yield _run(task)
+		return
+	# The workers are forked and must not share this connection
+	connection.close()
+	pool = multiprocessing.Pool(processes)
+	try:
+		for result in pool.imap_unordered(_run, tasks, 16):
+			yield result
+	finally:
+		pool.close()
+		pool.join()
+
+
+def export_build(build_id, root, processes=None):
+	"""
+	Export a build into the directory root.  Returns counts of the files
+	'written', 'unchanged', 'removed' and 'failed' (images that could not
+	be drawn), and the 'errors' of those.
+	"""
+	if processes is None:
+		processes = PROCESSES
+	if not FamilyBuild.objects.filter(pk=build_id).exists():
+		raise FamilyBuild.DoesNotExist("No build %d" % build_id)
+	from navigator import views
+
+	manifest_path = "b%d/index.json" % build_id
+	try:
+		old = simplejson.load(open(os.path.join(root, manifest_path)))['files']
+	except (IOError, ValueError, KeyError):
+		# Missing or corrupt: export everything again
+		old = {}
+	files = {}
+	counts = {'written': 0, 'unchanged': 0, 'removed': 0, 'failed': 0,
+	  'errors': []}
+
+	def unchanged(path, digest):
+		return path in old and old[path][0] == digest and \
+		  os.path.exists(os.path.join(root, path))
+
+	def done(path, digest, content_type, size, written):
+		files[path] = [digest, content_type, size]
+		counts[written and 'written' or 'unchanged'] += 1
+
+	for path, view, args in [("index.html", views.builds, ()),
+	  ("b%d/families" % build_id, views.families, (build_id,))]:
+		data = _render(view, *args)
+		digest = _digest(data)
+		if unchanged(path, digest):
+			done(path, digest, HTML, len(data), False)
+		else:
+			done(path, digest, HTML, _write(root, path, data), True)
+
+	tasks = []
+	for node_id, digest in family_digests(build_id):
+		path = "b%d/family/%d.fasta" % (build_id, node_id)
+		if unchanged(path, digest):
+			done(path, digest, FASTA, old[path][2], False)
+		else:
+			tasks.append(('fasta', root, path, (build_id, node_id), digest))
+	for sequence_id in structure_sequences(build_id):
+		path = "gene-structure/%d.png" % sequence_id
+		tasks.append(('png', root, path, sequence_id,
+		  path in old and old[path][0] or None))
+
+	for result in _map(tasks, processes):
+		if result[1] is None:
+			counts['failed'] += 1
+			counts['errors'].append("%s: %s" % (result[0], result[2]))
+		else:
+			done(*result)
+
+	prefix = "b%d/" % build_id
+	for path in old:
+		if path not in files and path.startswith(prefix) and \
+		  path != manifest_path and os.path.exists(os.path.join(root, path)):
+			os.remove(os.path.join(root, path))
+			counts['removed'] += 1
+
+	_write(root, manifest_path, simplejson.dumps({'build_id': build_id,
+	  'page_version': caching.PAGE_VERSION, 'files': files}, indent=1,
+	  sort_keys=True))
+	return counts
@@ -0,0 +1,335 @@
+"""
+Gene structure images.
+
+Rendered PNGs are kept on disk under GENE_STRUCTURE_CACHE_DIR, named by
+a digest of the sequence id and its feature/location/tag rows, so an
+image is rendered once per version of its features and any change to
+them yields a new file and a new ETag.
+
+Sequences whose features are the usual gene model parts (MODEL, EXON,
+CDS and the UTRs) are drawn by the Python renderer below.  Anything else
+goes to the Bio::Graphics script in exteranal/, with at most
+GENE_STRUCTURE_WORKERS copies running at once across all server
+processes.  Pfam domains (navigator/annotate.py) are not part of the
+gene structure: they are left out of the images and their digests, so
+scanning a sequence neither redraws it nor sends it to the Perl script.
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import random
+import struct
+import subprocess
+import tempfile
+import zlib
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from navigator import annotate, tracks
+from navigator.models import SequenceLocation, SequenceTag
+
+CACHE_DIR = getattr(settings, 'GENE_STRUCTURE_CACHE_DIR',
+  os.path.join(tempfile.gettempdir(), 'gfam-gene-structure'))
+WORKERS = getattr(settings, 'GENE_STRUCTURE_WORKERS', 4)
+PERL_RENDERER = os.path.join(os.path.dirname(os.path.dirname(
+  os.path.abspath(__file__))), 'exteranal', 'reneder-gene.pl')
+
+# Part of every cache key; bump when the drawing code changes
+RENDERER_VERSION = 1
+
+GENE_MODEL_TAGS = set(['MODEL', 'EXON', 'CDS',
+  'UTR', 'LEFT_UTR', 'RIGHT_UTR', 'EXTENDED_UTR'])
+DOMAIN_TAGS = set([annotate.PRIMARY_TAG])
+
+
+class RenderError(Exception):
+	pass
+
+
+# -- feature rows ------------------------------------------------------------
+
+def structure_rows(sequence_id):
+	"""
+	Everything the renderers draw for a sequence: (length, locations,
+	tags) where locations are (feature_id, primary_tag, start, end,
+	strand), domains left out, and tags map feature_id -> {name: value}
+	for the 'model' and 'feat_name' tags.  Read from the precomputed
+	feature track in one query, or from the feature tables in two.
+	"""
+	track = tracks.get_track(sequence_id)
+	if track is not None:
+		length, locations, tags = track
+		locations = without_domains(locations)
+		return locations and length or 0, locations, tags
+
+	locations = SequenceLocation.objects \
+	  .filter(sequence_feature__sequence=sequence_id) \
+	  .exclude(sequence_feature__primary_tag__in=DOMAIN_TAGS) \
+	  .order_by('sequence_feature', 'rank') \
+	  .values_list('sequence_feature', 'sequence_feature__primary_tag',
+	    'start_pos', 'end_pos', 'strand', 'sequence_feature__sequence__length')
+	locations = list(locations)
+	length = locations and locations[0][5] or 0
+	locations = [row[:5] for row in locations]
+
+	tags = {}
+	for feature_id, name, value in SequenceTag.objects \
+	  .filter(sequence_feature__sequence=sequence_id,
+	    name__in=tracks.TRACK_TAGS) \
+	  .order_by('sequence_tag_id') \
+	  .values_list('sequence_feature', 'name', 'value'):
+		tags.setdefault(feature_id, {})[name] = value
+	return length, locations, tags
+
+
+def without_domains(locations):
+	return [row for row in locations if row[1] not in DOMAIN_TAGS]
+
+
+def structure_digest(sequence_id, rows):
+	h = hashlib.sha1()
+	h.update(repr((RENDERER_VERSION, sequence_id, rows)))
+	return h.hexdigest()
+
+
+# -- python renderer ---------------------------------------------------------
+
+WIDTH = 600
+PAD = 10
+ROW = 12
+GAP = 6
+
+PALETTE = [
+	(255, 255, 255),  # 0 background
+	(0, 0, 0),        # 1 ruler, outlines, introns
+	(0, 0, 255),      # 2 sequence
+	(173, 216, 230),  # 3 MODEL
+	(255, 165, 0),    # 4 EXON
+	(0, 128, 0),      # 5 CDS
+	(128, 128, 128),  # 6 UTR
+]
+
+
+def gene_models(locations, tags):
+	"""
+	Group feature locations by gene model the way reneder-gene.pl does:
+	MODEL features are named by their feat_name tag, everything else by
+	its model tag.  Returns [(model name, {primary_tag: [(start, end)]})].
+	"""
+	models = {}
+	for feature_id, primary_tag, start, end, strand in locations:
+		t = tags.get(feature_id, {})
+		if primary_tag == 'MODEL':
+			name = t.get('feat_name')
+		else:
+			name = t.get('model')
+		parts = models.setdefault(name or '', {})
+		parts.setdefault(primary_tag, []).append((start, end))
+	return sorted(models.items())
+
+
+def can_render(locations):
+	return bool(locations) and \
+	  all(row[1] in GENE_MODEL_TAGS for row in locations)
+
+
+def layout(length, locations, tags):
+	"""
+	Lay out a sequence and its gene models: a ruler, the sequence bar,
+	and for every model its span and its exons, with UTRs and CDS on
+	top.  Returns (height, scale, boxes) with boxes as
+	(top, start, end, color, h) in drawing order.  Domains are left out,
+	positions are clamped to the sequence, and a sequence without a
+	length is drawn as one residue long.
+	"""
+	length = max(length or 0, 1)
+	models = gene_models(without_domains(locations), tags)
+	height = PAD * 2 + (ROW + GAP) * (2 + 2 * len(models))
+	scale = float(WIDTH - 2 * PAD) / length
+	boxes = []
+
+	def box(top, start, end, color, h=ROW):
+		boxes.append((top, min(max(start, 1), length),
+		  min(max(end, 1), length), color, h))
+
+	# Ruler with a tick at every power-of-ten step
+	top = PAD
+	box(top + ROW // 2, 1, length, 1, h=1)
+	step = 10 ** max(len(str(length)) - 1, 1)
+	for pos in range(step, length + 1, step):
+		box(top + ROW // 4, pos, pos, 1, h=ROW // 2)
+
+	top += ROW + GAP
+	box(top, 1, length, 2)
+
+	for name, parts in models:
+		top += ROW + GAP
+		for start, end in parts.get('MODEL', ()):
+			box(top, start, end, 3)
+
+		top += ROW + GAP
+		exons = sorted(parts.get('EXON', ()))
+		for (s0, e0), (s1, e1) in zip(exons, exons[1:]):
+			box(top + ROW // 2, e0, s1, 1, h=1)
+		for start, end in exons:
+			box(top, start, end, 4)
+		for tag in ('UTR', 'LEFT_UTR', 'RIGHT_UTR', 'EXTENDED_UTR'):
+			for start, end in parts.get(tag, ()):
+				box(top + ROW // 4, start, end, 6, h=ROW // 2)
+		for start, end in parts.get('CDS', ()):
+			box(top, start, end, 5)
+
+	return height, scale, boxes
+
+
+def _span(scale, start, end):
+	x0 = PAD + int((min(start, end) - 1) * scale)
+	x1 = max(PAD + int((max(start, end) - 1) * scale), x0 + 1)
+	return x0, x1
+
+
+def render_png(length, locations, tags):
+	height, scale, boxes = layout(length, locations, tags)
+	pixels = [bytearray(WIDTH) for y in range(height)]
+	for top, start, end, color, h in boxes:
+		x0, x1 = _span(scale, start, end)
+		for y in range(top, top + h):
+			row = pixels[y]
+			for i in range(x0, x1):
+				row[i] = color
+		for i in range(x0, x1):
+			pixels[top][i] = pixels[top + h - 1][i] = 1
+		for y in range(top, top + h):
+			pixels[y][x0] = pixels[y][x1 - 1] = 1
+	return png(WIDTH, height, pixels, PALETTE)
+
+
+def render_svg(length, locations, tags):
+	"""The same drawing as render_png(), as an inline <svg> element."""
+	height, scale, boxes = layout(length, locations, tags)
+	out = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">'
+	  % (WIDTH, height)]
+	for top, start, end, color, h in boxes:
+		x0, x1 = _span(scale, start, end)
+		out.append('<rect x="%d" y="%d" width="%d" height="%d" '
+		  'fill="#%02x%02x%02x"%s/>' % ((x0, top, x1 - x0, h) +
+		  PALETTE[color] + (h > 1 and ' stroke="black"' or '',)))
+	out.append('</svg>')
+	return ''.join(out)
+
+
+def png(width, height, rows, palette):
+	"""Encode rows of 8-bit palette indexes as a PNG."""
+	def chunk(kind, data):
+		return struct.pack('>I', len(data)) + kind + data + \
+		  struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+	raw = ''.join('\0' + str(row) for row in rows)
+	return '\x89PNG\r\n\x1a\n' + \
+	  chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)) + \
+	  chunk('PLTE', ''.join(struct.pack('BBB', *c) for c in palette)) + \
+	  chunk('IDAT', zlib.compress(raw, 9)) + \
+	  chunk('IEND', '')
+
+
+def _makedirs(path):
+	try:
+		os.makedirs(path)
+	except OSError, e:
+		if e.errno != errno.EEXIST:
+			raise
+
+
+# -- perl renderer -----------------------------------------------------------
+
+class render_slot(object):
+	"""
+	Hold one of WORKERS lock files in the cache directory for the
+	duration of a render, waiting on a random one when all are taken.
+	"""
+	def __enter__(self):
+		slots = range(WORKERS)
+		random.shuffle(slots)
+		for i in slots:
+			self.f = open(os.path.join(CACHE_DIR, 'slot-%d.lock' % i), 'a')
+			try:
+				fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				return self
+			except IOError, e:
+				self.f.close()
+				if e.errno not in (errno.EAGAIN, errno.EACCES):
+					raise
+		self.f = open(os.path.join(CACHE_DIR, 'slot-%d.lock' % slots[0]), 'a')
+		fcntl.flock(self.f, fcntl.LOCK_EX)
+		return self
+
+	def __exit__(self, *exc):
+		fcntl.flock(self.f, fcntl.LOCK_UN)
+		self.f.close()
+
+
+def render_perl(sequence_id):
+	_makedirs(CACHE_DIR)
+	with render_slot():
+		p = subprocess.Popen([PERL_RENDERER, str(sequence_id)],
+		  cwd=os.path.dirname(PERL_RENDERER),
+		  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		out, err = p.communicate()
+	if p.returncode != 0:
+		raise RenderError(err.strip())
+	return out
+
+
+# -- cache -------------------------------------------------------------------
+
+def cache_path(digest):
+	return os.path.join(CACHE_DIR, digest[:2], digest + '.png')
+
+
+def cached_png(sequence_id):
+	"""
+	Return (path, digest) of the rendered image for a sequence, rendering
+	it first if this version of its features has not been drawn yet.
+	"""
+	rows = structure_rows(sequence_id)
+	digest = structure_digest(sequence_id, rows)
+	path = cache_path(digest)
+	if os.path.exists(path):
+		return path, digest
+
+	length, locations, tags = rows
+	if can_render(locations):
+		data = render_png(length, locations, tags)
+	else:
+		data = render_perl(sequence_id)
+
+	# Write under a temporary name and rename, so concurrent requests
+	# for the same image never see a partial file
+	_makedirs(os.path.dirname(path))
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+	try:
+		os.write(fd, data)
+	finally:
+		os.close(fd)
+	os.rename(tmp, path)
+	return path, digest
+
+
+def png_response(request, sequence_id):
+	path, digest = cached_png(sequence_id)
+	etag = '"%s"' % digest
+	mtime = os.stat(path).st_mtime
+	if request.META.get('HTTP_IF_NONE_MATCH') == etag or \
+	  not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+	    mtime):
+		return HttpResponseNotModified()
+
+	response = HttpResponse(open(path, 'rb').read(), mimetype='image/png')
+	response['ETag'] = etag
+	response['Last-Modified'] = http_date(mtime)
+	return response
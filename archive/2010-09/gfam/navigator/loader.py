@@ -0,0 +1,401 @@
+"""
+Bulk loader for hmmsearch results.
+
+load_hits() reads a hmmsearch --tblout hit table and streams a FASTA
+file (the full normalized UniProt file or just the hit sequences), and
+writes one new FamilyBuild with its Sequence, SequenceResidues,
+SequenceInformation, Species and FamilyMember rows.  Everything happens
+in one transaction, with rows written in multi-row INSERT statements and
+looked up in batches, so the number of queries grows with hits /
+BATCH_SIZE and not with hits.  Sequences are deduplicated by SEGUID
+against the database and within the load.
+
+load_delta() makes the next build of an incremental refresh: it copies
+the members of the previous build, drops the ones whose accessions were
+removed or changed in the new UniProt release, and adds the hits found
+among the added and changed sequences.
+"""
+
+import base64
+import datetime
+import hashlib
+import re
+
+from django.db import connection, transaction
+
+from navigator.models import *
+from navigator.residues import RESIDUE_COLUMNS, residue_rows
+from navigator.summary import build_family_summary
+
+BATCH_SIZE = 5000
+
+
+class LoadError(Exception):
+	pass
+
+
+# -- input files -------------------------------------------------------------
+
+def read_tblout(f, max_evalue=None, query=None):
+	"""
+	Parse a hmmsearch --tblout table into {target name: (evalue, score,
+	description)}, keeping the best hit per target.
+	"""
+	hits = {}
+	for line in f:
+		if line.startswith('#') or not line.strip():
+			continue
+		fields = line.split(None, 18)
+		if len(fields) < 18:
+			raise LoadError("Not a --tblout line: %r" % line)
+		target, query_name = fields[0], fields[2]
+		evalue, score = float(fields[4]), float(fields[5])
+		if query is not None and query_name != query:
+			continue
+		if max_evalue is not None and evalue > max_evalue:
+			continue
+		if target not in hits or evalue < hits[target][0]:
+			description = len(fields) > 18 and fields[18].strip() or ''
+			hits[target] = (evalue, score, description)
+	return hits
+
+
+def read_fasta(f):
+	"""Yield (header, sequence) for every record of a FASTA file."""
+	header = None
+	seq = []
+	for line in f:
+		if line.startswith('>'):
+			if header is not None:
+				yield header, ''.join(seq)
+			header = line[1:].rstrip()
+			seq = []
+		else:
+			seq.append(line.strip())
+	if header is not None:
+		yield header, ''.join(seq)
+
+
+def seguid(sequence):
+	"""SEGUID checksum, computed like gfam.get_seguid()."""
+	digest = base64.b64encode(hashlib.sha1(sequence.upper()).digest())
+	return digest.rstrip('=')
+
+
+_UNIPROT_FIELD = re.compile(r' ([A-Z]{2})=')
+
+
+def parse_header(header):
+	"""
+	Split a normalized UniProt header ("P12345 NAME_SPECIES Full name
+	OS=Genus species GN=gene PE=1 SV=1") into accession, display name,
+	description, gene name and (genus, species).
+	"""
+	words = header.split(None, 2) + ['', '']
+	accession, display, rest = words[:3]
+	parts = _UNIPROT_FIELD.split(' ' + rest)
+	fields = dict(zip(parts[1::2], [p.strip() for p in parts[2::2]]))
+	organism = (fields.get('OS') or 'unknown').split(None, 1) + ['']
+	return accession, display, parts[0].strip(), fields.get('GN', ''), \
+	  (organism[0], organism[1])
+
+
+# -- database helpers --------------------------------------------------------
+
+def _is_postgresql():
+	return 'postgresql' in connection.settings_dict['ENGINE']
+
+
+def _max_params():
+	if 'sqlite' in connection.settings_dict['ENGINE']:
+		return 999
+	return 30000
+
+
+def _chunks(items, size):
+	for i in xrange(0, len(items), size):
+		yield items[i:i + size]
+
+
+def allocate_ids(cursor, model, count):
+	"""Reserve count primary key values for new rows of model."""
+	if count == 0:
+		return []
+	table = model._meta.db_table
+	if _is_postgresql():
+		cursor.execute("SELECT nextval('" + table + "_seq') " +
+		  "FROM generate_series(1, %s)", [count])
+		return [row[0] for row in cursor.fetchall()]
+	cursor.execute("SELECT COALESCE(MAX(" + model._meta.pk.column + "), 0) " +
+	  "FROM " + table)
+	start = cursor.fetchone()[0] + 1
+	return range(start, start + count)
+
+
+def insert_rows(cursor, model, columns, rows):
+	"""Insert rows with as few multi-row INSERT statements as possible."""
+	row_sql = "(" + ",".join(["%s"] * len(columns)) + ")"
+	sql = "INSERT INTO " + model._meta.db_table + \
+	  " (" + ",".join(columns) + ") VALUES "
+	for batch in _chunks(rows, max(1, _max_params() // len(columns))):
+		cursor.execute(sql + ",".join([row_sql] * len(batch)),
+		  [value for row in batch for value in row])
+		transaction.set_dirty()
+
+
+def select_in(cursor, sql, values, params=()):
+	"""Run sql, which ends in "IN", for values in batches and yield rows."""
+	values = list(values)
+	for batch in _chunks(values, _max_params() - len(params)):
+		cursor.execute(sql + " (" + ",".join(["%s"] * len(batch)) + ")",
+		  list(params) + batch)
+		for row in cursor.fetchall():
+			yield row
+
+
+def copy_members(cursor, from_build_id, to_build_id):
+	"""Copy the members of one build into another with one INSERT."""
+	table = FamilyMember._meta.db_table
+	if _is_postgresql():
+		new_id = "nextval('" + table + "_seq')"
+		params = [to_build_id, from_build_id]
+	else:
+		cursor.execute("SELECT COALESCE(MAX(family_member_id), 0) " +
+		  "FROM " + table)
+		new_id = "%s + family_member_id"
+		params = [cursor.fetchone()[0], to_build_id, from_build_id]
+	cursor.execute("INSERT INTO " + table + " " +
+	  "(family_member_id, family_build_id, instance_node_id, sequence_id) " +
+	  "SELECT " + new_id + ", %s, instance_node_id, sequence_id " +
+	  "FROM " + table + " WHERE family_build_id = %s", params)
+	transaction.set_dirty()
+	return cursor.rowcount
+
+
+def dropped_sequences(cursor, accessions, db_id):
+	"""
+	Sequences that only have accessions of db_id in accessions, and so
+	are no longer in the release.
+	"""
+	accessions = set(accessions)
+	table = SequenceInformation._meta.db_table
+	candidates = set(row[0] for row in select_in(cursor,
+	  "SELECT sequence_id FROM " + table + " " +
+	  "WHERE db_id = %s AND accession IN", accessions, [db_id]))
+	kept = set(sequence_id for sequence_id, accession in select_in(cursor,
+	  "SELECT sequence_id, accession FROM " + table + " " +
+	  "WHERE db_id = %s AND sequence_id IN", candidates, [db_id])
+	  if accession not in accessions)
+	return candidates - kept
+
+
+def drop_members(cursor, build_id, sequence_ids):
+	"""Remove sequences from a build; returns the member rows deleted."""
+	count = 0
+	for batch in _chunks(sorted(sequence_ids), _max_params() - 1):
+		cursor.execute("DELETE FROM " + FamilyMember._meta.db_table + " " +
+		  "WHERE family_build_id = %s AND sequence_id IN (" +
+		  ",".join(["%s"] * len(batch)) + ")", [build_id] + batch)
+		count += cursor.rowcount
+		transaction.set_dirty()
+	return count
+
+
+# -- loading -----------------------------------------------------------------
+
+class BuildLoader(object):
+	"""Writes the sequences of one build, a batch of records at a time."""
+
+	def __init__(self, cursor, build_id, node_id, db_id):
+		self.cursor = cursor
+		self.build_id = build_id
+		self.node_id = node_id
+		self.db_id = db_id
+		self.species = {}       # (genus, species) -> species_id
+		self.members = set()    # sequence ids already in this build
+		self.counts = dict(sequences=0, information=0, members=0, species=0)
+
+	def species_ids(self, names):
+		cursor = self.cursor
+		missing = set(names) - set(self.species)
+		if not missing:
+			return
+		for g, s, species_id in select_in(cursor,
+		  "SELECT genus, species, species_id FROM " +
+		  Species._meta.db_table + " WHERE genus IN",
+		  set(g for g, s in missing)):
+			self.species.setdefault((g, s), species_id)
+		missing -= set(self.species)
+		missing = sorted(missing)
+		ids = allocate_ids(cursor, Species, len(missing))
+		insert_rows(cursor, Species,
+		  ['species_id', 'genus', 'species', 'sub_species', 'common_name'],
+		  [(i, g, s, '', '') for i, (g, s) in zip(ids, missing)])
+		self.species.update(zip(missing, ids))
+		self.counts['species'] += len(missing)
+
+	def load_batch(self, records):
+		"""
+		records: [(accession, display, description, gene, organism,
+		seguid, sequence)]
+		"""
+		cursor = self.cursor
+
+		# Sequences, deduplicated by SEGUID
+		by_seguid = {}
+		for r in records:
+			by_seguid.setdefault(r[5], r[6])
+		sequence_ids = dict(select_in(cursor, "SELECT seguid, sequence_id " +
+		  "FROM " + Sequence._meta.db_table + " WHERE seguid IN",
+		  by_seguid.keys()))
+		new = sorted(set(by_seguid) - set(sequence_ids))
+		ids = allocate_ids(cursor, Sequence, len(new))
+		# Residues go packed into sequence_residues, not sequence.sequence
+		insert_rows(cursor, Sequence,
+		  ['sequence_id', 'seguid', 'alphabet', 'length', 'sequence'],
+		  [(i, s, 'protein', len(by_seguid[s]), '')
+		   for i, s in zip(ids, new)])
+		insert_rows(cursor, SequenceResidues, RESIDUE_COLUMNS,
+		  [residue_rows(i, by_seguid[s], 'protein')
+		   for i, s in zip(ids, new)])
+		sequence_ids.update(zip(new, ids))
+		self.counts['sequences'] += len(new)
+
+		# Sequence information, unique by (sequence, accession, db)
+		self.species_ids([r[4] for r in records])
+		known = set(select_in(cursor, "SELECT sequence_id, accession " +
+		  "FROM " + SequenceInformation._meta.db_table + " " +
+		  "WHERE db_id = %s AND accession IN",
+		  set(r[0] for r in records), [self.db_id]))
+		info = []
+		for accession, display, description, gene, organism, checksum, seq \
+		  in records:
+			key = (sequence_ids[checksum], accession)
+			if key in known:
+				continue
+			known.add(key)
+			info.append((key[0], accession, self.db_id,
+			  self.species[organism], display, description, gene))
+		ids = allocate_ids(cursor, SequenceInformation, len(info))
+		insert_rows(cursor, SequenceInformation,
+		  ['sequence_information_id', 'sequence_id', 'accession', 'db_id',
+		   'species_id', 'display', 'description', 'gene_name',
+		   'fullname', 'alt_fullname', 'symbols'],
+		  [(i,) + row + ('', '', '') for i, row in zip(ids, info)])
+		self.counts['information'] += len(info)
+
+		# Family members
+		new = sorted(set(sequence_ids.values()) - self.members)
+		ids = allocate_ids(cursor, FamilyMember, len(new))
+		insert_rows(cursor, FamilyMember,
+		  ['family_member_id', 'family_build_id', 'instance_node_id',
+		   'sequence_id'],
+		  [(i, self.build_id, self.node_id, s) for i, s in zip(ids, new)])
+		self.members.update(new)
+		self.counts['members'] += len(new)
+
+
+def create_build(cursor, method_id, name, desc):
+	build_id = allocate_ids(cursor, FamilyBuild, 1)[0]
+	insert_rows(cursor, FamilyBuild,
+	  ['family_build_id', 'famaily_build_name', 'family_build_desc',
+	   'family_build_method_id', 'family_build_timestamp'],
+	  [(build_id, name, desc, method_id, datetime.datetime.now())])
+	return build_id
+
+
+def load_records(loaders, fasta, batch_size=BATCH_SIZE):
+	"""
+	Read fasta once and hand every record that is a hit of a loader to
+	that loader.  loaders is [(BuildLoader, hits)].  Raises LoadError when
+	some hits have no sequence in fasta.
+	"""
+	wanted = {}
+	for l, hits in loaders:
+		for accession in hits:
+			wanted.setdefault(accession, []).append(l)
+	batches = dict((l, []) for l, hits in loaders)
+
+	found = set()
+	for header, seq in fasta:
+		accession = header.split(None, 1)[0]
+		if accession not in wanted or accession in found:
+			continue
+		found.add(accession)
+		record = parse_header(header) + (seguid(seq), seq)
+		for l in wanted[accession]:
+			batch = batches[l]
+			batch.append(record)
+			if len(batch) >= batch_size:
+				l.load_batch(batch)
+				batches[l] = []
+	for l, batch in batches.items():
+		if batch:
+			l.load_batch(batch)
+
+	missing = set(wanted) - found
+	if missing:
+		raise LoadError("%d hits have no sequence in the FASTA file, e.g. %s"
+		  % (len(missing), ", ".join(sorted(missing)[:5])))
+
+
+@transaction.commit_on_success
+def load_hits(hits, fasta, node_id, method_id, db_id, name='', desc='',
+              batch_size=BATCH_SIZE):
+	"""
+	Create a FamilyBuild holding the sequences of fasta that are hits.
+
+	hits is the dict returned by read_tblout(), fasta an iterable of
+	(header, sequence).  Returns (build_id, counts) where counts has the
+	number of new sequences, sequence information, species and member
+	rows.  Raises LoadError, leaving the database untouched, when some
+	hits have no sequence in fasta.
+	"""
+	cursor = connection.cursor()
+	build_id = create_build(cursor, method_id, name, desc)
+	loader = BuildLoader(cursor, build_id, node_id, db_id)
+	load_records([(loader, hits)], fasta, batch_size)
+	build_family_summary(build_id)
+	return build_id, loader.counts
+
+
+@transaction.commit_on_success
+def load_delta(previous_build_id, hits_by_node, fasta, dropped, method_id,
+               db_id, name='', desc='', batch_size=BATCH_SIZE):
+	"""
+	Create the FamilyBuild that follows previous_build_id after a UniProt
+	release.
+
+	dropped are the accessions (of db_id) that were removed or changed;
+	their sequences leave the build unless another accession still has
+	them.  hits_by_node maps instance node ids to read_tblout() hits
+	among the added and changed sequences, whose records fasta yields.
+	Returns (build_id, counts) with the load_hits() counts summed over
+	the nodes, plus the number of 'inherited' and 'dropped' members.
+	"""
+	if not FamilyBuild.objects.filter(pk=previous_build_id).exists():
+		raise LoadError("No family build %s" % previous_build_id)
+	cursor = connection.cursor()
+	build_id = create_build(cursor, method_id, name, desc)
+	copied = copy_members(cursor, previous_build_id, build_id)
+	removed = drop_members(cursor, build_id,
+	  dropped_sequences(cursor, dropped, db_id))
+
+	loaders = []
+	for node_id, hits in sorted(hits_by_node.items()):
+		l = BuildLoader(cursor, build_id, node_id, db_id)
+		cursor.execute("SELECT sequence_id FROM " +
+		  FamilyMember._meta.db_table + " " +
+		  "WHERE family_build_id = %s AND instance_node_id = %s",
+		  [build_id, node_id])
+		l.members.update(row[0] for row in cursor.fetchall())
+		loaders.append((l, hits))
+	load_records(loaders, fasta, batch_size)
+
+	counts = dict(sequences=0, information=0, members=0, species=0,
+	  inherited=copied - removed, dropped=removed)
+	for l, hits in loaders:
+		for key, value in l.counts.items():
+			counts[key] = counts.get(key, 0) + value
+	build_family_summary(build_id)
+	return build_id, counts
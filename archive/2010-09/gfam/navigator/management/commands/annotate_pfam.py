@@ -0,0 +1,44 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from navigator.annotate import (AnnotationError, BATCH_SIZE, DATABASE,
+                                PROCESSES, annotate)
+from navigator.tracks import build_tracks
+
+
+class Command(BaseCommand):
+    help = 'Scans the protein sequences that were not yet scanned ' + \
+           'against the Pfam release with hmmscan and stores their ' + \
+           'domains as PFAM features, then rebuilds their feature tracks.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default=DATABASE,
+            help='hmmpress-ed Pfam HMM library [default: %default]'),
+        make_option('--release',
+            help='name of the Pfam release; sequences scanned against ' +
+                 'another are scanned again (default: the library\'s ' +
+                 'file name, size and mtime)'),
+        make_option('--processes', type='int', default=PROCESSES,
+            help='hmmscan processes [default: %default]'),
+        make_option('--batch-size', type='int', default=BATCH_SIZE,
+            help='sequences per hmmscan run and transaction ' +
+                 '[default: %default]'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("annotate_pfam takes no arguments")
+        start = time.time()
+        try:
+            counts = annotate(options['database'], options['release'],
+                              options['processes'], options['batch_size'])
+        except AnnotationError, e:
+            raise CommandError(str(e))
+        self.stdout.write("Scanned %d sequences, %d Pfam domains in " \
+            "%.1f s\n" % (counts['sequences'], counts['domains'],
+            time.time() - start))
+        if counts['sequence_ids']:
+            self.stdout.write("Built %d feature tracks\n" %
+                build_tracks(counts['sequence_ids']))
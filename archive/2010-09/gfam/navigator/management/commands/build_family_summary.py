@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from navigator.models import FamilyBuild
+from navigator.summary import build_family_summary
+
+
+class Command(BaseCommand):
+    args = '[build_id build_id ...]'
+    help = 'Computes the per-build family summary shown on the families ' + \
+           'page. Without arguments every build is summarized.'
+
+    def handle(self, *args, **options):
+        if args:
+            try:
+                build_ids = [int(a) for a in args]
+            except ValueError:
+                raise CommandError("Build ids must be integers: %s" %
+                  " ".join(args))
+        else:
+            build_ids = FamilyBuild.objects.values_list('family_build_id',
+              flat=True)
+
+        for build_id in build_ids:
+            count = build_family_summary(build_id)
+            self.stdout.write("Build %d: %d families\n" % (build_id, count))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from navigator.tracks import build_tracks
+
+
+class Command(BaseCommand):
+    args = '[sequence_id sequence_id ...]'
+    help = 'Builds the feature tracks the gene structure pages draw from. ' + \
+           'Run after loading features; without arguments the tracks ' + \
+           'of every sequence with features are rebuilt.'
+
+    def handle(self, *args, **options):
+        sequence_ids = None
+        if args:
+            try:
+                sequence_ids = [int(a) for a in args]
+            except ValueError:
+                raise CommandError("Sequence ids must be integers: %s" %
+                  " ".join(args))
+        count = build_tracks(sequence_ids)
+        self.stdout.write("Built %d feature tracks\n" % count)
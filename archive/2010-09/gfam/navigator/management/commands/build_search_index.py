@@ -0,0 +1,25 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from navigator.search import INDEX_PATH, rebuild_index, update_index
+
+
+class Command(BaseCommand):
+    help = 'Adds new sequence_information rows to the search index, ' + \
+           'or with --rebuild indexes all of them into a new file.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', default=False,
+            help='index every row into a new index file'),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        if options['rebuild']:
+            count = rebuild_index()
+        else:
+            count = update_index()
+        self.stdout.write("Indexed %d rows into %s in %.1f s\n" % (
+            count, INDEX_PATH, time.time() - start))
@@ -0,0 +1,40 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from navigator.export import PROCESSES, export_build
+from navigator.models import FamilyBuild
+
+
+class Command(BaseCommand):
+    args = '<build_id> <directory>'
+    help = 'Exports the pages, FASTA files and gene structure images of ' + \
+           'a family build to a directory a static file server can ' + \
+           'serve.  Only files whose inputs changed since the last ' + \
+           'export are rewritten.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=PROCESSES,
+            help='worker processes [default: %default]'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Expected a build id and a directory")
+        try:
+            build_id = int(args[0])
+        except ValueError:
+            raise CommandError("Build id must be an integer: %s" % args[0])
+
+        start = time.time()
+        try:
+            counts = export_build(build_id, args[1], options['processes'])
+        except FamilyBuild.DoesNotExist, e:
+            raise CommandError(str(e))
+        for error in counts['errors']:
+            self.stderr.write("%s\n" % error)
+        self.stdout.write("Build %d: %d files written, %d unchanged, " \
+            "%d removed, %d failed in %.1f s\n" % (build_id,
+            counts['written'], counts['unchanged'], counts['removed'],
+            counts['failed'], time.time() - start))
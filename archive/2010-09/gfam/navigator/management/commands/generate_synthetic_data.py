@@ -0,0 +1,45 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from navigator.synthetic import generate
+
+
+class Command(BaseCommand):
+    help = 'Adds a synthetic family tree, builds, sequences and gene ' + \
+           'models to the database for benchmarks (see ' + \
+           'navigator/synthetic.py and benchmark_load.py).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--builds', type='int', default=2,
+            help='family builds [default: %default]'),
+        make_option('--families', type='int', default=200,
+            help='families in the tree [default: %default]'),
+        make_option('--sequences', type='int', default=100000,
+            help='sequences, each a member of every build ' +
+                 '[default: %default]'),
+        make_option('--accessions', type='int', default=1,
+            help='sequence_information rows per sequence ' +
+                 '[default: %default]'),
+        make_option('--features', type='float', default=0.2,
+            help='share of the sequences with a gene model ' +
+                 '[default: %default]'),
+        make_option('--seed', type='int', default=0,
+            help='random seed [default: %default]'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("generate_synthetic_data takes no arguments")
+        if min(options['builds'], options['families'],
+               options['sequences'], options['accessions']) < 1:
+            raise CommandError("Builds, families, sequences and " +
+                               "accessions must be at least 1")
+        start = time.time()
+        counts = generate(options['builds'], options['families'],
+            options['sequences'], options['accessions'],
+            options['features'], options['seed'])
+        for table, count in sorted(counts.items()):
+            self.stdout.write("%-22s %10d\n" % (table, count))
+        self.stdout.write("Generated in %.1f s\n" % (time.time() - start))
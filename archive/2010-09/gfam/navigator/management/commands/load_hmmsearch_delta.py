@@ -0,0 +1,91 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from navigator.loader import LoadError, load_delta, read_fasta, read_tblout
+from navigator.management.commands.load_hmmsearch_hits import open_file
+from navigator.models import FamilyBuild, FamilyTreeInstance
+from navigator.caching import builds_changed
+from navigator.search import update_index
+
+
+def instance_node(name):
+    """An instance node id, given as a number or a family abbreviation."""
+    if name.isdigit():
+        return int(name)
+    ids = list(FamilyTreeInstance.objects
+      .filter(family_tree_node__family_tree_node_abrev=name)
+      .values_list('node_id', flat=True))
+    if len(ids) != 1:
+        raise CommandError("%d tree instances of family %s, give the "
+                           "instance node id instead" % (len(ids), name))
+    return ids[0]
+
+
+def read_delta(f):
+    """Accessions removed or changed, from refresh.incremental's delta.tsv."""
+    dropped = []
+    for line in f:
+        status, accession = line.split()
+        if status in ('removed', 'changed'):
+            dropped.append(accession)
+    return dropped
+
+
+class Command(BaseCommand):
+    args = '<delta.tsv> <delta.fasta> <node>:<tblout> [<node>:<tblout> ...]'
+    help = 'Makes the next family build from --previous and a UniProt ' + \
+           'release delta (see refresh.incremental), with the hits ' + \
+           'of each family among the added and changed sequences.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--previous', type='int',
+            help='family_build the new build follows'),
+        make_option('--method', type='int',
+            help='family_build_method of the new build (default: the ' +
+                 'method of the previous build)'),
+        make_option('--db', type='int',
+            help='db the accessions belong to (e.g. UniProt)'),
+        make_option('--name', default='', help='build name'),
+        make_option('--desc', default='', help='build description'),
+        make_option('--evalue', type='float',
+            help='ignore hits with a full sequence E-value above this'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) < 2:
+            raise CommandError("Usage: load_hmmsearch_delta %s" % self.args)
+        for option in ('previous', 'db'):
+            if options[option] is None:
+                raise CommandError("--%s is required" % option)
+        try:
+            previous = FamilyBuild.objects.get(pk=options['previous'])
+        except FamilyBuild.DoesNotExist:
+            raise CommandError("No family build %s" % options['previous'])
+
+        start = time.time()
+        hits_by_node = {}
+        for arg in args[2:]:
+            if ':' not in arg:
+                raise CommandError("Expected <node>:<tblout>, got %s" % arg)
+            node, path = arg.split(':', 1)
+            hits = read_tblout(open_file(path), options['evalue'])
+            hits_by_node.setdefault(instance_node(node), {}).update(hits)
+
+        try:
+            build_id, counts = load_delta(previous.pk, hits_by_node,
+                read_fasta(open_file(args[1])),
+                read_delta(open_file(args[0])),
+                options['method'] or previous.family_build_method_id,
+                options['db'], options['name'], options['desc'])
+        except LoadError, e:
+            raise CommandError(str(e))
+        builds_changed()
+
+        self.stdout.write("Build %d: %d members kept from build %d, " \
+            "%d dropped, %d added, %d new sequences in %.1f s\n" % (
+            build_id, counts['inherited'], previous.pk, counts['dropped'],
+            counts['members'], counts['sequences'], time.time() - start))
+        self.stdout.write("%d rows added to the search index\n" %
+            update_index())
@@ -0,0 +1,62 @@
+import gzip
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from navigator.loader import LoadError, load_hits, read_fasta, read_tblout
+from navigator.caching import builds_changed
+from navigator.search import update_index
+
+
+def open_file(path):
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    return open(path)
+
+
+class Command(BaseCommand):
+    args = '<tblout> <fasta>'
+    help = 'Loads hmmsearch --tblout hits, with their sequences from a ' + \
+           'FASTA file, as a new family build.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--node', type='int',
+            help='family_tree_instance the hits become members of'),
+        make_option('--method', type='int',
+            help='family_build_method of the new build'),
+        make_option('--db', type='int',
+            help='db the accessions belong to (e.g. UniProt)'),
+        make_option('--name', default='', help='build name'),
+        make_option('--desc', default='', help='build description'),
+        make_option('--evalue', type='float',
+            help='ignore hits with a full sequence E-value above this'),
+        make_option('--query',
+            help='only load hits of this query (HMM) name'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Usage: load_hmmsearch_hits %s" % self.args)
+        for option in ('node', 'method', 'db'):
+            if options[option] is None:
+                raise CommandError("--%s is required" % option)
+
+        start = time.time()
+        hits = read_tblout(open_file(args[0]), options['evalue'],
+                           options['query'])
+        try:
+            build_id, counts = load_hits(hits, read_fasta(open_file(args[1])),
+                options['node'], options['method'], options['db'],
+                options['name'], options['desc'])
+        except LoadError, e:
+            raise CommandError(str(e))
+        builds_changed()
+
+        self.stdout.write("Build %d: %d hits, %d new sequences, " \
+            "%d new sequence_information rows, %d new species " \
+            "in %.1f s\n" % (build_id, counts['members'],
+            counts['sequences'], counts['information'], counts['species'],
+            time.time() - start))
+        self.stdout.write("%d rows added to the search index\n" %
+            update_index())
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from navigator.models import FamilyTree
+from navigator.tree import number_tree
+
+
+class Command(BaseCommand):
+    args = '[family_tree_id family_tree_id ...]'
+    help = 'Recomputes the nested-set (preorder interval) columns of ' + \
+           'family_tree_instance. Run after loading or editing a tree. ' + \
+           'Without arguments every tree is numbered.'
+
+    def handle(self, *args, **options):
+        if args:
+            try:
+                tree_ids = [int(a) for a in args]
+            except ValueError:
+                raise CommandError("Tree ids must be integers: %s" %
+                  " ".join(args))
+        else:
+            tree_ids = FamilyTree.objects.values_list('family_tree_id',
+              flat=True)
+
+        for tree_id in tree_ids:
+            count = number_tree(tree_id)
+            self.stdout.write("Tree %d: %d nodes\n" % (tree_id, count))
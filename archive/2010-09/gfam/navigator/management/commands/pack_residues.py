@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from navigator.loader import insert_rows
+from navigator.models import Sequence, SequenceResidues
+from navigator.residues import RESIDUE_COLUMNS, residue_rows
+
+
+class Command(BaseCommand):
+    help = 'Packs the residues of sequences loaded before sequence_residues ' + \
+           'existed into that table.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--clear', action='store_true', default=False,
+            help='empty the sequence column of the packed sequences'),
+        make_option('--batch', type='int', default=1000,
+            help='sequences per transaction [default: %default]'),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        try:
+            total = self.pack(options['batch'], options['clear'])
+        except:
+            transaction.rollback()
+            raise
+        self.stdout.write("Packed %d sequences\n" % total)
+
+    def pack(self, batch_size, clear):
+        sequence = Sequence._meta.db_table
+        residues = SequenceResidues._meta.db_table
+        cursor = connection.cursor()
+        total = 0
+        last = -1
+        while True:
+            cursor.execute("SELECT s.sequence_id, s.sequence, s.alphabet " +
+              "FROM " + sequence + " s WHERE s.sequence_id > %s " +
+              "AND s.sequence <> '' AND NOT EXISTS (SELECT 1 FROM " +
+              residues + " r WHERE r.sequence_id = s.sequence_id) " +
+              "ORDER BY s.sequence_id LIMIT %s", [last, batch_size])
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            insert_rows(cursor, SequenceResidues, RESIDUE_COLUMNS,
+              [residue_rows(*row) for row in rows])
+            if clear:
+                cursor.execute("UPDATE " + sequence + " SET sequence = '' " +
+                  "WHERE sequence_id BETWEEN %s AND %s " +
+                  "AND sequence_id IN (SELECT sequence_id FROM " +
+                  residues + ")", [rows[0][0], rows[-1][0]])
+            transaction.commit()
+            total += len(rows)
+            last = rows[-1][0]
+        return total
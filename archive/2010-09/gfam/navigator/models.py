@@ -40,33 +40,79 @@ class FamilyBuild(models.Model):
     class Meta:
         db_table = u'family_build'
 
+class SequenceManager(models.Manager):
+    # Residues are read through Sequence.residues, never with the row
+    def get_query_set(self):
+        return super(SequenceManager, self).get_query_set().defer('sequence')
+
 class Sequence(models.Model):
     sequence_id = models.IntegerField(primary_key=True)
     seguid = models.CharField(unique=True, max_length=256)
     alphabet = models.CharField(max_length=256)
     length = models.IntegerField()
+    # Only filled for sequences loaded before sequence_residues existed
     sequence = models.CharField(max_length=256)
+    objects = SequenceManager()
     class Meta:
         db_table = u'sequence'
 
+    @property
+    def residues(self):
+        from navigator.residues import Residues
+        return Residues(self.sequence_id, self.length)
+
+class PackedField(models.Field):
+    """Binary column holding packed residues (see navigator.residues)."""
+    def db_type(self, connection):
+        engine = connection.settings_dict['ENGINE']
+        if 'postgresql' in engine:
+            return 'bytea'
+        if 'mysql' in engine:
+            return 'longblob'
+        return 'blob'
+
+class SequenceResidues(models.Model):
+    sequence = models.OneToOneField(Sequence, primary_key=True)
+    encoding = models.CharField(max_length=16)
+    length = models.IntegerField()
+    exceptions = models.TextField()
+    packed = PackedField()
+    class Meta:
+        db_table = u'sequence_residues'
+
 
 class FamilyTreeInstance(models.Model):
-    node_id = models.IntegerField(primary_key=True)
+    node_id = models.IntegerField(primary_key=True, db_column='instance_node_id')
     parent_node = models.ForeignKey('self')
     family_tree_node = models.ForeignKey(FamilyTreeNode)
     rank = models.IntegerField()
     family_tree = models.ForeignKey(FamilyTree)
+    preorder_code = models.CharField(max_length=256, null=True)
+    preorder_left = models.IntegerField(null=True)
+    preorder_right = models.IntegerField(null=True)
+    depth = models.IntegerField(null=True)
     class Meta:
         db_table = u'family_tree_instance'
 
 class FamilyMember(models.Model):
     family_member_id = models.IntegerField(primary_key=True)
     family_build = models.ForeignKey(FamilyBuild)
-    node = models.ForeignKey(FamilyTreeInstance)
+    node = models.ForeignKey(FamilyTreeInstance, db_column='instance_node_id')
     sequence = models.ForeignKey(Sequence)
     class Meta:
         db_table = u'family_member'
 
+class FamilySummary(models.Model):
+    family_summary_id = models.IntegerField(primary_key=True)
+    family_build = models.ForeignKey(FamilyBuild)
+    instance_node = models.ForeignKey(FamilyTreeInstance)
+    preorder_code = models.CharField(max_length=256, null=True)
+    family_tree_node_abrev = models.CharField(max_length=256)
+    family_tree_node_name = models.CharField(max_length=256)
+    member_count = models.IntegerField()
+    class Meta:
+        db_table = u'family_summary'
+
 class Genome(models.Model):
     genome_id = models.IntegerField(primary_key=True)
     genome_name = models.CharField(max_length=256)
@@ -148,6 +194,24 @@ class SequenceLocation(models.Model):
         db_table = u'sequence_location'
 
 
+class FeatureTrack(models.Model):
+    # Features, locations and tags of a sequence as JSON (navigator/tracks.py)
+    sequence = models.OneToOneField(Sequence, primary_key=True)
+    track = models.TextField()
+    class Meta:
+        db_table = u'feature_track'
+
+
+class PfamScan(models.Model):
+    # The Pfam release a sequence checksum was last scanned against
+    # (navigator/annotate.py); its hits are PFAM SequenceFeature rows
+    seguid = models.CharField(max_length=256, primary_key=True)
+    release = models.CharField(max_length=256)
+    domains = models.IntegerField()
+    class Meta:
+        db_table = u'pfam_scan'
+
+
 class Dblink(models.Model):
     dblink_id = models.IntegerField(primary_key=True)
     section = models.CharField(max_length=256)
@@ -0,0 +1,45 @@
+"""
+Read-only queries used by the views.
+
+Every function here returns plain rows (lists of dicts or values) and
+fetches whatever related tables it needs through joins in a single query,
+so walking the result in a view or template never goes back to the
+database.
+"""
+
+from navigator.models import *
+
+BUILD_FIELDS = {
+	'build_id': 'family_build_id',
+	'timestamp': 'family_build_timestamp',
+	'method_id': 'family_build_method__family_build_method_id',
+	'method': 'family_build_method__family_build_method_name',
+}
+
+def _rows(queryset, fields):
+	"""Run queryset.values() and rename the columns to the keys of fields."""
+	names = fields.items()
+	return [dict((key, row[column]) for key, column in names)
+	  for row in queryset.values(*[column for key, column in names])]
+
+
+def builds():
+	"""All family builds with their method, oldest first."""
+	return _rows(FamilyBuild.objects.order_by('family_build_id'),
+	  BUILD_FIELDS)
+
+
+def method(method_id):
+	"""The name of a build method and the ids of the builds made with it."""
+	rows = FamilyBuild.objects.filter(family_build_method=method_id) \
+	  .order_by('family_build_id') \
+	  .values('family_build_id', 'family_build_method__family_build_method_name')
+	rows = list(rows)
+	if rows:
+		name = rows[0]['family_build_method__family_build_method_name']
+	else:
+		name = FamilyBuildMethod.objects.filter(
+		  family_build_method_id=method_id) \
+		  .values_list('family_build_method_name', flat=True).get()
+	return {'name': name, 'builds': [r['family_build_id'] for r in rows]}
+
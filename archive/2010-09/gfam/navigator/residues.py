@@ -0,0 +1,327 @@
+"""
+Compact residue storage.
+
+Residues live in sequence_residues, packed by alphabet:
+
+    dna2     2 bits per residue (ACGT), 4 residues per byte
+    protein5 5 bits per residue, 8 residues per 5 bytes
+    raw      the residues as they are, for anything else
+
+Characters outside the packed alphabet (N runs, selenocysteine, lower
+case, ...) are kept in the exceptions column as "offset:run" pairs.
+Since every residue has a fixed bit width, residues [start, end) sit in
+a byte range that is computed up front, and only those bytes are read
+from the database (with substr(); on PostgreSQL the packed column is
+stored uncompressed so substr() reads only the TOAST chunks it needs).
+
+Residues(sequence_id, length) is the lazy handle that Sequence.residues
+returns; slicing it reads just that window.  Sequences loaded before
+this table existed are read from the sequence column instead.
+"""
+
+import struct
+
+from django.db import connection, transaction
+
+from navigator.models import Sequence, SequenceResidues
+
+TABLE = SequenceResidues._meta.db_table
+SEQUENCE = Sequence._meta.db_table
+
+# Sequence ids per IN (...) query
+BATCH_SIZE = 500
+
+NUCLEOTIDES = 'ACGT'
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWYBZXUOJ*-'
+
+# encoding -> (alphabet, bits per residue, residues per group, bytes per group)
+ENCODINGS = {
+	'dna2': (NUCLEOTIDES, 2, 4, 1),
+	'protein5': (AMINO_ACIDS, 5, 8, 5),
+	'raw': (None, 8, 1, 1),
+}
+
+
+def encoding_for(alphabet):
+	alphabet = (alphabet or '').lower()
+	if alphabet in ('dna', 'nucleotide', 'nucleic', 'rna'):
+		return 'dna2'
+	if alphabet == 'protein':
+		return 'protein5'
+	return 'raw'
+
+
+# -- packing -----------------------------------------------------------------
+
+def _exceptions(sequence, alphabet):
+	"""Runs of characters not in alphabet, as [(offset, run)]."""
+	runs = []
+	start = None
+	for i, c in enumerate(sequence):
+		if c in alphabet:
+			if start is not None:
+				runs.append((start, sequence[start:i]))
+				start = None
+		elif start is None:
+			start = i
+	if start is not None:
+		runs.append((start, sequence[start:]))
+	return runs
+
+
+def format_exceptions(runs):
+	return ','.join('%d:%s' % run for run in runs)
+
+
+def parse_exceptions(text):
+	runs = []
+	for item in text.split(',') if text else ():
+		offset, run = item.split(':', 1)
+		runs.append((int(offset), run))
+	return runs
+
+
+_PACK_DNA = {}
+_UNPACK_DNA = []
+for _i in range(256):
+	_word = ''.join(NUCLEOTIDES[(_i >> s) & 3] for s in (6, 4, 2, 0))
+	_PACK_DNA[_word] = chr(_i)
+	_UNPACK_DNA.append(_word)
+
+# Pairs of amino acids <-> 10-bit numbers
+_PACK_PAIR = {}
+_UNPACK_PAIR = [AMINO_ACIDS[0] * 2] * 1024
+for _a, _x in enumerate(AMINO_ACIDS):
+	for _b, _y in enumerate(AMINO_ACIDS):
+		_PACK_PAIR[_x + _y] = _a << 5 | _b
+		_UNPACK_PAIR[_a << 5 | _b] = _x + _y
+
+_QUAD = struct.Struct('>Q')
+
+
+def encode(sequence, alphabet):
+	"""Pack sequence; returns (encoding, packed bytes, exceptions text)."""
+	encoding = encoding_for(alphabet)
+	letters, bits, group, size = ENCODINGS[encoding]
+	if letters is None:
+		return encoding, sequence, ''
+
+	runs = _exceptions(sequence, letters)
+	if runs:
+		# Packed as the first letter; put back from exceptions on read
+		chars = list(sequence)
+		for offset, run in runs:
+			chars[offset:offset + len(run)] = letters[0] * len(run)
+		sequence = ''.join(chars)
+	sequence += letters[0] * (-len(sequence) % group)
+
+	if encoding == 'dna2':
+		packed = ''.join([_PACK_DNA[sequence[i:i + 4]]
+		  for i in xrange(0, len(sequence), 4)])
+	else:
+		out = []
+		pack = _QUAD.pack
+		pair = _PACK_PAIR
+		for i in xrange(0, len(sequence), 8):
+			n = pair[sequence[i:i + 2]] << 30 | \
+			  pair[sequence[i + 2:i + 4]] << 20 | \
+			  pair[sequence[i + 4:i + 6]] << 10 | \
+			  pair[sequence[i + 6:i + 8]]
+			out.append(pack(n)[3:])
+		packed = ''.join(out)
+	return encoding, packed, format_exceptions(runs)
+
+
+def byte_range(encoding, start, end):
+	"""
+	(first byte, byte count, first residue) of the groups that hold
+	residues [start, end).
+	"""
+	letters, bits, group, size = ENCODINGS[encoding]
+	first = start // group
+	last = (end + group - 1) // group
+	return first * size, (last - first) * size, first * group
+
+
+def unpack(encoding, packed, exceptions='', offset=0):
+	"""
+	Unpack bytes holding whole groups that start at residue offset.
+	Returns the residues, padding included.
+	"""
+	packed = str(packed)
+	if encoding == 'raw':
+		return packed
+	if encoding == 'dna2':
+		residues = ''.join([_UNPACK_DNA[ord(c)] for c in packed])
+	else:
+		out = []
+		unpack = _QUAD.unpack
+		pair = _UNPACK_PAIR
+		for i in xrange(0, len(packed), 5):
+			n = unpack('\0\0\0' + packed[i:i + 5])[0]
+			out.append(pair[n >> 30] + pair[(n >> 20) & 1023] +
+			  pair[(n >> 10) & 1023] + pair[n & 1023])
+		residues = ''.join(out)
+
+	if exceptions:
+		end = offset + len(residues)
+		chars = None
+		for start, run in parse_exceptions(exceptions):
+			if start >= end or start + len(run) <= offset:
+				continue
+			if chars is None:
+				chars = list(residues)
+			lo = max(start, offset)
+			hi = min(start + len(run), end)
+			chars[lo - offset:hi - offset] = run[lo - start:hi - start]
+		if chars is not None:
+			residues = ''.join(chars)
+	return residues
+
+
+def decode(encoding, packed, exceptions, length):
+	return unpack(encoding, packed, exceptions)[:length]
+
+
+# -- storage -----------------------------------------------------------------
+
+def residue_rows(sequence_id, sequence, alphabet):
+	"""The sequence_residues row of a sequence, for insert_rows()."""
+	encoding, packed, exceptions = encode(sequence, alphabet)
+	return (sequence_id, encoding, len(sequence), exceptions, buffer(packed))
+
+RESIDUE_COLUMNS = ['sequence_id', 'encoding', 'length', 'exceptions',
+  'packed']
+
+
+@transaction.commit_manually
+def store(sequence_id, sequence, alphabet):
+	"""Write (or replace) the packed residues of one sequence, and commit."""
+	try:
+		cursor = connection.cursor()
+		cursor.execute("DELETE FROM " + TABLE + " WHERE sequence_id = %s",
+		  [sequence_id])
+		cursor.execute("INSERT INTO " + TABLE + " (" +
+		  ",".join(RESIDUE_COLUMNS) + ") VALUES (%s, %s, %s, %s, %s)",
+		  residue_rows(sequence_id, sequence, alphabet))
+	except:
+		transaction.rollback()
+		raise
+	transaction.commit()
+
+
+def fetch_range(sequence_id, start, end=None):
+	"""
+	Residues [start, end) of a sequence (0-based), reading only the
+	bytes that hold them.  Returns None for unknown sequences.
+	"""
+	cursor = connection.cursor()
+	cursor.execute("SELECT encoding, length, exceptions FROM " + TABLE +
+	  " WHERE sequence_id = %s", [sequence_id])
+	row = cursor.fetchone()
+	if row is None:
+		return _legacy_range(cursor, sequence_id, start, end)
+	encoding, length, exceptions = row
+	end = length if end is None else min(end, length)
+	start = max(0, start)
+	if start >= end:
+		return ''
+	first, count, offset = byte_range(encoding, start, end)
+	cursor.execute("SELECT substr(packed, %s, %s) FROM " + TABLE +
+	  " WHERE sequence_id = %s", [first + 1, count, sequence_id])
+	residues = unpack(encoding, cursor.fetchone()[0], exceptions, offset)
+	return residues[start - offset:end - offset]
+
+
+def _legacy_range(cursor, sequence_id, start, end):
+	cursor.execute("SELECT length, substr(sequence, %s, %s) FROM " +
+	  SEQUENCE + " WHERE sequence_id = %s",
+	  [start + 1, (end if end is not None else 2 ** 31 - 1) - start,
+	   sequence_id])
+	row = cursor.fetchone()
+	return row and row[1]
+
+
+def fetch_sequences(sequence_ids):
+	"""{sequence_id: residues} for many sequences."""
+	sequence_ids = list(sequence_ids)
+	cursor = connection.cursor()
+	sequences = {}
+	for i in xrange(0, len(sequence_ids), BATCH_SIZE):
+		batch = sequence_ids[i:i + BATCH_SIZE]
+		cursor.execute("SELECT sequence_id, encoding, length, exceptions, " +
+		  "packed FROM " + TABLE + " WHERE sequence_id IN (" +
+		  ",".join(["%s"] * len(batch)) + ")", batch)
+		for sequence_id, encoding, length, exceptions, packed in \
+		  cursor.fetchall():
+			sequences[sequence_id] = decode(encoding, packed, exceptions,
+			  length)
+
+		legacy = [s for s in batch if s not in sequences]
+		if legacy:
+			cursor.execute("SELECT sequence_id, sequence FROM " + SEQUENCE +
+			  " WHERE sequence_id IN (" + ",".join(["%s"] * len(legacy)) +
+			  ")", legacy)
+			sequences.update(cursor.fetchall())
+	return sequences
+
+
+def iter_fasta(rows, batch_size=BATCH_SIZE):
+	"""
+	Yield FASTA records for a stream of (sequence_id, header) rows,
+	decoding the residues of batch_size rows at a time.
+	"""
+	batch = []
+	for row in rows:
+		batch.append(row)
+		if len(batch) >= batch_size:
+			for record in _fasta_records(batch):
+				yield record
+			batch = []
+	for record in _fasta_records(batch):
+		yield record
+
+
+def _fasta_records(batch):
+	sequences = fetch_sequences(set(row[0] for row in batch))
+	for sequence_id, header in batch:
+		yield ">%s\n%s\n" % (header, sequences.get(sequence_id, ''))
+
+
+class Residues(object):
+	"""
+	The residues of a sequence, read from the database only when sliced
+	or converted to a string:
+
+		seq.residues[100:160]    # 60 residues, one small read
+		len(seq.residues)        # no read at all
+	"""
+
+	def __init__(self, sequence_id, length):
+		self.sequence_id = sequence_id
+		self.length = length
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			start, stop, step = index.indices(self.length)
+			if step != 1:
+				return self[start:stop][::step]
+			return fetch_range(self.sequence_id, start, stop) or ''
+		if index < 0:
+			index += self.length
+		if not 0 <= index < self.length:
+			raise IndexError(index)
+		return fetch_range(self.sequence_id, index, index + 1)
+
+	def __str__(self):
+		return fetch_range(self.sequence_id, 0) or ''
+
+	def window(self, start_pos, end_pos, flank=0):
+		"""
+		Residues of a SequenceLocation (1-based, inclusive) with flank
+		residues on either side.
+		"""
+		return self[max(0, start_pos - 1 - flank):end_pos + flank]
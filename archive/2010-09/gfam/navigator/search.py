@@ -0,0 +1,247 @@
+"""
+Text search over SequenceInformation.
+
+The index is a SQLite file (settings.SEARCH_INDEX_PATH) next to, not in,
+the main database:
+
+    entry   one row per sequence_information row, with the lower case
+            accession as a b-tree key for prefix lookups (At1g0 ...)
+    text    a full-text table over accession, display, gene_name,
+            fullname, alt_fullname, symbols and description, for ranked
+            keyword search (BM25, accession and names weighted up)
+
+Rows are only ever added by the loaders, so the index is kept up to date
+incrementally: update_index() adds the rows with ids above the highest
+one it has seen.  The load_hmmsearch_* commands call it after a build is
+loaded, and manage.py build_search_index (re)builds it by hand.
+
+FTS5 is used when SQLite has it; otherwise FTS4, with the BM25 ranking
+computed from matchinfo() in Python.
+"""
+
+import math
+import os
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from navigator.models import SequenceInformation
+
+INDEX_PATH = getattr(settings, 'SEARCH_INDEX_PATH',
+  os.path.join(tempfile.gettempdir(), 'gfam-search.sqlite'))
+
+FIELDS = ['accession', 'display', 'gene_name', 'fullname', 'alt_fullname',
+  'symbols', 'description']
+
+# BM25 weight of each of FIELDS
+WEIGHTS = [10.0, 5.0, 5.0, 2.0, 1.0, 3.0, 1.0]
+
+RESULT_KEYS = ['sequence_information_id', 'sequence_id', 'accession',
+  'display', 'description']
+
+LIMIT = 50
+
+# Matches of a keyword query that are ranked.  Words like "protein" match
+# most rows, and ranking them all takes seconds, so only the first
+# CANDIDATES matches (in id order) are ranked.  Rare words, which are the
+# ones that tell rows apart, match fewer rows than this.
+CANDIDATES = 5000
+BATCH_SIZE = 10000
+
+_WORD = re.compile(r'\w+\*?', re.UNICODE)
+
+
+def _has_fts5():
+	db = sqlite3.connect(':memory:')
+	try:
+		db.execute("CREATE VIRTUAL TABLE t USING fts5(a)")
+		return True
+	except sqlite3.OperationalError:
+		return False
+	finally:
+		db.close()
+
+FTS5 = _has_fts5()
+
+
+def _bm25(matchinfo, *weights):
+	"""
+	BM25 of a row from FTS4 matchinfo(text, 'pcnalx'), negated so that
+	better rows sort first, as FTS5's bm25() does.
+	"""
+	info = struct.unpack('@%dI' % (len(matchinfo) // 4), matchinfo)
+	phrases, columns, rows = info[0], info[1], info[2]
+	average = info[3:3 + columns]
+	lengths = info[3 + columns:3 + 2 * columns]
+	hits = info[3 + 2 * columns:]
+	score = 0.0
+	for p in range(phrases):
+		for c in range(columns):
+			here, total, docs = hits[3 * (p * columns + c):
+			  3 * (p * columns + c) + 3]
+			if not here:
+				continue
+			idf = math.log((rows - docs + 0.5) / (docs + 0.5))
+			idf = max(idf, 1e-6)
+			norm = 1.2 * (0.25 + 0.75 * lengths[c] / max(average[c], 1))
+			score += weights[c] * idf * here * 2.2 / (here + norm)
+	return -score
+
+
+def query_terms(text):
+	"""Lower case words of text, keeping a trailing * for prefixes."""
+	return [w.lower() for w in _WORD.findall(text)]
+
+
+class SearchIndex(object):
+	def __init__(self, path=None):
+		self.path = path or INDEX_PATH
+		self.db = sqlite3.connect(self.path, check_same_thread=False)
+		self.inode = os.stat(self.path).st_ino
+		self.db.create_function('bm25_fts4', len(WEIGHTS) + 1, _bm25)
+		self._create()
+
+	def _create(self):
+		db = self.db
+		db.execute("CREATE TABLE IF NOT EXISTS entry (id INTEGER PRIMARY KEY, "
+		  "sequence_id INTEGER, key TEXT, " + ", ".join(FIELDS) + ")")
+		db.execute("CREATE INDEX IF NOT EXISTS entry_key ON entry (key)")
+		db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS text USING " +
+		  (FTS5 and "fts5(" + ", ".join(FIELDS) +
+		    ", content='entry', content_rowid='id')" or
+		   "fts4(content='entry', " + ", ".join(FIELDS) + ")"))
+		db.commit()
+
+	def close(self):
+		self.db.close()
+
+	def last_id(self):
+		return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM entry") \
+		  .fetchone()[0]
+
+	def __len__(self):
+		return self.db.execute("SELECT COUNT(*) FROM entry").fetchone()[0]
+
+	def add(self, rows):
+		"""
+		Index rows of (sequence_information_id, sequence_id, accession,
+		display, gene_name, fullname, alt_fullname, symbols,
+		description), in one transaction.  Returns the number added.
+		"""
+		columns = ", ".join(FIELDS)
+		marks = ", ".join(["?"] * len(FIELDS))
+		entry = "INSERT INTO entry (id, sequence_id, key, " + \
+		  columns + ") VALUES (?, ?, ?, " + marks + ")"
+		text = "INSERT INTO text (rowid, " + columns + ") VALUES (?, " + \
+		  marks + ")"
+		count = 0
+		with self.db:
+			for row in rows:
+				row = [v or '' for v in row]
+				self.db.execute(entry,
+				  [row[0], row[1], row[2].lower()] + row[2:])
+				self.db.execute(text, [row[0]] + row[2:])
+				count += 1
+		return count
+
+	def prefix(self, text, limit=LIMIT):
+		"""Entries whose accession starts with text, in accession order."""
+		key = text.lower()
+		return self._results("SELECT id, sequence_id, accession, display, "
+		  "description FROM entry WHERE key >= ? AND key < ? "
+		  "ORDER BY key LIMIT ?", [key, key + u'\uffff', limit])
+
+	def keywords(self, text, limit=LIMIT):
+		"""
+		Entries that have all words of text, best BM25 first among the
+		first CANDIDATES matches.
+		"""
+		terms = query_terms(text)
+		if not terms:
+			return []
+		weights = ", ".join(str(w) for w in WEIGHTS)
+		rank = FTS5 and "bm25(text, " + weights + ")" or \
+		  "bm25_fts4(matchinfo(text, 'pcnalx'), " + weights + ")"
+		return self._results("SELECT e.id, e.sequence_id, e.accession, "
+		  "e.display, e.description FROM (SELECT rowid, " + rank +
+		  " AS score FROM text WHERE text MATCH ? LIMIT ?) r "
+		  "JOIN entry e ON e.id = r.rowid ORDER BY r.score LIMIT ?",
+		  [" ".join(terms), CANDIDATES, limit])
+
+	def search(self, text, limit=LIMIT):
+		"""Accession prefix matches first, then keyword matches."""
+		text = text.strip()
+		results = []
+		if text and ' ' not in text and not text.endswith('*'):
+			results = self.prefix(text, limit)
+		seen = set(r['sequence_information_id'] for r in results)
+		for r in self.keywords(text, limit):
+			if len(results) >= limit:
+				break
+			if r['sequence_information_id'] not in seen:
+				results.append(r)
+		return results
+
+	def _results(self, sql, params):
+		return [dict(zip(RESULT_KEYS, row))
+		  for row in self.db.execute(sql, params)]
+
+
+_local = threading.local()
+
+
+def get_index():
+	"""
+	The SearchIndex of INDEX_PATH, one connection per thread, reopened
+	when rebuild_index() has replaced the file.
+	"""
+	index = getattr(_local, 'index', None)
+	if index is not None:
+		try:
+			if os.stat(index.path).st_ino == index.inode:
+				return index
+		except OSError:
+			pass
+		index.close()
+	index = _local.index = SearchIndex()
+	return index
+
+
+def information_rows(after_id=0, batch_size=BATCH_SIZE):
+	"""Yield the SearchIndex.add() rows of SequenceInformation by id."""
+	cursor = connection.cursor()
+	while True:
+		cursor.execute("SELECT sequence_information_id, sequence_id, " +
+		  ", ".join(FIELDS) + " FROM " + SequenceInformation._meta.db_table +
+		  " WHERE sequence_information_id > %s " +
+		  "ORDER BY sequence_information_id LIMIT %s", [after_id, batch_size])
+		rows = cursor.fetchall()
+		if not rows:
+			break
+		for row in rows:
+			yield row
+		after_id = rows[-1][0]
+
+
+def update_index(index=None):
+	"""Add the SequenceInformation rows the index has not seen yet."""
+	index = index or get_index()
+	return index.add(information_rows(index.last_id()))
+
+
+def rebuild_index(path=None):
+	"""Index every SequenceInformation row into a new index file."""
+	path = path or INDEX_PATH
+	tmp = path + '.new'
+	if os.path.exists(tmp):
+		os.remove(tmp)
+	index = SearchIndex(tmp)
+	count = index.add(information_rows())
+	index.close()
+	os.rename(tmp, path)
+	return count
@@ -0,0 +1,48 @@
+"""
+Similar sequences, from the BLAST service of the refresh project
+(projects/302-cellwall-refresh/code/refresh/blastservice.py).
+
+The service keeps the BLAST databases warm and caches results by query,
+so the navigator asks it for every page view and keeps no copy.  Set
+BLAST_SERVICE_URL to where it runs.
+"""
+
+import urllib
+import urllib2
+
+from django.conf import settings
+from django.utils import simplejson
+
+SERVICE_URL = getattr(settings, 'BLAST_SERVICE_URL', 'http://localhost:8017')
+TIMEOUT = getattr(settings, 'BLAST_SERVICE_TIMEOUT', 60)
+
+
+class SimilarityError(Exception):
+	"""status is the HTTP status the service answered, None if none."""
+	def __init__(self, message, status=None):
+		Exception.__init__(self, message)
+		self.status = status
+
+
+def similar_sequences(sequence, db='full'):
+	"""
+	BLAST hits of sequence in database db of the service, as a dict with
+	'hits' (accession, identity, length, evalue, bitscore, title) and
+	'cached'.  Raises SimilarityError when the service cannot answer,
+	with status 400 when it has no database db.
+	"""
+	data = urllib.urlencode({'db': db, 'sequence': sequence})
+	try:
+		f = urllib2.urlopen(SERVICE_URL + '/search', data, TIMEOUT)
+		try:
+			return simplejson.loads(f.read())
+		finally:
+			f.close()
+	except urllib2.HTTPError, e:
+		try:
+			message = simplejson.loads(e.read())['error']
+		except (ValueError, KeyError):
+			message = str(e)
+		raise SimilarityError(message, e.code)
+	except (urllib2.URLError, IOError), e:
+		raise SimilarityError("BLAST service unavailable: %s" % e)
@@ -0,0 +1,91 @@
+"""
+Helpers for sending large query results to the client without holding
+the whole result set in memory.
+
+Rows are pulled from the database in fetchmany() batches (through a
+server-side cursor on PostgreSQL), joined into moderately sized chunks
+and optionally gzip-compressed on the fly.  The resulting generators can
+be handed straight to HttpResponse, which iterates over them while
+writing to the socket.
+"""
+
+import itertools
+import zlib
+
+from django.db import connection
+
+FETCH_SIZE = 2000          # rows per fetchmany() round trip
+CHUNK_SIZE = 64 * 1024     # bytes per chunk written to the client
+
+_cursor_names = itertools.count(1)
+
+
+def server_side_cursor():
+	"""
+	Return a cursor that keeps the result set on the database server.
+
+	psycopg2 only does this for named cursors; on other backends the
+	regular cursor is returned and fetchmany() still bounds the number of
+	rows converted to Python objects at a time.
+	"""
+	cursor = connection.cursor()
+	if 'postgresql' in connection.settings_dict['ENGINE']:
+		cursor.close()
+		return connection.connection.cursor(
+		  'gfam_stream_%d' % next(_cursor_names))
+	return cursor
+
+
+def iter_rows(cursor, sql, params, fetch_size=FETCH_SIZE):
+	"""Execute sql on cursor and yield its rows one fetchmany() batch at a time."""
+	try:
+		cursor.execute(sql, params)
+		while True:
+			rows = cursor.fetchmany(fetch_size)
+			if not rows:
+				break
+			for row in rows:
+				yield row
+	finally:
+		cursor.close()
+
+
+def iter_query(sql, params, fetch_size=FETCH_SIZE):
+	"""
+	Like iter_rows(), but only opens the cursor once iteration starts.
+
+	The handler closes the database connection as soon as the view
+	returns, before the response body is written, so the cursor has to
+	be created from inside the generator.
+	"""
+	for row in iter_rows(server_side_cursor(), sql, params, fetch_size):
+		yield row
+
+
+def iter_chunks(lines, chunk_size=CHUNK_SIZE):
+	"""Join lines into strings of roughly chunk_size bytes."""
+	buf = []
+	size = 0
+	for line in lines:
+		buf.append(line)
+		size += len(line)
+		if size >= chunk_size:
+			yield ''.join(buf)
+			buf = []
+			size = 0
+	if buf:
+		yield ''.join(buf)
+
+
+def iter_gzip(chunks, level=6):
+	"""Compress a stream of chunks into a single gzip member."""
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	for chunk in chunks:
+		data = compressor.compress(chunk)
+		if data:
+			yield data
+	yield compressor.flush()
+
+
+def accepts_gzip(request):
+	return 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
@@ -0,0 +1,86 @@
+"""
+Per-build family summary.
+
+A family build does not change once it is loaded, so the member counts
+for its families are computed once (build_family_summary) into
+gfam.family_summary.  The families page then reads that table, and the
+result is kept in the cache under a key that carries the build id.
+"""
+
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from navigator.models import *
+
+SUMMARY = FamilySummary._meta.db_table
+MEMBER = FamilyMember._meta.db_table
+INSTANCE = FamilyTreeInstance._meta.db_table
+NODE = FamilyTreeNode._meta.db_table
+
+SUMMARY_KEYS = ["instance_node_id",
+                "preorder_code",
+                "family_tree_node_abrev",
+                "family_tree_node_name",
+                "member_count"]
+
+# Bump when SUMMARY_KEYS changes so stale cache entries are ignored
+SUMMARY_VERSION = 1
+
+CACHE_TIMEOUT = 30 * 24 * 60 * 60
+
+
+def cache_key(build_id):
+	return "gfam.families.v%d.b%d" % (SUMMARY_VERSION, build_id)
+
+
+def build_family_summary(build_id):
+	"""
+	(Re)compute the family_summary rows of one build.  Inside a managed
+	transaction (the loaders) the caller commits them.
+	"""
+	cursor = connection.cursor()
+	cursor.execute("DELETE FROM " + SUMMARY + " " +
+	  "WHERE family_build_id = %s", [build_id])
+	cursor.execute("INSERT INTO " + SUMMARY + " " +
+	  "(family_build_id, " + ",".join(SUMMARY_KEYS) + ") " +
+	  "SELECT m.family_build_id, i.instance_node_id, i.preorder_code, " +
+	    "n.family_tree_node_abrev, n.family_tree_node_name, m.member_count " +
+	  "FROM (SELECT family_build_id, instance_node_id, " +
+	      "count(*) AS member_count " +
+	    "FROM " + MEMBER + " WHERE family_build_id = %s " +
+	    "GROUP BY family_build_id, instance_node_id) m " +
+	  "JOIN " + INSTANCE + " i " +
+	    "ON i.instance_node_id = m.instance_node_id " +
+	  "JOIN " + NODE + " n " +
+	    "ON n.family_tree_node_id = i.family_tree_node_id", [build_id])
+	count = cursor.rowcount
+	transaction.commit_unless_managed()
+	cache.delete(cache_key(build_id))
+	return count
+
+
+def _read_family_summary(build_id):
+	cursor = connection.cursor()
+	cursor.execute("SELECT " + ",".join(SUMMARY_KEYS) +
+	  " FROM " + SUMMARY + " WHERE family_build_id = %s " +
+	  "ORDER BY preorder_code", [build_id])
+	return [dict(zip(SUMMARY_KEYS, row)) for row in cursor.fetchall()]
+
+
+def family_summary(build_id):
+	"""
+	Return the families of a build as a list of dicts keyed by SUMMARY_KEYS.
+
+	The loaders build the summary of a new build; builds loaded before the
+	summary table existed need manage.py build_family_summary.  Until
+	then they have no families, and that is not cached.
+	"""
+	key = cache_key(build_id)
+	families = cache.get(key)
+	if families is not None:
+		return families
+
+	families = _read_family_summary(build_id)
+	if families:
+		cache.set(key, families, CACHE_TIMEOUT)
+	return families
@@ -0,0 +1,239 @@
+"""
+Synthetic navigator data, for benchmarks.
+
+generate() adds one family tree, its builds and their sequences to the
+database, in the shapes the loaders write:
+
+    family tree     a root, one node per CLAN_SIZE families, the families
+    builds          each build has every sequence in one family; family
+                    sizes are skewed (a few families hold most members)
+                    and each build moves REASSIGNED of them elsewhere
+    sequences       protein sequences with packed residues, one or more
+                    SequenceInformation rows (UniProt-like accessions and
+                    descriptions) each
+    features        a share of the sequences get a gene model: a MODEL
+                    feature and its EXON and CDS features, located and
+                    tagged like the gene structures of the Perl site
+
+Rows are written BATCH_SIZE sequences at a time with insert_rows(), and
+the derived tables (family summaries, feature tracks, the search index)
+are built at the end, so the site can be browsed and load-tested right
+away.  The same seed gives the same data.
+"""
+
+import datetime
+import random
+
+from django.db import connection, transaction
+
+from navigator import caching, search
+from navigator.loader import allocate_ids, insert_rows, seguid
+from navigator.models import *
+from navigator.residues import RESIDUE_COLUMNS, residue_rows
+from navigator.summary import build_family_summary
+from navigator.tracks import build_tracks
+from navigator.tree import number_tree
+
+BATCH_SIZE = 5000
+CLAN_SIZE = 10
+REASSIGNED = 0.05
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+WORDS = ['protein', 'putative', 'family', 'domain', 'hydrolase', 'kinase',
+  'transferase', 'glycosyl', 'synthase', 'xylan', 'cellulose', 'pectin',
+  'methylesterase', 'expansin', 'lyase', 'peroxidase', 'laccase',
+  'arabinosyl', 'galacturonosyl', 'xyloglucan', 'endotransglucosylase',
+  'mannan', 'callose', 'chitinase', 'reductase', 'oxidase', 'binding',
+  'receptor', 'like', 'subunit', 'alpha', 'beta', 'uncharacterized']
+
+SPECIES = [('Arabidopsis', 'thaliana'), ('Oryza', 'sativa'),
+  ('Populus', 'trichocarpa'), ('Zea', 'mays'), ('Vitis', 'vinifera'),
+  ('Sorghum', 'bicolor'), ('Medicago', 'truncatula'),
+  ('Physcomitrella', 'patens'), ('Selaginella', 'moellendorffii'),
+  ('Chlamydomonas', 'reinhardtii')]
+
+
+def _word(rng):
+	# Word i is drawn with probability proportional to 1 / (i + 1)
+	return WORDS[min(int(rng.paretovariate(1.0)) - 1, len(WORDS) - 1)]
+
+
+def _residues(rng, pool, i, length):
+	"""A protein sequence, unique through the digits of i it starts with."""
+	stamp = []
+	while True:
+		i, digit = divmod(i, len(AMINO_ACIDS))
+		stamp.append(AMINO_ACIDS[digit])
+		if not i:
+			break
+	start = rng.randint(0, len(pool) - length)
+	return 'M' + ''.join(stamp) + 'W' + pool[start:start + length]
+
+
+def _family(rng, families):
+	# Skewed: family k holds about 1 / (k + 1) of the members
+	return min(int(rng.paretovariate(0.8)), families) - 1
+
+
+def _gene_model(rng, length):
+	"""[(primary_tag, start, end)]: the model, its exons and its CDS."""
+	span = length
+	cuts = sorted(rng.sample(xrange(2, span), 2 * rng.randint(1, 3)))
+	parts = [('MODEL', 1, span)]
+	for start, end in zip([1] + cuts[1::2], cuts[0::2] + [span]):
+		parts.append(('EXON', start, end))
+	parts.append(('CDS', min(span, 1 + rng.randint(0, 30)), span))
+	return parts
+
+
+def _tree(cursor, families, name):
+	"""Add a family tree; returns (tree id, instance node ids of families)."""
+	tree_id = allocate_ids(cursor, FamilyTree, 1)[0]
+	insert_rows(cursor, FamilyTree, ['family_tree_id', 'family_tree_name',
+	  'family_tree_description'], [(tree_id, name, 'synthetic data')])
+
+	clans = (families + CLAN_SIZE - 1) // CLAN_SIZE
+	names = [('Synthetic', 'SYN')] + \
+	  [('Clan %d' % c, 'C%d' % c) for c in range(clans)] + \
+	  [('Synthetic family %d' % f, 'SF%d' % f) for f in range(families)]
+	node_ids = allocate_ids(cursor, FamilyTreeNode, len(names))
+	insert_rows(cursor, FamilyTreeNode, ['family_tree_node_id',
+	  'family_tree_node_name', 'family_tree_node_abrev'],
+	  [(i,) + n for i, n in zip(node_ids, names)])
+
+	instance_ids = allocate_ids(cursor, FamilyTreeInstance, len(names))
+	root = instance_ids[0]
+	parents = [root] + [root] * clans + \
+	  [instance_ids[1 + f // CLAN_SIZE] for f in range(families)]
+	ranks = [1] + range(1, clans + 1) + \
+	  [f % CLAN_SIZE + 1 for f in range(families)]
+	insert_rows(cursor, FamilyTreeInstance, ['instance_node_id',
+	  'parent_node_id', 'family_tree_node_id', 'rank', 'family_tree_id'],
+	  zip(instance_ids, parents, node_ids, ranks, [tree_id] * len(names)))
+	return tree_id, instance_ids[1 + clans:]
+
+
+@transaction.commit_manually
+def generate(builds=2, families=200, sequences=100000, accessions=1,
+             features=0.2, seed=0, batch_size=BATCH_SIZE):
+	"""
+	Add a synthetic family tree with builds of sequences (see the module
+	docstring).  accessions is the number of SequenceInformation rows of
+	a sequence and features the share of sequences with a gene model.
+	Returns counts of the rows added, by table.
+	"""
+	try:
+		return _generate(builds, families, sequences, accessions, features,
+		  seed, batch_size)
+	except:
+		transaction.rollback()
+		raise
+
+
+def _generate(builds, families, sequences, accessions, features, seed,
+              batch_size):
+	rng = random.Random(seed)
+	pool = ''.join(rng.choice(AMINO_ACIDS) for i in xrange(100000))
+	cursor = connection.cursor()
+	counts = {}
+
+	def add(model, columns, rows):
+		insert_rows(cursor, model, columns, rows)
+		table = model._meta.db_table
+		counts[table] = counts.get(table, 0) + len(rows)
+
+	tree_id, family_ids = _tree(cursor, families, 'Synthetic %d' % seed)
+	number_tree(tree_id)
+
+	method_id = allocate_ids(cursor, FamilyBuildMethod, 1)[0]
+	add(FamilyBuildMethod, ['family_build_method_id',
+	  'family_build_method_name', 'family_build_method_desc'],
+	  [(method_id, 'synthetic', 'benchmark data, seed %d' % seed)])
+	build_ids = allocate_ids(cursor, FamilyBuild, builds)
+	now = datetime.datetime.now()
+	add(FamilyBuild, ['family_build_id', 'famaily_build_name',
+	  'family_build_desc', 'family_build_method_id',
+	  'family_build_timestamp'],
+	  [(b, 'Synthetic build %d' % (k + 1), '', method_id,
+	    now - datetime.timedelta(days=30 * (builds - k)))
+	   for k, b in enumerate(build_ids)])
+
+	genome_id = allocate_ids(cursor, Genome, 1)[0]
+	add(Genome, ['genome_id', 'genome_name'], [(genome_id, 'Synthetic')])
+	db_id = allocate_ids(cursor, Db, 1)[0]
+	add(Db, ['db_id', 'genome_id', 'db_name', 'db_type'],
+	  [(db_id, genome_id, 'Synthetic', 'protein')])
+	species_ids = allocate_ids(cursor, Species, len(SPECIES))
+	add(Species, ['species_id', 'genus', 'species', 'sub_species',
+	  'common_name'], [(i, g, s, '', '') for i, (g, s) in
+	  zip(species_ids, SPECIES)])
+	transaction.commit()
+
+	featured = []
+	for first in xrange(0, sequences, batch_size):
+		count = min(batch_size, sequences - first)
+		ids = allocate_ids(cursor, Sequence, count)
+		seqs = [_residues(rng, pool, first + k, rng.randint(80, 900))
+		  for k in xrange(count)]
+		add(Sequence, ['sequence_id', 'seguid', 'alphabet', 'length',
+		  'sequence'], [(i, seguid(s), 'protein', len(s), '')
+		  for i, s in zip(ids, seqs)])
+		add(SequenceResidues, RESIDUE_COLUMNS,
+		  [residue_rows(i, s, 'protein') for i, s in zip(ids, seqs)])
+
+		info = []
+		for k, i in enumerate(ids):
+			for a in range(accessions):
+				n = (first + k) * accessions + a
+				name = '%s%d' % (rng.choice(WORDS)[:3].upper(), n % 9999)
+				info.append((i, 'S%07d' % n, db_id, rng.choice(species_ids),
+				  '%s_SYNTH' % name, ' '.join(_word(rng) for w in
+				  range(rng.randint(2, 8))).capitalize(), name))
+		add(SequenceInformation, ['sequence_information_id', 'sequence_id',
+		  'accession', 'db_id', 'species_id', 'display', 'description',
+		  'gene_name', 'fullname', 'alt_fullname', 'symbols'],
+		  [(j,) + row + ('', '', '') for j, row in
+		   zip(allocate_ids(cursor, SequenceInformation, len(info)), info)])
+
+		members = []
+		family = [_family(rng, families) for i in ids]
+		for b in build_ids:
+			for k, i in enumerate(ids):
+				if b != build_ids[0] and rng.random() < REASSIGNED:
+					family[k] = _family(rng, families)
+				members.append((b, family_ids[family[k]], i))
+		add(FamilyMember, ['family_member_id', 'family_build_id',
+		  'instance_node_id', 'sequence_id'], [(j,) + row for j, row in
+		  zip(allocate_ids(cursor, FamilyMember, len(members)), members)])
+
+		parts = []
+		for i, s in zip(ids, seqs):
+			if rng.random() < features:
+				featured.append(i)
+				parts.extend((i, rank) + part for rank, part in
+				  enumerate(_gene_model(rng, len(s)), 1))
+		feature_ids = allocate_ids(cursor, SequenceFeature, len(parts))
+		add(SequenceFeature, ['sequence_feature_id', 'sequence_id', 'rank',
+		  'primary_tag'], [(f, p[0], p[1], p[2]) for f, p in
+		  zip(feature_ids, parts)])
+		add(SequenceLocation, ['sequence_location_id', 'sequence_feature_id',
+		  'rank', 'start_pos', 'end_pos', 'strand'],
+		  [(j, f, 1, p[3], p[4], 1) for j, f, p in zip(allocate_ids(cursor,
+		    SequenceLocation, len(parts)), feature_ids, parts)])
+		# MODEL features are named by feat_name, their parts by model
+		tags = [(f, p[2] == 'MODEL' and 'feat_name' or 'model',
+		  'model%d' % p[0]) for f, p in zip(feature_ids, parts)]
+		add(SequenceTag, ['sequence_tag_id', 'sequence_feature_id', 'name',
+		  'value'], [(j,) + t for j, t in
+		  zip(allocate_ids(cursor, SequenceTag, len(tags)), tags)])
+		transaction.commit()
+
+	for b in build_ids:
+		build_family_summary(b)
+	counts[FeatureTrack._meta.db_table] = build_tracks(featured)
+	transaction.commit()
+	search.update_index()
+	transaction.commit()
+	caching.builds_changed()
+	return counts
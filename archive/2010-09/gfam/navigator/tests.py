@@ -5,7 +5,42 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import BaseHTTPServer
+import cgi
+import datetime
+import gzip
+import logging
+import os
+import random
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import thread
+import threading
+import time
+from collections import deque
+
+import numpy
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection, reset_queries, transaction
+from django.http import Http404, HttpRequest, HttpResponse, QueryDict
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client
+from django.utils import simplejson
+
+from navigator import annotate, caching, export, genestructure, loader, queries, residues, search, similar, streaming, summary, tracks, tree, views
+from navigator.models import *
+
+import settings_profiling
+from gfam2 import alignments, catalog, profiling, trees
+from gfam2 import views as gfam2_views
+from gfam2.views import window_range
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +49,1144 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+
+class Row(tuple):
+    """A result row that keeps count of how many rows are alive at once."""
+    live = 0
+    peak = 0
+
+    def __new__(cls, values):
+        Row.live += 1
+        Row.peak = max(Row.peak, Row.live)
+        return tuple.__new__(cls, values)
+
+    def __del__(self):
+        Row.live -= 1
+
+class FakeFastaCursor(object):
+    """Serves `count` fasta_line rows through fetchmany() only."""
+    def __init__(self, count):
+        self.remaining = count
+        self.closed = False
+
+    def execute(self, sql, params):
+        pass
+
+    def fetchmany(self, size):
+        n = min(size, self.remaining)
+        self.remaining -= n
+        return [Row((">seq%d\nMKVLAAGIVG\n" % i,)) for i in range(n)]
+
+    def fetchall(self):
+        raise AssertionError("streaming export must not call fetchall()")
+
+    def close(self):
+        self.closed = True
+
+class StreamingFastaTest(TestCase):
+    def stream(self, count, fetch_size=100):
+        Row.live = Row.peak = 0
+        cursor = FakeFastaCursor(count)
+        rows = streaming.iter_rows(cursor, "SELECT", [], fetch_size)
+        size = 0
+        for chunk in streaming.iter_chunks(row[0] for row in rows):
+            size += len(chunk)
+        self.failUnless(cursor.closed)
+        return size, Row.peak
+
+    def test_peak_rows_flat_as_family_grows(self):
+        small_size, small_peak = self.stream(1000)
+        large_size, large_peak = self.stream(100000)
+        self.failUnless(large_size > 90 * small_size)
+        self.failUnless(small_peak <= 2 * 100)
+        self.failUnlessEqual(small_peak, large_peak)
+
+    def test_gzip_round_trip(self):
+        lines = [">seq%d\nMKVLAAGIVG\n" % i for i in range(5000)]
+        data = ''.join(streaming.iter_gzip(
+          streaming.iter_chunks(lines, chunk_size=1024)))
+        f = gzip.GzipFile(fileobj=StringIO.StringIO(data))
+        self.failUnlessEqual(f.read(), ''.join(lines))
+
+class QueryCountTestCase(TestCase):
+    def count_queries(self, func, *args):
+        """Call func(*args) and return the number of SQL queries it ran."""
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        reset_queries()
+        try:
+            func(*args)
+            return len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+
+    def assertQueries(self, expected, func, *args):
+        self.failUnlessEqual(self.count_queries(func, *args), expected)
+
+class ViewQueryCountTest(QueryCountTestCase):
+    def setUp(self):
+        caching._builds.clear()
+        caching.builds_changed()
+        now = datetime.datetime(2010, 9, 1)
+        for method_id in (1, 2):
+            FamilyBuildMethod.objects.create(family_build_method_id=method_id,
+              family_build_method_name="method %d" % method_id,
+              family_build_method_desc="")
+        for build_id in range(1, 21):
+            FamilyBuild.objects.create(family_build_id=build_id,
+              famaily_build_name="build %d" % build_id, family_build_desc="",
+              family_build_method_id=build_id % 2 + 1,
+              family_build_timestamp=now)
+
+        genome = Genome.objects.create(genome_id=1, genome_name="TAIR9")
+        db = Db.objects.create(db_id=1, genome=genome, db_name="TAIR",
+          db_type="protein")
+        species = Species.objects.create(species_id=1, genus="Arabidopsis",
+          species="thaliana", sub_species="", common_name="")
+        tree = FamilyTree.objects.create(family_tree_id=1,
+          family_tree_name="CWN", family_tree_description="")
+        node = FamilyTreeNode.objects.create(family_tree_node_id=1,
+          family_tree_node_name="Sugar 1-kinases", family_tree_node_abrev="S1K")
+        self.instance = FamilyTreeInstance.objects.create(node_id=1,
+          parent_node_id=1, family_tree_node=node, rank=1, family_tree=tree)
+        for i in range(1, 31):
+            seq = Sequence.objects.create(sequence_id=i, seguid="seguid%d" % i,
+              alphabet="protein", length=100 + i, sequence="")
+            SequenceInformation.objects.create(sequence_information_id=i,
+              sequence=seq, accession="At1g%05d" % i, db=db, species=species,
+              display="", description="protein %d" % i, gene_name="",
+              fullname="", alt_fullname="", symbols="")
+            FamilyMember.objects.create(family_member_id=i, family_build_id=1,
+              node=self.instance, sequence=seq)
+
+    def test_builds(self):
+        caching.site_stamp()
+        self.assertQueries(1, views.builds, HttpRequest())
+        rows = queries.builds()
+        self.failUnlessEqual(len(rows), 20)
+        self.failUnlessEqual(rows[0]['method'], "method 2")
+
+    def test_method(self):
+        caching.site_stamp()
+        self.assertQueries(1, views.method, HttpRequest(), "1")
+        self.failUnlessEqual(queries.method(1)['builds'], range(2, 21, 2))
+
+    def test_method_without_builds(self):
+        FamilyBuildMethod.objects.create(family_build_method_id=3,
+          family_build_method_name="unused", family_build_method_desc="")
+        self.assertQueries(2, queries.method, 3)
+        self.failUnlessEqual(queries.method(3),
+          {'name': "unused", 'builds': []})
+
+    def test_families_cached(self):
+        cache.set(summary.cache_key(1), [{'instance_node_id': 1,
+          'preorder_code': "A", 'family_tree_node_abrev': "S1K",
+          'family_tree_node_name': "Sugar 1-kinases", 'member_count': 30}])
+        caching.build_stamp(1)
+        self.assertQueries(0, views.families, HttpRequest(), "1")
+
+    def test_families(self):
+        summary.build_family_summary(1)
+        cache.delete(summary.cache_key(1))
+        caching.build_stamp(1)
+        self.assertQueries(1, views.families, HttpRequest(), "1")
+        self.assertQueries(0, views.families, HttpRequest(), "1")
+
+    def test_family_fasta(self):
+        caching.build_stamp(1)
+        request = HttpRequest()
+        request.method = 'GET'
+        # The member rows, then the packed and the legacy residues of the
+        # one batch of members
+        self.assertQueries(3, lambda: views.family_fasta(request, "1",
+          "1").content)
+
+    def test_conditional_get(self):
+        request = HttpRequest()
+        request.method = 'GET'
+        response = views.family_fasta(request, "1", "1")
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnlessEqual(response['ETag'], '"b1-20100901000000-%d"' %
+          caching.PAGE_VERSION)
+        self.failUnless('max-age=%d' % caching.BUILD_MAX_AGE in
+          response['Cache-Control'])
+
+        request.META['HTTP_IF_NONE_MATCH'] = response['ETag']
+        self.assertQueries(0, views.family_fasta, request, "1", "1")
+        self.failUnlessEqual(views.family_fasta(request, "1", "1").status_code,
+          304)
+        request.META['HTTP_IF_NONE_MATCH'] = '"b1-0-0"'
+        self.failUnlessEqual(views.family_fasta(request, "1", "1").status_code,
+          200)
+
+        # The gzipped body is another entity with its own ETag
+        request = HttpRequest()
+        request.method = 'GET'
+        request.META['HTTP_ACCEPT_ENCODING'] = 'gzip, deflate'
+        response = views.family_fasta(request, "1", "1")
+        self.failUnlessEqual(response['Content-Encoding'], 'gzip')
+        self.failUnlessEqual(response['ETag'],
+          '"b1-20100901000000-%d-gzip"' % caching.PAGE_VERSION)
+        request.META['HTTP_IF_NONE_MATCH'] = response['ETag']
+        self.failUnlessEqual(views.family_fasta(request, "1", "1").status_code,
+          304)
+        request.META['HTTP_IF_NONE_MATCH'] = '"b1-20100901000000-%d"' % \
+          caching.PAGE_VERSION
+        self.failUnlessEqual(views.family_fasta(request, "1", "1").status_code,
+          200)
+
+        request = HttpRequest()
+        request.method = 'GET'
+        request.META['HTTP_IF_NONE_MATCH'] = views.builds(request)['ETag']
+        self.assertQueries(0, views.builds, request)
+        caching.builds_changed()
+        FamilyBuild.objects.filter(pk=20).delete()
+        self.failUnlessEqual(views.builds(request).status_code, 200)
+
+class FamilyTreeTest(QueryCountTestCase):
+    def setUp(self):
+        family_tree = FamilyTree.objects.create(family_tree_id=1,
+          family_tree_name="CWN", family_tree_description="")
+        # 10 -+- 11 --- 13
+        #     +- 12
+        shape = [(10, 10, 1), (11, 10, 1), (12, 10, 2), (13, 11, 1)]
+        for node_id, parent_id, rank in shape:
+            node = FamilyTreeNode.objects.create(family_tree_node_id=node_id,
+              family_tree_node_name="node %d" % node_id,
+              family_tree_node_abrev="N%d" % node_id)
+            FamilyTreeInstance.objects.create(node_id=node_id,
+              parent_node_id=parent_id, family_tree_node=node, rank=rank,
+              family_tree=family_tree)
+        self.failUnlessEqual(tree.number_tree(1), 4)
+
+    def test_preorder_columns(self):
+        codes = dict(FamilyTreeInstance.objects.values_list('node_id',
+          'preorder_code'))
+        self.failUnlessEqual(codes, {10: "AAB", 11: "AABAAB", 12: "AABAAC",
+          13: "AABAABAAB"})
+        root = FamilyTreeInstance.objects.get(node_id=10)
+        self.failUnlessEqual((root.preorder_left, root.preorder_right), (1, 8))
+        # One read and one batch of updates
+        self.assertQueries(2, tree.number_tree, 1)
+
+    def test_rank_codes_sort_in_preorder(self):
+        codes = [tree.rank_code(rank) for rank in (0, 1, 9, 26, 27, 700)]
+        self.failUnlessEqual(codes, ["AAA", "AAB", "AAJ", "ABA", "ABB", "BAY"])
+        self.failUnlessEqual(sorted(codes), codes)
+        self.failUnlessRaises(ValueError, tree.rank_code, 26 ** 3)
+
+    def test_subtree(self):
+        self.assertQueries(1, tree.subtree, 11)
+        self.failUnlessEqual([n.node_id for n in tree.subtree(11)], [11, 13])
+        self.failUnlessEqual([n.node_id for n in tree.subtree(10)],
+          [10, 11, 13, 12])
+        self.failUnlessEqual(tree.subtree(13)[0].family_tree_node_abrev, "N13")
+
+    def test_ancestors(self):
+        self.assertQueries(1, tree.ancestors, 13)
+        self.failUnlessEqual([n.node_id for n in tree.ancestors(13)], [10, 11])
+        self.failUnlessEqual(tree.ancestors(10), [])
+
+    def test_subtree_with_members(self):
+        genome = Genome.objects.create(genome_id=1, genome_name="TAIR9")
+        db = Db.objects.create(db_id=1, genome=genome, db_name="TAIR",
+          db_type="protein")
+        species = Species.objects.create(species_id=1, genus="Arabidopsis",
+          species="thaliana", sub_species="", common_name="")
+        FamilyBuildMethod.objects.create(family_build_method_id=1,
+          family_build_method_name="hmmsearch", family_build_method_desc="")
+        FamilyBuild.objects.create(family_build_id=1, famaily_build_name="",
+          family_build_desc="", family_build_method_id=1,
+          family_build_timestamp=datetime.datetime(2010, 9, 1))
+        for i, node_id in enumerate([11, 12, 13, 13]):
+            seq = Sequence.objects.create(sequence_id=i, seguid="s%d" % i,
+              alphabet="protein", length=10, sequence="")
+            SequenceInformation.objects.create(sequence_information_id=i,
+              sequence=seq, accession="At%d" % i, db=db, species=species,
+              display="", description="", gene_name="", fullname="",
+              alt_fullname="", symbols="")
+            FamilyMember.objects.create(family_member_id=i, family_build_id=1,
+              node_id=node_id, sequence=seq)
+
+        self.assertQueries(2, tree.subtree_with_members, 1, 11)
+        nodes = tree.subtree_with_members(1, 11)
+        self.failUnlessEqual([[m['accession'] for m in n.members]
+          for n in nodes], [["At0"], ["At2", "At3"]])
+
+class GeneStructureTest(TestCase):
+    locations = [(1, 'MODEL', 100, 1500, 1), (2, 'EXON', 100, 400, 1),
+                 (2, 'EXON', 600, 1500, 1), (3, 'CDS', 240, 1300, 1)]
+    tags = {1: {'feat_name': 'm1'}, 2: {'model': 'm1'}, 3: {'model': 'm1'}}
+
+    def test_python_renderer(self):
+        self.failUnless(genestructure.can_render(self.locations))
+        data = genestructure.render_png(1781, self.locations, self.tags)
+        self.failUnless(data.startswith('\x89PNG\r\n\x1a\n'))
+        self.failUnlessEqual(genestructure.gene_models(self.locations,
+          self.tags)[0][0], 'm1')
+
+    def test_positions_outside_the_sequence(self):
+        inside = genestructure.render_png(1000, [(1, 'MODEL', 100, 1000, 1)],
+          {})
+        self.failUnlessEqual(genestructure.render_png(1000,
+          [(1, 'MODEL', 100, 1500, 1)], {}), inside)
+        for length, start, end in [(1000, -50, 0), (0, 1, 10),
+                                   (None, 5, 3)]:
+            rows = [(1, 'MODEL', start, end, 1), (2, 'EXON', start, end, 1)]
+            self.failUnless(genestructure.render_png(length, rows, {})
+              .startswith('\x89PNG'))
+            self.failIf('width="-' in genestructure.render_svg(length, rows,
+              {}))
+
+    def test_unknown_features_go_to_perl(self):
+        self.failIf(genestructure.can_render([]))
+        self.failIf(genestructure.can_render(self.locations +
+          [(4, 'TRNA', 10, 90, 1)]))
+
+    def test_digest_follows_features(self):
+        rows = (1781, self.locations, self.tags)
+        moved = (1781, self.locations[:-1] + [(3, 'CDS', 250, 1300, 1)],
+          self.tags)
+        self.failIfEqual(genestructure.structure_digest(1, rows),
+          genestructure.structure_digest(1, moved))
+        self.failIfEqual(genestructure.structure_digest(1, rows),
+          genestructure.structure_digest(2, rows))
+
+class FeatureTrackTest(QueryCountTestCase):
+    def setUp(self):
+        for sequence_id in range(1, 201):
+            Sequence.objects.create(sequence_id=sequence_id,
+              seguid=str(sequence_id), alphabet="dna", length=1781,
+              sequence="")
+            for rank, (feature_id, tag, start, end, strand) in \
+              enumerate(GeneStructureTest.locations):
+                feature, created = SequenceFeature.objects.get_or_create(
+                  sequence_feature_id=sequence_id * 10 + feature_id,
+                  sequence_id=sequence_id, rank=feature_id, primary_tag=tag)
+                SequenceLocation.objects.create(sequence_location_id=
+                  sequence_id * 10 + rank, sequence_feature=feature,
+                  rank=rank, start_pos=start, end_pos=end, strand=strand)
+            for feature_id, tags in GeneStructureTest.tags.items():
+                for name, value in tags.items():
+                    SequenceTag.objects.create(sequence_feature_id=
+                      sequence_id * 10 + feature_id, name=name, value=value)
+
+    def test_track_matches_feature_rows(self):
+        rows = genestructure.structure_rows(7)
+        self.failUnlessEqual(tracks.build_tracks(), 200)
+        self.assertQueries(1, genestructure.structure_rows, 7)
+        self.failUnlessEqual(genestructure.structure_rows(7), rows)
+        self.failUnlessEqual(genestructure.structure_digest(7, rows),
+          genestructure.structure_digest(7,
+            genestructure.structure_rows(7)))
+
+    def test_domains_are_left_out(self):
+        rows = genestructure.structure_rows(7)
+        digest = genestructure.structure_digest(7, rows)
+        feature = SequenceFeature.objects.create(sequence_feature_id=79,
+          sequence_id=7, rank=4, primary_tag=annotate.PRIMARY_TAG)
+        SequenceLocation.objects.create(sequence_location_id=79,
+          sequence_feature=feature, rank=1, start_pos=10, end_pos=90,
+          strand=1)
+        SequenceTag.objects.create(sequence_feature=feature, name='family',
+          value='PF04616.9')
+        self.failUnlessEqual(genestructure.structure_rows(7), rows)
+        tracks.build_tracks([7])
+        self.failUnlessEqual(genestructure.structure_rows(7), rows)
+        self.failUnlessEqual(genestructure.structure_digest(7,
+          genestructure.structure_rows(7)), digest)
+        self.failUnless(genestructure.can_render(rows[1]))
+        self.failUnlessEqual(genestructure.render_svg(*tracks.decode_track(
+          tracks.get_tracks([7])[7])), genestructure.render_svg(*rows))
+
+    def test_side_by_side_in_one_query(self):
+        tracks.build_tracks()
+        request = HttpRequest()
+        request.GET['ids'] = ",".join(str(i) for i in range(1, 201))
+        self.assertQueries(1, views.sidebyside, request)
+        self.failUnlessEqual(views.sidebyside(request).content.count("<svg"),
+          200)
+
+    def test_batch_endpoint(self):
+        tracks.build_tracks([1, 2])
+        request = HttpRequest()
+        request.GET['ids'] = "1,2,3"
+        data = simplejson.loads(views.feature_tracks(request).content)
+        self.failUnlessEqual(sorted(data), ["1", "2"])
+        self.failUnlessEqual(data["1"][0], 1781)
+        request.GET['ids'] = ",".join(["1"] * (tracks.MAX_TRACKS + 1))
+        self.failUnlessEqual(views.feature_tracks(request).status_code, 400)
+
+class LoaderFixture(object):
+    def setUp(self):
+        family_tree = FamilyTree.objects.create(family_tree_id=1,
+          family_tree_name="CWN", family_tree_description="")
+        node = FamilyTreeNode.objects.create(family_tree_node_id=1,
+          family_tree_node_name="Glycoside Hydrolase Family 43",
+          family_tree_node_abrev="GH43")
+        FamilyTreeInstance.objects.create(node_id=1, parent_node_id=1,
+          family_tree_node=node, rank=1, family_tree=family_tree)
+        FamilyBuildMethod.objects.create(family_build_method_id=1,
+          family_build_method_name="hmmsearch", family_build_method_desc="")
+        genome = Genome.objects.create(genome_id=1, genome_name="UniProt")
+        Db.objects.create(db_id=1, genome=genome, db_name="UniProt",
+          db_type="protein")
+
+    def hits(self, count):
+        lines = ["# target name accession query name ...\n"]
+        for i in range(count):
+            lines.append("Q%05d - MSA.MAFFT.aln - %.1e 170.3 0.1 1.5e-50 "
+              "170.0 0.1 1.0 1 0 0 1 1 1 1 X%d_ARATH Protein %d\n"
+              % (i, 10.0 ** -(i % 50), i, i))
+        return loader.read_tblout(lines)
+
+    def fasta(self, count):
+        for i in range(count + 10):
+            # Every other record shares its sequence with the one before
+            yield ("Q%05d X%d_ARATH Protein %d OS=Arabidopsis thaliana "
+              "GN=XYL%d PE=1 SV=1" % (i, i, i, i), "MKV" + "A" * (i // 2))
+
+    def load(self, count):
+        return loader.load_hits(self.hits(count), self.fasta(count),
+          node_id=1, method_id=1, db_id=1, name="GH43 refresh")
+
+class LoaderTest(LoaderFixture, QueryCountTestCase):
+    def test_read_tblout(self):
+        hits = self.hits(100)
+        self.failUnlessEqual(len(hits), 100)
+        self.failUnlessEqual(hits["Q00001"][2], "X1_ARATH Protein 1")
+        self.failUnlessEqual(len(loader.read_tblout(self.hitlines(),
+          max_evalue=1e-10)), 11)
+
+    def hitlines(self):
+        return ["Q%05d - MSA.MAFFT.aln - 1e-%d 1 1 1 1 1 1 1 0 0 1 1 1 1 d\n"
+          % (i, i) for i in range(1, 21)]
+
+    def test_load(self):
+        build_id, counts = self.load(100)
+        self.failUnlessEqual(counts, {'sequences': 50, 'information': 100,
+          'members': 50, 'species': 1})
+        self.failUnlessEqual(Sequence.objects.count(), 50)
+        info = SequenceInformation.objects.get(accession="Q00003")
+        self.failUnlessEqual((info.display, info.gene_name, info.species.genus),
+          ("X3_ARATH", "XYL3", "Arabidopsis"))
+        self.failUnlessEqual(info.sequence.seguid,
+          loader.seguid("MKV" + "A"))
+        self.failUnlessEqual(summary.family_summary(build_id)[0]['member_count'],
+          50)
+
+    def test_reload_reuses_sequences(self):
+        self.load(100)
+        build_id, counts = self.load(120)
+        self.failUnlessEqual(counts, {'sequences': 10, 'information': 20,
+          'members': 60, 'species': 0})
+        self.failUnlessEqual(FamilyMember.objects.filter(
+          family_build=build_id).count(), 60)
+
+    def test_delta(self):
+        previous, counts = self.load(100)
+        # Q00010/Q00011 and Q00030/Q00031 share a sequence, so do
+        # Q00020/Q00021 but Q00021 stays in the release
+        dropped = ["Q00010", "Q00011", "Q00020", "Q00030", "Q00031"]
+        hits = loader.read_tblout(["%s - GH43 - 1e-30 1 1 1 1 1 1 1 0 0 1 1 "
+          "1 1 d\n" % a for a in ("Q00030", "Q00200")])
+        fasta = [("Q00030 X30_ARATH Protein 30 OS=Arabidopsis thaliana",
+                  "MKVNEW"),
+                 ("Q00031 X31_ARATH Protein 31 OS=Arabidopsis thaliana",
+                  "MKVNEW"),
+                 ("Q00200 X200_ARATH Protein 200 OS=Arabidopsis thaliana",
+                  "MKVADDED")]
+        build_id, counts = loader.load_delta(previous, {1: hits}, fasta,
+          dropped, method_id=1, db_id=1)
+        self.failUnlessEqual((counts['inherited'], counts['dropped'],
+          counts['members'], counts['sequences']), (48, 2, 2, 2))
+        members = set(FamilyMember.objects.filter(family_build=build_id)
+          .values_list('sequence__seguid', flat=True))
+        self.failUnlessEqual(len(members), 50)
+        self.failUnless(loader.seguid("MKV" + "A" * 10) in members)
+        self.failIf(loader.seguid("MKV" + "A" * 5) in members)
+        self.failIf(loader.seguid("MKV" + "A" * 15) in members)
+        self.failUnless(loader.seguid("MKVNEW") in members)
+        self.failUnlessEqual(FamilyMember.objects.filter(
+          family_build=previous).count(), 50)
+
+    def test_queries_do_not_grow_with_hits(self):
+        few = self.count_queries(self.load, 20)
+        many = self.count_queries(self.load, 2000)
+        # Only multi-row statements split by the parameter limit are added
+        self.failUnless(many - few < 2000 / 50, (few, many))
+
+class ResiduesTest(LoaderFixture, QueryCountTestCase):
+    def test_round_trip(self):
+        for sequence, alphabet, encoding in [
+          ("ACGTNNNNACGTTGCAacgtA", "dna", "dna2"),
+          ("MKVLAUAGIVGXXBZ*", "protein", "protein5"),
+          ("MKV" + "A" * 37, "protein", "protein5"),
+          ("ACGU", "rna", "dna2"),
+          ("anything", None, "raw")]:
+            for n in range(len(sequence) + 1):
+                packed = residues.encode(sequence[:n], alphabet)
+                self.failUnlessEqual(packed[0], encoding)
+                self.failUnlessEqual(residues.decode(packed[0], packed[1],
+                  packed[2], n), sequence[:n])
+        # 2 and 5 bits per residue
+        self.failUnlessEqual(len(residues.encode("A" * 400, "dna")[1]), 100)
+        self.failUnlessEqual(len(residues.encode("A" * 400, "protein")[1]),
+          250)
+
+    def test_range_reads(self):
+        sequence = "MKVLAUAGIVG" * 30 + "xx" + "WYQ" * 20
+        Sequence.objects.create(sequence_id=7, seguid="x", alphabet="protein",
+          length=len(sequence), sequence="")
+        residues.store(7, sequence, "protein")
+        seq = Sequence.objects.get(pk=7)
+        self.failUnlessEqual(self.count_queries(len, seq.residues), 0)
+        for start, end in [(0, 1), (5, 13), (329, 335), (300, 10000)]:
+            self.failUnlessEqual(seq.residues[start:end],
+              sequence[start:end])
+        self.failUnlessEqual(seq.residues.window(100, 110, flank=2),
+          sequence[97:112])
+        self.failUnlessEqual(str(seq.residues), sequence)
+
+    def test_loaded_sequences_are_packed(self):
+        build_id, counts = self.load(20)
+        info = SequenceInformation.objects.get(accession="Q00009")
+        self.failUnlessEqual(info.sequence.sequence, "")
+        self.failUnlessEqual(str(info.sequence.residues), "MKV" + "A" * 4)
+
+        request = HttpRequest()
+        response = views.family_fasta(request, str(build_id), "1")
+        fasta = "".join(response)
+        self.failUnless(">Q00009 X9_ARATH Protein 9\nMKVAAAA\n" in fasta)
+        self.failUnlessEqual(fasta.count(">"), 20)
+
+class ExportTest(LoaderFixture, TestCase):
+    def setUp(self):
+        LoaderFixture.setUp(self)
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_incremental_export(self):
+        build_id, counts = self.load(20)
+        counts = export.export_build(build_id, self.root, processes=1)
+        self.failUnlessEqual((counts['written'], counts['unchanged']), (3, 0))
+        fasta = os.path.join(self.root, "b%d/family/1.fasta" % build_id)
+        self.failUnlessEqual(open(fasta).read(),
+          "".join(views.family_fasta(HttpRequest(), str(build_id), "1")))
+        manifest = simplejson.load(open(os.path.join(self.root,
+          "b%d/index.json" % build_id)))
+        self.failUnlessEqual(sorted(manifest['files']), ["b%d/families" %
+          build_id, "b%d/family/1.fasta" % build_id, "index.html"])
+
+        counts = export.export_build(build_id, self.root, processes=1)
+        self.failUnlessEqual((counts['written'], counts['unchanged']), (0, 3))
+        os.remove(fasta)
+        counts = export.export_build(build_id, self.root, processes=1)
+        self.failUnlessEqual((counts['written'], counts['unchanged']), (1, 2))
+
+        # A corrupt index is as good as none
+        open(os.path.join(self.root, "b%d/index.json" % build_id),
+          "w").write('{"files": {"b')
+        counts = export.export_build(build_id, self.root, processes=1)
+        self.failUnlessEqual((counts['written'], counts['unchanged']), (3, 0))
+
+    def test_image_errors_are_counted(self):
+        build_id, counts = self.load(20)
+        def cached_png(sequence_id):
+            if sequence_id == 2:
+                raise OSError("disk full")
+            raise genestructure.RenderError("no features")
+        old = export.structure_sequences, genestructure.cached_png
+        export.structure_sequences = lambda build_id: [1, 2]
+        genestructure.cached_png = cached_png
+        try:
+            counts = export.export_build(build_id, self.root, processes=1)
+        finally:
+            export.structure_sequences, genestructure.cached_png = old
+        self.failUnlessEqual((counts['written'], counts['failed']), (3, 2))
+        self.failUnlessEqual(counts['errors'], [
+          "gene-structure/1.png: RenderError: no features",
+          "gene-structure/2.png: OSError: disk full"])
+
+class SearchTest(LoaderFixture, TestCase):
+    def setUp(self):
+        LoaderFixture.setUp(self)
+        self.old_path = search.INDEX_PATH
+        search.INDEX_PATH = tempfile.mktemp(suffix='.sqlite')
+
+    def tearDown(self):
+        search.get_index().close()
+        search._local.index = None
+        os.remove(search.INDEX_PATH)
+        search.INDEX_PATH = self.old_path
+
+    def test_incremental_update(self):
+        self.load(100)
+        self.failUnlessEqual(search.update_index(), 100)
+        self.failUnlessEqual(search.update_index(), 0)
+        self.load(120)
+        self.failUnlessEqual(search.update_index(), 20)
+        self.failUnlessEqual(len(search.get_index()), 120)
+
+    def test_prefix_and_keywords(self):
+        self.load(100)
+        search.update_index()
+        index = search.get_index()
+        self.failUnlessEqual([r['accession'] for r in index.prefix("q0001")],
+          ["Q%05d" % i for i in range(10, 20)])
+        self.failUnlessEqual(index.keywords("protein 42")[0]['accession'],
+          "Q00042")
+        self.failUnlessEqual(len(index.keywords("protein")), search.LIMIT)
+        self.failUnlessEqual(index.keywords("x4*")[0]['display'][:2], "X4")
+        self.failUnlessEqual(index.search("Q00042")[0]['accession'],
+          "Q00042")
+
+    def test_search_page(self):
+        self.load(20)
+        search.update_index()
+        request = HttpRequest()
+        request.GET['q'] = "Q0001"
+        self.failUnless("X13_ARATH" in views.search_page(request).content)
+
+class StandInService(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers /search like refresh.blastservice, with one fixed hit, and
+    400 for any database but full.
+    """
+    queries = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        query = cgi.parse_qs(body)
+        StandInService.queries.append(query)
+        if query['db'] != ['full']:
+            data = simplejson.dumps({'error': 'No database %s' %
+              query['db'][0]})
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        data = simplejson.dumps({'cached': False, 'hits': [
+          {'accession': 'P12345', 'identity': 98.5, 'length': 40,
+           'evalue': 1e-20, 'bitscore': 80.0, 'title': 'P12345 XYL1_ARATH'}]})
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class SimilarTest(TestCase):
+    def setUp(self):
+        seq = Sequence.objects.create(sequence_id=1, seguid="x",
+          alphabet="protein", length=40, sequence="")
+        residues.store(1, "MKVL" * 10, "protein")
+        genome = Genome.objects.create(genome_id=1, genome_name="TAIR9")
+        db = Db.objects.create(db_id=1, genome=genome, db_name="TAIR",
+          db_type="protein")
+        species = Species.objects.create(species_id=1, genus="Arabidopsis",
+          species="thaliana", sub_species="", common_name="")
+        SequenceInformation.objects.create(sequence_information_id=1,
+          sequence=seq, accession="At1g01010", db=db, species=species,
+          display="", description="", gene_name="", fullname="",
+          alt_fullname="", symbols="")
+        self.old_url = similar.SERVICE_URL
+
+    def tearDown(self):
+        similar.SERVICE_URL = self.old_url
+
+    def test_similar_sequences(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandInService)
+        similar.SERVICE_URL = 'http://127.0.0.1:%d' % server.server_port
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        response = views.similar_sequences(HttpRequest(), "1")
+        thread.join()
+        server.server_close()
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnless("XYL1_ARATH" in response.content)
+        self.failUnlessEqual(StandInService.queries[-1],
+          {'db': ['full'], 'sequence': ["MKVL" * 10]})
+
+        # Nothing listens there any more
+        response = views.similar_sequences(HttpRequest(), "1")
+        self.failUnlessEqual(response.status_code, 503)
+
+    def test_unknown_database(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandInService)
+        similar.SERVICE_URL = 'http://127.0.0.1:%d' % server.server_port
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        request = HttpRequest()
+        request.GET = {'db': 'GH43'}
+        response = views.similar_sequences(request, "1")
+        thread.join()
+        server.server_close()
+        self.failUnlessEqual(response.status_code, 404)
+        self.failUnless("No database GH43" in response.content)
+
+    def test_by_accession(self):
+        request = HttpRequest()
+        request.GET = QueryDict("db=GH43")
+        response = views.similar_by_accession(request, "AT1G01010")
+        self.failUnlessEqual(response.status_code, 302)
+        self.failUnlessEqual(response['Location'],
+          "/sequence/1/similar?db=GH43")
+        self.failUnlessRaises(Http404, views.similar_by_accession,
+          HttpRequest(), "At9g")
+
+# Writes one domain per query of the FASTA file it is given, like
+# hmmscan --domtblout
+STAND_IN_HMMSCAN = """#!%s
+import sys
+args = sys.argv[1:]
+table = open(args[args.index('--domtblout') + 1], 'w')
+for line in open(args[-1]):
+    if line.startswith('>'):
+        table.write("Glyco_hydro_43 PF04616.9 286 %%s - 300 1e-40 140.0 0.1 "
+          "1 1 1e-43 1e-40 139.8 0.1 2 280 3 290 2 290 0.97 "
+          "Glycosyl hydrolases family 43\\n" %% line[1:].strip())
+"""
+
+class AnnotateTest(LoaderFixture, TestCase):
+    def setUp(self):
+        LoaderFixture.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'Pfam-A.hmm')
+        open(self.database, 'w').close()
+        self.old_hmmscan = annotate.HMMSCAN
+        annotate.HMMSCAN = os.path.join(self.directory, 'hmmscan')
+        open(annotate.HMMSCAN, 'w').write(STAND_IN_HMMSCAN % sys.executable)
+        os.chmod(annotate.HMMSCAN, 0755)
+
+    def tearDown(self):
+        annotate.HMMSCAN = self.old_hmmscan
+        shutil.rmtree(self.directory)
+
+    def test_only_new_sequences_are_scanned(self):
+        self.load(20)
+        counts = annotate.annotate(self.database, 'Pfam 24', processes=1)
+        self.failUnlessEqual((counts['sequences'], counts['domains']),
+          (10, 10))
+        feature = SequenceFeature.objects.filter(primary_tag='PFAM')[0]
+        self.failUnlessEqual(dict(feature.sequencetag_set.values_list('name',
+          'value')), {'family': 'PF04616', 'evalue': '1e-40',
+          'description': 'Glycosyl hydrolases family 43'})
+        self.failUnlessEqual(feature.sequencelocation_set.values_list(
+          'start_pos', 'end_pos')[0], (2, 290))
+
+        self.load(30)
+        counts = annotate.annotate(self.database, 'Pfam 24', processes=1)
+        self.failUnlessEqual(counts['sequences'], 5)
+        counts = annotate.annotate(self.database, 'Pfam 25', processes=1)
+        self.failUnlessEqual(counts['sequences'], 15)
+        self.failUnlessEqual(SequenceFeature.objects.count(), 15)
+
+class LoaderRollbackTest(LoaderFixture, TransactionTestCase):
+    def test_missing_sequences_roll_back(self):
+        hits = self.hits(100)
+        self.failUnlessRaises(loader.LoadError, loader.load_hits, hits,
+          self.fasta(50), 1, 1, 1)
+        self.failUnlessEqual(FamilyBuild.objects.count(), 0)
+        self.failUnlessEqual(Sequence.objects.count(), 0)
+
+class CommandTestCase(TransactionTestCase):
+    def outside_transactions(self, func, *args, **kwargs):
+        """
+        Call func as manage.py or a request would: Django 1.2 only refuses
+        set_dirty() outside a managed transaction in a thread that was
+        never under transaction management.
+        """
+        transaction.dirty.pop(thread.get_ident(), None)
+        return func(*args, **kwargs)
+
+class SummaryCommandTest(LoaderFixture, CommandTestCase):
+    def test_command_and_view_outside_a_transaction(self):
+        build_id = self.load(20)[0]
+        FamilySummary.objects.all().delete()
+        cache.delete(summary.cache_key(build_id))
+        request = HttpRequest()
+        request.method = 'GET'
+
+        # The page does not build a missing summary
+        self.failUnlessEqual(self.outside_transactions(views.families,
+          request, str(build_id)).status_code, 200)
+        self.failUnlessEqual(FamilySummary.objects.count(), 0)
+
+        self.outside_transactions(call_command, 'build_family_summary',
+          str(build_id), stdout=StringIO.StringIO())
+        self.failUnlessEqual(FamilySummary.objects.get().member_count, 10)
+        self.failUnlessEqual(self.outside_transactions(views.families,
+          request, str(build_id)).status_code, 200)
+        self.failUnlessEqual(summary.family_summary(build_id)[0]
+          ['member_count'], 10)
+
+class PackResiduesTest(CommandTestCase):
+    def test_command_outside_a_transaction(self):
+        for i, alphabet in enumerate(["protein", "dna", "protein"]):
+            Sequence.objects.create(sequence_id=i + 1, seguid="s%d" % i,
+              alphabet=alphabet, length=12, sequence="ACGTACGTACGT"[i:])
+        self.outside_transactions(residues.store, 3, "MKVL", "protein")
+
+        self.outside_transactions(call_command, 'pack_residues', batch=1,
+          clear=True, stdout=StringIO.StringIO())
+        self.failUnlessEqual(SequenceResidues.objects.count(), 3)
+        for i in range(2):
+            seq = Sequence.objects.get(pk=i + 1)
+            self.failUnlessEqual((seq.sequence, str(seq.residues)),
+              ("", "ACGTACGTACGT"[i:]))
+        self.failUnlessEqual(SequenceResidues.objects.get(pk=2).encoding,
+          "dna2")
+        # Already packed: left alone, not cleared
+        seq = Sequence.objects.get(pk=3)
+        self.failUnlessEqual((seq.sequence, str(seq.residues)),
+          ("GTACGTACGT", "MKVL"))
+
+def random_tree(n, seed):
+    """(parent, length) dicts of a random rooted tree with leaves 0..n-1."""
+    rng = random.Random(seed)
+    active, parent, length = range(n), {}, {}
+    node = n
+    while len(active) > 1:
+        for child in [active.pop(rng.randrange(len(active))) for i in (0, 1)]:
+            parent[child] = node
+            length[child] = rng.uniform(0.1, 1.0)
+        active.append(node)
+        node += 1
+    return parent, length
+
+def tree_distances(leaves, parent, length):
+    """Path lengths between all leaves of a tree given by parent links."""
+    def up(node):
+        path, total = {node: 0.0}, 0.0
+        while node in parent:
+            total += length[node]
+            node = parent[node]
+            path[node] = total
+        return path
+    paths = [up(leaf) for leaf in leaves]
+    d = numpy.zeros((len(leaves), len(leaves)))
+    for i, leaf in enumerate(leaves):
+        for j in range(len(leaves)):
+            node, total = leaf, 0.0
+            while node not in paths[j]:
+                total += length[node]
+                node = parent[node]
+            d[i, j] = total + paths[j][node]
+    return d
+
+def nj_links(root):
+    """(leaf names, parent, length) of a tree of gfam2.trees nodes."""
+    names, parent, length = [], {}, {}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node[2]:
+            for child in node[2]:
+                parent[id(child)] = id(node)
+                length[id(child)] = child[1]
+                stack.append(child)
+        else:
+            names.append((node[0], id(node)))
+    names.sort()
+    return [name for name, i in names], [i for name, i in names], \
+      parent, length
+
+def splits(leaves, parent):
+    """The leaf bipartitions of a tree, as the sides without leaves[0]."""
+    below = {}
+    for leaf in leaves:
+        node = leaf
+        while node in parent:
+            below.setdefault(node, set()).add(leaf)
+            node = parent[node]
+    everything = frozenset(leaves)
+    result = set()
+    for side in below.values():
+        side = frozenset(side)
+        if leaves[0] in side:
+            side = everything - side
+        if 1 < len(side) < len(leaves) - 1:
+            result.add(side)
+    return result
+
+class TreesTest(TestCase):
+    """gfam2.trees: distances and neighbor joining."""
+    def setUp(self):
+        self.old_rows = trees.NJ_ROWS
+
+    def tearDown(self):
+        trees.NJ_ROWS = self.old_rows
+
+    def check_additive_tree(self, n, seed):
+        parent, length = random_tree(n, seed)
+        d = tree_distances(range(n), parent, length)
+        names = ["L%d" % i for i in range(n)]
+        root = trees.neighbor_joining(d, names)
+
+        found, leaves, nj_parent, nj_length = nj_links(root)
+        self.failUnlessEqual(found, sorted(names))
+        # The same leaf distances, so the same tree
+        order = [int(name[1:]) for name in found]
+        self.failUnless(numpy.allclose(tree_distances(leaves, nj_parent,
+          nj_length), d[numpy.ix_(order, order)], atol=1e-4))
+        index = dict(zip(leaves, order))
+        self.failUnlessEqual(set(frozenset(index[leaf] for leaf in side)
+          for side in splits(leaves, nj_parent)),
+          splits(range(n), parent))
+
+    def test_neighbor_joining_of_additive_trees(self):
+        for n, seed in [(3, 1), (4, 2), (12, 3)]:
+            self.check_additive_tree(n, seed)
+        # The first partners in several blocks of rows
+        trees.NJ_ROWS = 7
+        for seed in range(4, 8):
+            self.check_additive_tree(50, seed)
+
+    def test_larger_than_one_block(self):
+        self.check_additive_tree(trees.NJ_ROWS + 20, 8)
+
+    def test_distances(self):
+        rows = ["MKV-LAAGX", "MKVALSAG-", "-KIALSCGX", "---------",
+          "MRVAL*AGB"]
+        p = numpy.ones((len(rows), len(rows)))
+        for i, a in enumerate(rows):
+            for j, b in enumerate(rows):
+                pairs = [(x, y) for x, y in zip(a, b) if x != '-' != y]
+                if pairs:
+                    p[i, j] = 1 - float(sum(x == y and x in trees.AMINO_ACIDS
+                      for x, y in pairs)) / len(pairs)
+        expected = -numpy.log(numpy.maximum(1 - p - 0.2 * p * p,
+          numpy.exp(-trees.MAX_DISTANCE)))
+        numpy.fill_diagonal(expected, 0)
+        for columns in (2, 4, 256):
+            self.failUnless(numpy.allclose(trees.distances(trees.encode(rows),
+              columns), expected))
+        self.failUnlessEqual(expected[0, 3], trees.MAX_DISTANCE)
+
+    def test_newick(self):
+        alignment = ">a x\nMKV-\n>b'c\nMKIA\n>d\nMRIA\n"
+        self.failUnlessEqual(trees.read_alignment(alignment)[0],
+          ["a", "b'c", "d"])
+        newick = trees.build_tree(alignment)
+        self.failUnlessEqual(trees.to_newick(trees.parse_newick(newick)),
+          newick)
+        self.failUnless("'b''c'" in newick)
+
+class CatalogTest(TestCase):
+    """gfam2.catalog lookups and the gene page that uses them."""
+    def setUp(self):
+        self.catalog = catalog.Catalog()
+        for accession in ["At1g01020", "At1g01010", "At2g01010"]:
+            self.catalog.add_gene(catalog.Gene(accession, name=accession))
+        self.catalog.link("Os01g01010", ["S1K"])
+        self.catalog.finish()
+        self.old = gfam2_views.catalog, settings.TEMPLATE_DIRS
+        gfam2_views.catalog = self.catalog
+        settings.TEMPLATE_DIRS = (os.path.join(os.path.dirname(
+          os.path.abspath(gfam2_views.__file__)), 'templates'),)
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def tearDown(self):
+        gfam2_views.catalog, settings.TEMPLATE_DIRS = self.old
+        sys.stdout = self.stdout
+
+    def test_accessions_with_prefix(self):
+        self.failUnlessEqual(self.catalog.accessions_with_prefix("AT1G"),
+          ["At1g01010", "At1g01020"])
+        self.failUnlessEqual(self.catalog.accessions_with_prefix("a", 2),
+          ["At1g01010", "At1g01020"])
+        self.failUnlessEqual(self.catalog.accessions_with_prefix("os"),
+          ["Os01g01010"])
+        self.failUnlessEqual(self.catalog.accessions_with_prefix("x"), [])
+
+    def test_gene_page_lists_candidates(self):
+        request = HttpRequest()
+        request.method = 'GET'
+        content = gfam2_views.gene(request, "at1g0", "").content
+        self.failUnless('<a href="/At1g01010">' in content)
+        self.failUnless('<a href="/At1g01020">' in content)
+        self.failIf("At2g01010" in content)
+        self.failUnlessEqual(gfam2_views.gene(request, "At3g", "").content,
+          "At3g is not found in this database")
+        content = gfam2_views.gene(request, "At1g01010", "").content
+        self.failUnless("Gene: At1g01010" in content)
+        self.failUnless('<a href="/similar/At1g01010">' in content)
+
+class AlignmentWindowTest(TestCase):
+    """gfam2.alignments and the window parameters of its view."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old = trees.ALIGNMENTS_DIR, alignments.STORE_DIR
+        trees.ALIGNMENTS_DIR = self.root
+        alignments.STORE_DIR = os.path.join(self.root, "store")
+        alignments._open.clear()
+
+    def tearDown(self):
+        trees.ALIGNMENTS_DIR, alignments.STORE_DIR = self.old
+        alignments._open.clear()
+        shutil.rmtree(self.root)
+
+    def test_window_range(self):
+        request = HttpRequest()
+        self.failUnlessEqual(window_range(request, 'rows', 100, 30),
+          slice(0, 30))
+        for value, expected in [("5-10", slice(4, 10)), ("20-40",
+          slice(19, 30)), ("30-30", slice(29, 30)), ("31-40", None),
+          ("0-5", None), ("6-5", None), ("a-b", None), ("5", None)]:
+            request.GET = {'rows': value}
+            self.failUnlessEqual(window_range(request, 'rows', 100, 30),
+              expected)
+
+    def test_replaced_alignments_are_let_go(self):
+        path = os.path.join(self.root, "GH43.fasta")
+        open(path, "w").write(">a\nMKV-L\n>b\nMKIAL\n")
+        alignment = alignments.family_alignment("GH43")
+        self.failUnless(alignments.family_alignment("GH43") is alignment)
+        self.failUnlessEqual(alignment.window(slice(0, 2), slice(1, 4)),
+          [("a", "KV-"), ("b", "KIA")])
+
+        open(path, "w").write(">a\nMKV-L\n>b\nMKIAL\n>c\nMRIAL\n")
+        alignment = alignments.family_alignment("GH43")
+        self.failUnlessEqual(alignment.rows, 3)
+        self.failUnlessEqual(alignments._open.keys(), ["GH43"])
+        self.failUnlessEqual(sorted(os.listdir(alignments.STORE_DIR)),
+          ["GH43.lock", alignments.store_key("GH43") + ".cols",
+           alignments.store_key("GH43") + ".json"])
+
+    def test_convert_keeps_a_finished_store(self):
+        path = os.path.join(self.root, "GH43.fasta")
+        open(path, "w").write(">a\nMKV-L\n>b\nMKIAL\n")
+        key = alignments.store_key("GH43")
+        store = alignments.convert("GH43", key)
+        os.utime(store + ".cols", (0, 0))
+        # Another process that missed the store converts again: it finds
+        # the store done and leaves it in place
+        self.failUnlessEqual(alignments.convert("GH43", key), store)
+        self.failUnlessEqual(os.path.getmtime(store + ".cols"), 0)
+        self.failUnlessEqual(alignments.Alignment(store).rows, 2)
+        # Only the stores of other keys are removed
+        stale = os.path.join(alignments.STORE_DIR, key[:-1] + "x.json")
+        open(stale, "w").close()
+        alignments.convert("GH43", key)
+        self.failIf(os.path.exists(stale))
+        self.failUnless(os.path.exists(store + ".json"))
+
+class SleepingCursor(object):
+    """A database cursor whose queries take at least `seconds`."""
+    def __init__(self, cursor, seconds):
+        self.cursor = cursor
+        self.seconds = seconds
+
+    def execute(self, sql, params=()):
+        time.sleep(self.seconds)
+        return self.cursor.execute(sql, params)
+
+class ProfilingTest(TestCase):
+    """gfam2.profiling, registered the way settings_profiling says."""
+    def setUp(self):
+        self.old = (settings.MIDDLEWARE_CLASSES, settings.INTERNAL_IPS,
+          profiling.SAMPLE_RATE, profiling.SLOW_QUERY)
+        profiled = settings_profiling.profile({
+          'MIDDLEWARE_CLASSES': settings.MIDDLEWARE_CLASSES})
+        settings.MIDDLEWARE_CLASSES = profiled['MIDDLEWARE_CLASSES']
+        settings.INTERNAL_IPS = profiled['INTERNAL_IPS']
+        profiling.SAMPLE_RATE = 1.0
+        profiling.samples.clear()
+        self.logged = []
+        self.handler = logging.Handler()
+        self.handler.emit = self.logged.append
+        profiling.log.addHandler(self.handler)
+
+    def tearDown(self):
+        (settings.MIDDLEWARE_CLASSES, settings.INTERNAL_IPS,
+          profiling.SAMPLE_RATE, profiling.SLOW_QUERY) = self.old
+        profiling.log.removeHandler(self.handler)
+        profiling.samples.clear()
+
+    def profile(self, path, func):
+        """Run func as the view of a profiled request for path."""
+        middleware = profiling.ProfilingMiddleware()
+        request = HttpRequest()
+        request.path_info = path
+        middleware.process_request(request)
+        try:
+            func()
+        finally:
+            middleware.process_response(request, HttpResponse())
+        return profiling.samples[profiling.url_pattern(path)][-1]
+
+    def slow_query(self, seconds):
+        cursor = connection.cursor()
+        cursor.cursor = SleepingCursor(cursor.cursor, seconds)
+        cursor.execute("SELECT 1")
+
+    def test_settings_keep_their_values(self):
+        own = {'INTERNAL_IPS': ('10.0.0.1',), 'PROFILING_SAMPLE_RATE': 0.5,
+          'MIDDLEWARE_CLASSES': ('a', settings_profiling.PROFILING_MIDDLEWARE)}
+        namespace = {}
+        exec "from settings_profiling import *" in namespace
+        self.failUnlessEqual(sorted(k for k in namespace
+          if k != '__builtins__'), ['profile', 'profiled'])
+        settings_profiling.profile(own)
+        self.failUnlessEqual(own['INTERNAL_IPS'], ('10.0.0.1',))
+        self.failUnlessEqual(own['PROFILING_SAMPLE_RATE'], 0.5)
+        self.failUnlessEqual(own['PROFILING_STATS_URL'], '/_stats')
+        self.failUnlessEqual(own['MIDDLEWARE_CLASSES'],
+          (settings_profiling.PROFILING_MIDDLEWARE, 'a'))
+
+    def test_requests_are_sampled(self):
+        self.failUnlessEqual(settings.MIDDLEWARE_CLASSES[0],
+          'gfam2.profiling.ProfilingMiddleware')
+        caching.builds_changed()
+        self.failUnlessEqual(Client().get('/search').status_code, 200)
+        stats = profiling.stats()['^search$']
+        self.failUnlessEqual((stats['count'], stats['queries']['p50']), (1, 1))
+        self.failUnless(stats['template']['p50'] > 0)
+
+    def test_time_is_split_by_kind(self):
+        test = self
+        class Page(object):
+            def body(self):
+                time.sleep(0.05)
+                test.slow_query(0.1)
+                subprocess.Popen(["sleep", "0.2"]).wait()
+                return "x"
+        def view():
+            self.failUnlessEqual(Template("{{ page.body }}").render(
+              Context({'page': Page()})), "x")
+        wall, sql, queries, template, waited = self.profile('/methods', view)
+        self.failUnlessEqual(queries, 1)
+        self.failUnless(wall >= 0.35)
+        self.failUnless(0.1 <= sql < 0.2)
+        self.failUnless(0.2 <= waited < wall)
+        # Less the query and the subprocess it waited for
+        self.failUnless(0.05 <= template < 0.3)
+
+    def test_slow_queries_are_logged(self):
+        profiling.SLOW_QUERY = 0.05
+        self.profile('/methods', lambda: (self.slow_query(0.1),
+          self.slow_query(0)))
+        self.failUnlessEqual(len(self.logged), 1)
+        message = self.logged[0].getMessage()
+        self.failUnless("SELECT 1" in message)
+        self.failUnless("tests.py" in message and
+          "in slow_query" in message)
+
+    def test_stats_page(self):
+        profiling.samples['^methods$'] = deque((i, i / 10.0, 2, 0.0, 0.0)
+          for i in range(1, 101))
+        self.failUnlessEqual(Client(REMOTE_ADDR='10.0.0.1').get(
+          profiling.STATS_URL).status_code, 403)
+        stats = simplejson.loads(Client().get(profiling.STATS_URL).content)
+        stats = stats['^methods$']
+        self.failUnlessEqual(stats['count'], 100)
+        self.failUnlessEqual(stats['wall'], {'p50': 51, 'p95': 96, 'p99': 100})
+        self.failUnlessEqual(stats['sql']['p99'], 10.0)
+        self.failUnlessEqual(stats['queries']['p50'], 2)
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
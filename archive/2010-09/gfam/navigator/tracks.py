@@ -0,0 +1,139 @@
+"""
+Precomputed feature tracks.
+
+Drawing a gene structure takes the SequenceFeature, SequenceLocation and
+SequenceTag rows of a sequence.  build_tracks() joins them once, when
+features have been loaded (manage.py build_feature_tracks), into one
+JSON row per sequence in gfam.feature_track:
+
+    [length, [[feature_id, primary_tag, start, end, strand], ...],
+     {feature_id: {"model": ..., "feat_name": ...}}]
+
+which is what genestructure.structure_rows() returns.  get_tracks()
+reads the tracks of many sequences in one query, for the /tracks batch
+endpoint and the side-by-side page.
+"""
+
+from django.db import connection, transaction
+from django.utils import simplejson
+
+from navigator.loader import insert_rows, select_in
+from navigator.models import *
+
+TRACK = FeatureTrack._meta.db_table
+FEATURE = SequenceFeature._meta.db_table
+LOCATION = SequenceLocation._meta.db_table
+TAG = SequenceTag._meta.db_table
+SEQUENCE = Sequence._meta.db_table
+
+# Tags the renderers group features by
+TRACK_TAGS = ['model', 'feat_name']
+
+# Most tracks served by one request
+MAX_TRACKS = 500
+
+# Sequences per transaction; within the parameter limit of every backend
+BATCH_SIZE = 500
+
+
+def encode_track(length, locations, tags):
+	return simplejson.dumps([length, locations, tags], separators=(',', ':'))
+
+
+def decode_track(text):
+	"""(length, locations, tags) in the shape of structure_rows()."""
+	length, locations, tags = simplejson.loads(text)
+	return (length,
+	  [(row[0], unicode(row[1]), row[2], row[3], row[4])
+	   for row in locations],
+	  dict((int(feature_id), dict((unicode(k), unicode(v))
+	    for k, v in t.items())) for feature_id, t in tags.items()))
+
+
+def feature_sequences():
+	"""Ids of all sequences that have features."""
+	cursor = connection.cursor()
+	cursor.execute("SELECT DISTINCT sequence_id FROM " + FEATURE +
+	  " ORDER BY sequence_id")
+	return [row[0] for row in cursor.fetchall()]
+
+
+def _tracks(cursor, sequence_ids):
+	"""{sequence_id: (length, locations, tags)} in three queries."""
+	tracks = dict((sequence_id, (length, [], {})) for sequence_id, length in
+	  select_in(cursor, "SELECT sequence_id, length FROM " + SEQUENCE +
+	    " WHERE sequence_id IN", sequence_ids))
+
+	rows = sorted(select_in(cursor, "SELECT f.sequence_id, " +
+	    "l.sequence_feature_id, f.primary_tag, l.start_pos, l.end_pos, " +
+	    "l.strand, l.rank " +
+	  "FROM " + LOCATION + " l JOIN " + FEATURE + " f " +
+	    "ON f.sequence_feature_id = l.sequence_feature_id " +
+	  "WHERE f.sequence_id IN", sequence_ids),
+	  key=lambda row: (row[0], row[1], row[6]))
+	for row in rows:
+		tracks[row[0]][1].append(row[1:6])
+
+	rows = sorted(select_in(cursor, "SELECT f.sequence_id, " +
+	    "t.sequence_feature_id, t.name, t.value, t.sequence_tag_id " +
+	  "FROM " + TAG + " t JOIN " + FEATURE + " f " +
+	    "ON f.sequence_feature_id = t.sequence_feature_id " +
+	  "WHERE t.name IN (" + ",".join(["%s"] * len(TRACK_TAGS)) + ") " +
+	    "AND f.sequence_id IN", sequence_ids, TRACK_TAGS),
+	  key=lambda row: row[4])
+	for sequence_id, feature_id, name, value, tag_id in rows:
+		tracks[sequence_id][2].setdefault(feature_id, {})[name] = value
+	return tracks
+
+
+@transaction.commit_manually
+def build_tracks(sequence_ids=None, batch_size=BATCH_SIZE):
+	"""
+	(Re)build the tracks of sequence_ids, or of every sequence with
+	features, committing every batch.  Returns the number of tracks
+	written.
+	"""
+	try:
+		if sequence_ids is None:
+			sequence_ids = feature_sequences()
+		sequence_ids = list(sequence_ids)
+		cursor = connection.cursor()
+		count = 0
+		for i in xrange(0, len(sequence_ids), batch_size):
+			batch = sequence_ids[i:i + batch_size]
+			tracks = _tracks(cursor, batch)
+			cursor.execute("DELETE FROM " + TRACK + " WHERE sequence_id IN (" +
+			  ",".join(["%s"] * len(batch)) + ")", batch)
+			transaction.set_dirty()
+			insert_rows(cursor, FeatureTrack, ['sequence_id', 'track'],
+			  [(sequence_id, encode_track(*track))
+			   for sequence_id, track in sorted(tracks.items())])
+			count += len(tracks)
+			transaction.commit()
+	except:
+		transaction.rollback()
+		raise
+	transaction.commit()
+	return count
+
+
+def get_track(sequence_id):
+	"""The decoded track of one sequence, or None."""
+	cursor = connection.cursor()
+	cursor.execute("SELECT track FROM " + TRACK + " WHERE sequence_id = %s",
+	  [sequence_id])
+	row = cursor.fetchone()
+	return row and decode_track(row[0])
+
+
+def get_tracks(sequence_ids):
+	"""{sequence_id: track JSON} for the sequences that have a track."""
+	cursor = connection.cursor()
+	return dict(select_in(cursor, "SELECT sequence_id, track FROM " + TRACK +
+	  " WHERE sequence_id IN", sequence_ids))
+
+
+def random_tracks(count):
+	"""[(sequence_id, track JSON)] of count random sequences."""
+	return list(FeatureTrack.objects.order_by('?')
+	  .values_list('sequence', 'track')[:count])
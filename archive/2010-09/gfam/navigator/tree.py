@@ -0,0 +1,138 @@
+"""
+Family tree hierarchy stored as nested-set intervals.
+
+family_tree_instance keeps the adjacency list (parent_node, rank) as the
+source of truth.  number_tree() walks it once, when a tree is loaded, and
+stores for every node its preorder_left/preorder_right interval, depth and
+preorder_code.  With those, subtrees and ancestor paths are single range
+queries instead of one query per tree level.
+
+preorder_code spells the path from the root as CODE_WIDTH base-26
+letters per node, the node's rank, so sorting by it lists a tree in
+preorder whatever the ranks are ("AAB" then "AABAAA" then "AAC").
+"""
+
+from django.db import connection, transaction
+
+from navigator.models import *
+
+INSTANCE = FamilyTreeInstance._meta.db_table
+NODE = FamilyTreeNode._meta.db_table
+MEMBER = FamilyMember._meta.db_table
+INFO = SequenceInformation._meta.db_table
+
+_NODE_COLUMNS = "c.*, n.family_tree_node_abrev, n.family_tree_node_name"
+
+CODE_WIDTH = 3
+UPDATE_BATCH_SIZE = 1000
+
+
+def rank_code(rank):
+	"""The CODE_WIDTH letters of a rank: 0 is "AAA", 27 is "ABB"."""
+	if not 0 <= rank < 26 ** CODE_WIDTH:
+		raise ValueError("Rank %r does not fit in a preorder code" % rank)
+	letters = []
+	for i in range(CODE_WIDTH):
+		rank, digit = divmod(rank, 26)
+		letters.append(chr(digit + 65))
+	return ''.join(reversed(letters))
+
+
+def _preorder(nodes):
+	"""
+	Yield (node_id, left, right, depth, preorder_code) for a list of
+	(node_id, parent_node_id, rank) tuples.  Roots are nodes without a
+	parent or with themselves as parent.
+	"""
+	children = {}
+	roots = []
+	for node_id, parent_id, rank in nodes:
+		if parent_id is None or parent_id == node_id:
+			roots.append((rank, node_id))
+		else:
+			children.setdefault(parent_id, []).append((rank, node_id))
+
+	counter = 0
+	# Iterative depth-first walk; a node is pushed again (closing=True)
+	# to assign its right bound after all of its children
+	stack = [(node_id, 0, rank_code(rank), False)
+	  for rank, node_id in sorted(roots, reverse=True)]
+	left = {}
+	while stack:
+		node_id, depth, code, closing = stack.pop()
+		counter += 1
+		if closing:
+			yield node_id, left.pop(node_id), counter, depth, code
+			continue
+		left[node_id] = counter
+		stack.append((node_id, depth, code, True))
+		for rank, child_id in sorted(children.get(node_id, ()), reverse=True):
+			stack.append((child_id, depth + 1, code + rank_code(rank), False))
+
+
+@transaction.commit_on_success
+def number_tree(family_tree_id):
+	"""Recompute the nested-set columns of one family tree."""
+	nodes = FamilyTreeInstance.objects.filter(family_tree=family_tree_id) \
+	  .values_list('node_id', 'parent_node', 'rank')
+	rows = [(left, right, depth, code, node_id)
+	  for node_id, left, right, depth, code in _preorder(list(nodes))]
+	cursor = connection.cursor()
+	for i in xrange(0, len(rows), UPDATE_BATCH_SIZE):
+		cursor.executemany("UPDATE " + INSTANCE + " " +
+		  "SET preorder_left = %s, preorder_right = %s, depth = %s, " +
+		    "preorder_code = %s " +
+		  "WHERE instance_node_id = %s", rows[i:i + UPDATE_BATCH_SIZE])
+	transaction.set_dirty()
+	return len(rows)
+
+
+def subtree(node_id):
+	"""The node and all of its descendants, in preorder."""
+	return list(FamilyTreeInstance.objects.raw(
+	  "SELECT " + _NODE_COLUMNS + " " +
+	  "FROM " + INSTANCE + " p " +
+	  "JOIN " + INSTANCE + " c ON c.family_tree_id = p.family_tree_id " +
+	    "AND c.preorder_left BETWEEN p.preorder_left AND p.preorder_right " +
+	  "JOIN " + NODE + " n ON n.family_tree_node_id = c.family_tree_node_id " +
+	  "WHERE p.instance_node_id = %s ORDER BY c.preorder_left", [node_id]))
+
+
+def ancestors(node_id):
+	"""The path from the root down to (not including) the node."""
+	return list(FamilyTreeInstance.objects.raw(
+	  "SELECT " + _NODE_COLUMNS + " " +
+	  "FROM " + INSTANCE + " p " +
+	  "JOIN " + INSTANCE + " c ON c.family_tree_id = p.family_tree_id " +
+	    "AND c.preorder_left < p.preorder_left " +
+	    "AND c.preorder_right > p.preorder_right " +
+	  "JOIN " + NODE + " n ON n.family_tree_node_id = c.family_tree_node_id " +
+	  "WHERE p.instance_node_id = %s ORDER BY c.preorder_left", [node_id]))
+
+
+def subtree_with_members(build_id, node_id):
+	"""
+	The subtree of a node with the family members of one build attached
+	to each node as a list of dicts (node.members).  Two queries.
+	"""
+	nodes = subtree(node_id)
+	by_id = {}
+	for node in nodes:
+		node.members = []
+		by_id[node.node_id] = node
+
+	cursor = connection.cursor()
+	cursor.execute(
+	  "SELECT m.instance_node_id, i.sequence_id, i.accession, i.display, " +
+	    "i.description " +
+	  "FROM " + INSTANCE + " p " +
+	  "JOIN " + INSTANCE + " c ON c.family_tree_id = p.family_tree_id " +
+	    "AND c.preorder_left BETWEEN p.preorder_left AND p.preorder_right " +
+	  "JOIN " + MEMBER + " m ON m.instance_node_id = c.instance_node_id " +
+	  "JOIN " + INFO + " i ON i.sequence_id = m.sequence_id " +
+	  "WHERE p.instance_node_id = %s AND m.family_build_id = %s " +
+	  "ORDER BY i.accession", [node_id, build_id])
+	keys = ['sequence_id', 'accession', 'display', 'description']
+	for row in cursor.fetchall():
+		by_id[row[0]].members.append(dict(zip(keys, row[1:])))
+	return nodes
@@ -1,106 +1,166 @@
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 #from django.template import Template, Context
 from django.shortcuts import *
 
-import commands
 import random
 
 # Django style DB access
 from navigator.models import *
 
 # Advanced DB access (SQL)
-from django.db import connection, transaction
+from django.db import transaction
+
+from navigator import genestructure, queries, residues, search, similar, \
+  streaming, summary, tracks
+from navigator.caching import build_page, gzip_variant, site_page
 
 
 def homepage(request):
 	return HttpResponseRedirect("/families")
 
+@site_page
 def builds(request):
-	data = []
-	for b in FamilyBuild.objects.all():
-		d = {}
-		d['build_id'] = b.family_build_id
-		d['timestamp'] = b.family_build_timestamp
-		d['method_id'] = b.family_build_method.family_build_method_id
-		d['method'] = b.family_build_method.family_build_method_name
-		data.append(d)
-
-	return render_to_response("builds.html", {'data': data})
+	return render_to_response("builds.html", {'data': queries.builds()})
 
+@site_page
 def method(request, *q):
 	method_id = int(q[0])
-	m = FamilyBuildMethod.objects.get(family_build_method_id=method_id)
-	data = {}
-        data['name'] = m.family_build_method_name
-	data['builds'] = []
-        for i in FamilyBuild.objects.filter(family_build_method=method_id):
-		data['builds'].append(i.family_build_id)
-	return render_to_response("method.html", {'data': data})
+	return render_to_response("method.html",
+	  {'data': queries.method(method_id)})
 
 
 
+@build_page
 def families(request, *q):
 	build_id = int(q[0])
-
-        for tree_instance in FamilyMember.objects.raw(
-	  'SELECT instance_node_id ' +
-          'FROM gfam.family_member ' +
-          'WHERE family_build_id = %s GROUP BY instance_node_id', [build_id]):
-		pass #tree_instance.family_tree_node
-
-
-
-	# cursor = connection.cursor()
-	# # cursor.execute("SELECT instance_node_id FROM gfam.family_fasta " +
-	# #   "GROUP BY instance_node_id")
-        # keys = ["instance_node_id",
-        #         "preorder_code",
- 	# 	"family_tree_node_abrev",
-	# 	"family_tree_node_name"]
-
-
-	# # TODO: Re-write with "WHERE family_tree_id = 1"
-	# rows = cursor.execute("SELECT " + ",".join(keys) + " FROM " +
-        #  "gfam.family_tree_instance JOIN gfam.family_tree_node ON " +
-        #    "gfam.family_tree_instance.family_tree_node_id = " +
-	#    "gfam.family_tree_node.family_tree_node_id " +
-        #  "WHERE " +
-        #    "instance_node_id IN " +
-	#    "(SELECT instance_node_id FROM " + 
-	#    "gfam.family_fasta GROUP BY instance_node_id);")
-
-        # rows = cursor.fetchall()
-
-        fam_dicts = []
- 	for row in rows:
-		fam_dict = {}
-		for i, key in enumerate(keys):
-			fam_dict[key] = row[i]
-	        fam_dicts.append(fam_dict)
-
-	return render_to_response("families.html", {'families': fam_dicts})
+	return render_to_response("families.html",
+	  {'families': summary.family_summary(build_id)})
 
 
+@build_page
+@gzip_variant
 def family_fasta(request, *q):
-        instance_node_id = int(q[0])
-	cursor = connection.cursor()
-	cursor.execute("SELECT fasta_line FROM gfam.family_fasta " +
-	  "WHERE instance_node_id = %s", [instance_node_id])
-
-	rows = cursor.fetchall()
-	return HttpResponse(''.join(f[0] for f in rows), mimetype='text/plain')
+	build_id = int(q[0])
+	instance_node_id = int(q[-1])
+	rows = streaming.iter_query("SELECT m.sequence_id, i.accession, " +
+	  "i.display, i.description " +
+	  "FROM " + FamilyMember._meta.db_table + " m " +
+	  "JOIN " + SequenceInformation._meta.db_table + " i " +
+	    "ON i.sequence_id = m.sequence_id " +
+	  "WHERE m.family_build_id = %s AND m.instance_node_id = %s " +
+	  "ORDER BY i.accession", [build_id, instance_node_id])
+	headers = ((row[0], " ".join(filter(None, row[1:]))) for row in rows)
+
+	content = streaming.iter_chunks(residues.iter_fasta(headers))
+	return fasta_response(request, content)
+
+@site_page
+@gzip_variant
+def sequence_fasta(request, *q):
+	"""One sequence, or residues ?start= to ?end= of it (1-based)."""
+	sequence = get_object_or_404(Sequence, pk=int(q[0]))
+	try:
+		start = int(request.GET.get('start', 1))
+		end = int(request.GET.get('end', sequence.length))
+	except ValueError:
+		raise Http404
+	header = "%d" % sequence.sequence_id
+	if 'start' in request.GET or 'end' in request.GET:
+		header += ":%d-%d" % (start, end)
+	return fasta_response(request,
+	  [">%s\n%s\n" % (header, sequence.residues.window(start, end))])
+
+def similar_sequences(request, *q):
+	"""BLAST hits of a sequence, in ?db= (a family, or full by default)."""
+	sequence = get_object_or_404(Sequence, pk=int(q[0]))
+	db = request.GET.get('db', 'full')
+	context = {'sequence_id': sequence.sequence_id, 'db': db}
+	try:
+		context.update(similar.similar_sequences(str(sequence.residues), db))
+	except similar.SimilarityError, e:
+		context['error'] = str(e)
+		# The service answers 400 for a ?db= it does not have
+		status = e.status == 400 and 404 or 503
+	response = render_to_response("similar.html", context)
+	if 'error' in context:
+		response.status_code = status
+	return response
+
+def similar_by_accession(request, *q):
+	"""The similar sequences page of the sequence with accession q[0]."""
+	info = SequenceInformation.objects.filter(accession__iexact=q[0]) \
+	  .order_by('sequence_information_id')[:1]
+	if not info:
+		raise Http404
+	url = "/sequence/%d/similar" % info[0].sequence_id
+	if request.GET:
+		url += "?" + request.GET.urlencode()
+	return HttpResponseRedirect(url)
+
+def fasta_response(request, content):
+	if streaming.accepts_gzip(request):
+		response = HttpResponse(streaming.iter_gzip(content),
+		  mimetype='text/plain')
+		response['Content-Encoding'] = 'gzip'
+	else:
+		response = HttpResponse(content, mimetype='text/plain')
+	response['Vary'] = 'Accept-Encoding'
+	return response
+
+
+@site_page
+def search_page(request):
+	"""Accession prefix and keyword search: ?q=At1g0 or ?q=xylan synthase"""
+	q = request.GET.get('q', '')
+	results = q.strip() and search.get_index().search(q) or []
+	return render_to_response("search.html", {'q': q, 'results': results})
 
 
 def gene_structure_png(request, *q):
-	s, out = commands.getstatusoutput("./exteranal/reneder-gene.pl %s" % q)
-	return HttpResponse(out, mimetype='image/png')
-	#return HttpResponse(q)
+	try:
+		sequence_id = int(q[0])
+	except ValueError:
+		raise Http404
+	return genestructure.png_response(request, sequence_id)
+
+def _sequence_ids(request):
+	"""Sequence ids from ?ids=1,2,3, or None if they are not numbers."""
+	try:
+		return [int(i) for i in request.GET.get('ids', '').split(',') if i]
+	except ValueError:
+		return None
+
+def feature_tracks(request):
+	"""The feature tracks of ?ids=..., as {sequence_id: track} JSON."""
+	ids = _sequence_ids(request)
+	if ids is None or len(ids) > tracks.MAX_TRACKS:
+		return HttpResponseBadRequest("Expected up to %d sequence ids" %
+		  tracks.MAX_TRACKS, mimetype='text/plain')
+	found = tracks.get_tracks(ids)
+	return HttpResponse("{" + ",".join('"%d":%s' % (i, found[i])
+	  for i in ids if i in found) + "}", mimetype='application/json')
 
 def sidebyside(request):
-	l = []
-	#for x in range(1,200):
-	#	l.append(random.randint(1, 4591))
-	l.append(3195)
-	l.append(3135)
+	"""
+	Gene structures of ?ids=..., or of ?random=N sequences, drawn from
+	their feature tracks (read in one query) next to the Perl images.
+	"""
+	ids = _sequence_ids(request)
+	if ids is None:
+		raise Http404
+	if 'random' in request.GET:
+		try:
+			count = min(int(request.GET['random']), tracks.MAX_TRACKS)
+		except ValueError:
+			raise Http404
+		rows = tracks.random_tracks(count)
+	else:
+		ids = ids[:tracks.MAX_TRACKS] or [3195, 3135]
+		found = tracks.get_tracks(ids)
+		rows = [(i, found.get(i)) for i in ids]
 
-	return render_to_response("side-by-side.html", {'sequence_id_list': l})
+	l = []
+	for sequence_id, track in rows:
+		svg = track and genestructure.render_svg(*tracks.decode_track(track))
+		l.append({'sequence_id': sequence_id, 'svg': svg})
+	return render_to_response("side-by-side.html", {'sequence_list': l})
@@ -0,0 +1,52 @@
+"""
+Request profiling of the navigator site, see gfam2/profiling.py.
+
+settings.py is local to each server and not kept in the repository; to
+profile a server, end its settings.py with
+
+    from settings_profiling import profile
+    profile(globals())
+
+which puts the profiling middleware first in MIDDLEWARE_CLASSES and sets
+the PROFILING_* settings and INTERNAL_IPS to DEFAULTS where settings.py
+has not set them, so set PROFILING_SAMPLE_RATE there to change the
+fraction of requests that are timed.  The stats page answers INTERNAL_IPS
+only.
+"""
+
+import os
+import sys
+
+# gfam2 is next to this project
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.append(_ROOT)
+
+__all__ = ['profile', 'profiled']
+
+PROFILING_MIDDLEWARE = 'gfam2.profiling.ProfilingMiddleware'
+
+DEFAULTS = {
+    'PROFILING_SAMPLE_RATE': 0.05,
+    'PROFILING_SLOW_QUERY': 0.5,        # seconds
+    'PROFILING_STATS_URL': '/_stats',
+    'INTERNAL_IPS': ('127.0.0.1',),
+}
+
+
+def profiled(classes):
+    """classes with the profiling middleware first, as it must be."""
+    return (PROFILING_MIDDLEWARE,) + tuple(c for c in classes
+      if c != PROFILING_MIDDLEWARE)
+
+
+def profile(settings):
+    """
+    Turn on profiling in the settings dict (the globals() of settings.py),
+    keeping the values it already has; returns settings.
+    """
+    for name, value in DEFAULTS.items():
+        settings.setdefault(name, value)
+    settings['MIDDLEWARE_CLASSES'] = profiled(
+      settings.get('MIDDLEWARE_CLASSES', ()))
+    return settings
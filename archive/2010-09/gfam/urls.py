@@ -17,11 +17,17 @@ urlpatterns = patterns('',
 
     (r'^gene-structure/(.*)\.png', 'navigator.views.gene_structure_png'),
     (r'^gene-structure$', 'navigator.views.sidebyside'),
+    (r'^tracks$', 'navigator.views.feature_tracks'),
 
 
     (r'^b([0-9]+)/family/(.*)\.fasta', 'navigator.views.family_fasta'),
+    (r'^sequence/([0-9]+)\.fasta$', 'navigator.views.sequence_fasta'),
+    (r'^sequence/([0-9]+)/similar$', 'navigator.views.similar_sequences'),
+    (r'^similar/(.+)$', 'navigator.views.similar_by_accession'),
     (r'^b([0-9]+)/families$', 'navigator.views.families'),
 
+    (r'^search$', 'navigator.views.search_page'),
+
     (r'^method/(.*)', 'navigator.views.method'),
     (r'^methods$', 'navigator.views.methods'),
 
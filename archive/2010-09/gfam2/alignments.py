@@ -0,0 +1,160 @@
+"""
+Family alignments served a window at a time.
+
+The first request for a family converts its alignment (see
+trees.alignment_path()) into two files in settings.GFAM2_ALIGNMENT_STORE:
+
+    <key>.cols  the residues as bytes, column-major: column c is the
+                `rows` bytes at c * rows, gaps and padding '-'
+    <key>.json  rows, columns, the sequence names, and per column the
+                consensus residue ('-' when all are gaps) and its
+                conservation, the percent of the rows that have it
+
+where the key holds the size and mtime of the alignment, so a changed
+alignment is converted again.  Processes converting the same family take
+turns on <abbrev>.lock; the first writes the store, the others find it
+done, and stores of other keys are removed.  The .cols file is memory-mapped; a window
+of rows and columns reads only those columns, and the header is loaded
+once per process.  A process keeps only the newest store of a family
+open, so the map of a replaced one is let go.  An alignment of 5,000 x
+2,000 is a 10 MB file, and a window of 100 x 200 is 20 KB.
+"""
+
+import errno
+import fcntl
+import glob
+import os
+import tempfile
+
+import numpy
+
+from django.conf import settings
+from django.utils import simplejson
+
+from gfam2.trees import alignment_path, read_alignment
+
+STORE_DIR = getattr(settings, 'GFAM2_ALIGNMENT_STORE',
+                    os.path.join(tempfile.gettempdir(), 'gfam2-alignments'))
+
+# Part of the store file names; bump when the format changes
+STORE_VERSION = 1
+
+GAPS = '-.'
+GAP = ord('-')
+
+# Columns counted at a time for the consensus
+COLUMNS = 256
+
+# {abbrev: (key, Alignment)}
+_open = {}
+
+
+class Alignment(object):
+    """A converted alignment: names, consensus, conservation, residues."""
+    def __init__(self, path):
+        header = simplejson.load(open(path + '.json'))
+        self.rows = header['rows']
+        self.columns = header['columns']
+        self.names = header['names']
+        self.consensus = header['consensus']
+        self.conservation = header['conservation']
+        if self.rows and self.columns:
+            self.residues = numpy.memmap(path + '.cols', numpy.uint8, 'r',
+                                         shape=(self.columns, self.rows))
+        else:
+            self.residues = numpy.zeros((self.columns, self.rows),
+                                        numpy.uint8)
+
+    def window(self, rows, columns):
+        """[(name, residues)] of the slices rows and columns."""
+        block = numpy.ascontiguousarray(self.residues[columns, rows].T)
+        return zip(self.names[rows], [row.tostring() for row in block])
+
+
+def store_key(abbrev):
+    """Key of the converted alignment of a family, or None if it has none."""
+    path = alignment_path(abbrev)
+    if path is None:
+        return None
+    st = os.stat(path)
+    return 'gfam2.alignment.v%d.%s.%d.%d' % (STORE_VERSION, abbrev,
+                                             st.st_size, st.st_mtime)
+
+
+def consensus(residues):
+    """(consensus bytes, conservation percents) of column-major residues."""
+    columns, rows = residues.shape
+    letters = numpy.empty(columns, numpy.uint8)
+    percents = numpy.empty(columns, numpy.intp)
+    for start in xrange(0, columns, COLUMNS):
+        chunk = residues[start:start + COLUMNS]
+        keys = chunk + numpy.arange(len(chunk))[:, None] * 256
+        counts = numpy.bincount(keys.ravel(), minlength=len(chunk) * 256) \
+            .reshape(len(chunk), 256)
+        counts[:, [ord(gap) for gap in GAPS]] = 0
+        best = counts.argmax(axis=1)
+        top = counts[numpy.arange(len(chunk)), best]
+        letters[start:start + len(chunk)] = numpy.where(top > 0, best, GAP)
+        percents[start:start + len(chunk)] = top * 100 // max(rows, 1)
+    return letters.tostring(), percents.tolist()
+
+
+def _write(path, write):
+    fd, tmp = tempfile.mkstemp(dir=STORE_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        write(f)
+    os.rename(tmp, path)
+
+
+def convert(abbrev, key):
+    """
+    Write the store files of a family's alignment, unless another process
+    has; returns their path.
+    """
+    try:
+        os.makedirs(STORE_DIR)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    path = os.path.join(STORE_DIR, key)
+    with open(os.path.join(STORE_DIR, abbrev + '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path + '.json'):
+            _convert(abbrev, path)
+        for old in glob.glob(os.path.join(STORE_DIR,
+                'gfam2.alignment.v%d.%s.*' % (STORE_VERSION, abbrev))):
+            if not old.startswith(path + '.'):
+                os.remove(old)
+    return path
+
+
+def _convert(abbrev, path):
+    names, sequences = read_alignment(open(alignment_path(abbrev)).read())
+    width = max([len(sequence) for sequence in sequences] or [0])
+    residues = numpy.empty((width, len(sequences)), numpy.uint8)
+    residues.fill(GAP)
+    for i, sequence in enumerate(sequences):
+        residues[:len(sequence), i] = numpy.frombuffer(sequence, numpy.uint8)
+    residues[residues == ord('.')] = GAP
+    letters, percents = consensus(residues)
+    _write(path + '.cols', residues.tofile)
+    # The header goes last: a store is complete once it exists
+    _write(path + '.json', lambda f: simplejson.dump({
+        'rows': len(sequences), 'columns': width, 'names': names,
+        'consensus': letters, 'conservation': percents}, f))
+
+
+def family_alignment(abbrev):
+    """The Alignment of a family, converted on first use; None if none."""
+    key = store_key(abbrev)
+    if key is None:
+        return None
+    opened = _open.get(abbrev)
+    if opened is not None and opened[0] == key:
+        return opened[1]
+    path = os.path.join(STORE_DIR, key)
+    if not os.path.exists(path + '.json'):
+        path = convert(abbrev, key)
+    alignment = Alignment(path)
+    _open[abbrev] = key, alignment
+    return alignment
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Requests per second of the gfam2 views on a synthetic catalog, rendered
+the old way (templates loaded and compiled on every request, no fragment
+cache) and with the cached template loader and {% cache %} fragments.
+
+    ./benchmark.py [--families 500] [--members 40] [--requests 5000]
+
+Each mode runs in its own process since Django sets up template loaders
+and the cache backend once per process.
+"""
+
+import optparse
+import os.path
+import random
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+MODES = ('plain', 'cached')
+
+
+def synthetic_catalog(families, members):
+    from gfam2.catalog import Catalog, Family, Member
+    catalog = Catalog()
+    for i in range(families):
+        abbrev = 'F%03d' % i
+        catalog.add_family(Family(abbrev, 'Synthetic family %d' % i))
+        for j in range(members):
+            catalog.add_member(abbrev, Member(
+              'At%dg%05d' % (i % 5 + 1, i * members + j),
+              name='G%d' % j, species='Arabidopsis thaliana',
+              description='synthetic protein %d of family %d' % (j, i)))
+    return catalog.finish()
+
+
+def configure(mode):
+    from django.conf import settings
+    loaders = ('django.template.loaders.filesystem.Loader',)
+    if mode == 'cached':
+        loaders = (('django.template.loaders.cached.Loader', loaders),)
+        backend = 'locmem://?max_entries=5000'
+    else:
+        backend = 'dummy://'
+    settings.configure(TEMPLATE_DIRS=(os.path.join(HERE, 'templates'),),
+                       TEMPLATE_LOADERS=loaders,
+                       CACHE_BACKEND=backend)
+
+
+def run(mode, options):
+    configure(mode)
+    from django.http import HttpRequest
+    from gfam2 import views
+
+    views.catalog = synthetic_catalog(options.families, options.members)
+    abbrevs = [f.abbrev for f in views.catalog.families()]
+    rng = random.Random(0)
+    requests = [(views.families, ())]
+    for i in range(options.requests - 1):
+        view = rng.choice([views.summary, views.structure, views.tree])
+        requests.append((view, (rng.choice(abbrevs),)))
+
+    request = HttpRequest()
+    start = time.time()
+    for view, args in requests:
+        view(request, *args)
+    return len(requests) / (time.time() - start)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--families", type="int", default=500)
+    parser.add_option("--members", type="int", default=40,
+                      help="members per family")
+    parser.add_option("--requests", type="int", default=5000)
+    parser.add_option("--mode", choices=MODES,
+                      help="run one mode in this process and print its rate")
+    options, args = parser.parse_args()
+
+    if options.mode:
+        print "%.1f" % run(options.mode, options)
+        return
+
+    rates = {}
+    for mode in MODES:
+        out = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+          "--mode", mode, "--families", str(options.families),
+          "--members", str(options.members),
+          "--requests", str(options.requests)],
+          stdout=subprocess.PIPE).communicate()[0]
+        rates[mode] = float(out)
+        print "%-7s %8.1f requests/s" % (mode, rates[mode])
+    print "speedup %8.1fx" % (rates['cached'] / rates['plain'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+In-memory catalog of families, members, genes and DNA records.
+
+The catalog is loaded once per process (see load()) either from the
+family XML flat files of the Perl site (settings.GFAM2_FAMILIES_DIR,
+e.g. web/Cellwall/data/families) or, when that is not set, from the
+small sample data below.  Records use __slots__ and share interned
+species strings; the indexes give each view just the slice it renders:
+
+    accession -> families it belongs to
+    family    -> members (sorted by accession)
+    accession prefix lookups through a sorted list
+
+Catalog.version is a digest of the families and their members.  Cached
+page fragments include it in their keys, so reloading changed data
+leaves the old fragments unused; it is also the ETag of every page, with
+Catalog.timestamp (when the data last changed) as Last-Modified.
+"""
+
+import bisect
+import datetime
+import glob
+import hashlib
+import os.path
+from xml.etree import cElementTree as ElementTree
+
+from django.conf import settings
+
+
+class Family(object):
+    __slots__ = ('abbrev', 'name', 'tree')
+
+    def __init__(self, abbrev, name, tree=''):
+        self.abbrev = abbrev
+        self.name = name
+        self.tree = tree
+
+
+class Member(object):
+    __slots__ = ('accession', 'name', 'species', 'description', 'length',
+                 'fullname', 'sequence')
+
+    def __init__(self, accession, name='', species='', description='',
+                 length='', fullname='', sequence=''):
+        self.accession = accession
+        self.name = name
+        self.species = intern(species)
+        self.description = description
+        self.length = length
+        self.fullname = fullname
+        self.sequence = sequence
+
+
+class Gene(Member):
+    __slots__ = ('ids',)
+
+    def __init__(self, accession, ids='', **fields):
+        Member.__init__(self, accession, **fields)
+        self.ids = ids
+
+
+class Dna(object):
+    __slots__ = ('accession', 'structure', 'sequence', 'features')
+
+    def __init__(self, accession, structure='', sequence='', features=''):
+        self.accession = accession
+        self.structure = structure
+        self.sequence = sequence
+        self.features = features
+
+
+class Catalog(object):
+    def __init__(self):
+        self._families = {}
+        self._members = {}      # family abbrev -> [Member] by accession
+        self._genes = {}
+        self._dna = {}
+        self._gene_families = {}  # accession -> [family abbrev]
+        self._accessions = []   # sorted, lower case, for prefix lookups
+        self._accession_keys = {}
+        self.version = None
+        self.timestamp = None
+
+    # -- loading -------------------------------------------------------------
+
+    def add_family(self, family):
+        self._families[family.abbrev] = family
+        self._members.setdefault(family.abbrev, [])
+
+    def add_member(self, abbrev, member):
+        self._members.setdefault(abbrev, []).append(member)
+        self._gene_families.setdefault(member.accession, []).append(abbrev)
+
+    def add_gene(self, gene):
+        self._genes[gene.accession] = gene
+
+    def add_dna(self, dna):
+        self._dna[dna.accession] = dna
+
+    def link(self, accession, abbrevs):
+        """Record family memberships of a gene that has no Member record."""
+        known = self._gene_families.setdefault(accession, [])
+        known.extend(a for a in abbrevs if a not in known)
+
+    def finish(self, timestamp=None):
+        """
+        Sort the member lists, build the prefix index and set version and
+        timestamp (a UTC datetime, by default now).
+        """
+        for members in self._members.itervalues():
+            members.sort(key=lambda m: m.accession)
+        keys = set(self._gene_families) | set(self._genes) | set(self._dna)
+        self._accession_keys = dict((k.lower(), k) for k in keys)
+        self._accessions = sorted(self._accession_keys)
+
+        h = hashlib.sha1()
+        for family in self.families():
+            h.update("%s\t%s\n" % (family.abbrev, family.name))
+            for m in self._members[family.abbrev]:
+                h.update("\t%s\t%s\t%s\t%s\n" %
+                  (m.accession, m.name, m.species, m.description))
+        self.version = h.hexdigest()[:12]
+        self.timestamp = timestamp or datetime.datetime.utcnow()
+        return self
+
+    # -- lookups -------------------------------------------------------------
+
+    def families(self):
+        return sorted(self._families.itervalues(), key=lambda f: f.abbrev)
+
+    def family(self, abbrev):
+        return self._families.get(abbrev)
+
+    def members(self, abbrev):
+        return self._members.get(abbrev, [])
+
+    def gene(self, accession):
+        return self._genes.get(accession)
+
+    def dna(self, accession):
+        return self._dna.get(accession)
+
+    def families_for(self, accession):
+        """Families a gene belongs to, skipping ones not in the catalog."""
+        return [self._families[a] for a in self._gene_families.get(accession, ())
+                if a in self._families]
+
+    def accessions_with_prefix(self, prefix, limit=20):
+        """Up to limit accessions starting with prefix, ignoring case."""
+        prefix = prefix.lower()
+        i = bisect.bisect_left(self._accessions, prefix)
+        found = []
+        for key in self._accessions[i:i + limit]:
+            if not key.startswith(prefix):
+                break
+            found.append(self._accession_keys[key])
+        return found
+
+
+def from_family_xml(directory):
+    """Load families and their member accessions from <family> XML files."""
+    catalog = Catalog()
+    paths = sorted(glob.glob(os.path.join(directory, '*.xml')))
+    for path in paths:
+        root = ElementTree.parse(path).getroot()
+        abbrev = root.findtext('abrev') or \
+          os.path.splitext(os.path.basename(path))[0]
+        catalog.add_family(Family(abbrev, root.findtext('name') or abbrev))
+        for genome in root.findall('genome'):
+            species = genome.get('name', '')
+            for sequence in genome.findall('sequence'):
+                catalog.add_member(abbrev,
+                  Member(sequence.text.strip(), species=species))
+    return catalog.finish(paths and datetime.datetime.utcfromtimestamp(
+      max(os.path.getmtime(path) for path in paths)) or None)
+
+
+def from_sample_data():
+    catalog = Catalog()
+    for abbrev, family in SAMPLE_FAMILIES.items():
+        catalog.add_family(Family(abbrev, family['name'],
+          SAMPLE_TREES.get(abbrev, {}).get('tree', '')))
+    for abbrev, members in SAMPLE_MEMBERS.items():
+        for accession, fields in members.items():
+            fields = dict((k, v) for k, v in fields.items()
+                          if k in Member.__slots__)
+            catalog.add_member(abbrev, Member(accession, **fields))
+    for accession, abbrevs in SAMPLE_GENE_TO_FAMILY.items():
+        catalog.link(accession, abbrevs)
+    for accession, fields in SAMPLE_GENES.items():
+        fields = dict(fields)
+        ids = fields.pop('IDs', '')
+        fields = dict((k, v) for k, v in fields.items()
+                      if k in Member.__slots__)
+        catalog.add_gene(Gene(accession, ids=ids, **fields))
+    for accession, fields in SAMPLE_DNA.items():
+        catalog.add_dna(Dna(accession, **fields))
+    return catalog.finish()
+
+
+def load():
+    directory = getattr(settings, 'GFAM2_FAMILIES_DIR', None)
+    if directory:
+        return from_family_xml(directory)
+    return from_sample_data()
+
+
+SAMPLE_FAMILIES = {
+     'S1K': {'name': 'Sugar 1-kiases', },
+     'UGP': {'name': 'UDP-glucose pyrophosphorylases', },
+     'GMP': {'name': 'GDP-mannose pyrophosphorylase', },
+   }
+
+SAMPLE_TREES = {
+     'S1K': {'tree': 'S1K tree image', },
+     'UGP': {'tree': 'UDP-tree image', },
+     'GMP': {'tree': 'GDP-tree image', },
+   }
+
+SAMPLE_MEMBERS = {
+  'S1K':
+    {
+      'At1g02000': {
+          'name': 'GAE2',
+          'species': 'Arabidopsis thaliana',
+          'description': 'NAD-dependent epimerase/dehydratase family protein'},
+
+       'At1g08200': {
+          'name': 'AXS2',
+          'species': 'Arabidopsis thaliana',
+          'description': 'expressed protein'},
+    },
+
+  'GMP':
+    {
+      'At1g12780': {
+         'name': 'UGE1',
+         'length': '1781',
+         'fullname': 'UDP-D-GLUCURONATE 4-EPIMERASE 2',
+         'structure': 'Image of GAE2 gene structure',
+         'sequence': 'AGAAAGGAAAGGAAAGAAAGAAAACAAAAG',
+         'species': 'Arabidopsis thaliana',
+         'description': 'UDP-glucose ' + \
+           '4-epimerase/UDP-galactose 4-epimerase/Galactowaldenase'},
+    },
+
+  'UGP':
+    {
+    },
+}
+
+SAMPLE_GENE_TO_FAMILY = {
+  'At1g12780': ['GMP'],
+  'At1234567': [],
+  'At1g08200': ['S1K', 'NSI'],
+  'At1g02000': ['S1K', 'NSI'],
+}
+
+SAMPLE_GENES = {
+  'At1g02000': {
+      'name': 'GAE2',
+      'length': '1781',
+      'fullname': 'UDP-D-GLUCURONATE 4-EPIMERASE 2',
+      'structure': 'Image of GAE2 gene structure',
+      'sequence': 'AGAAAGGAAAGGAAAGAAAGAAAACAAAAG',
+      'species':  'Arabidopsis thaliana',
+      'IDs': '[51779.t00015; 68414.m00118; 68414.t00105; At1g02000.1; ' + \
+	   'F22M8.13; GAE2]',
+      'description': 'UDP-glucose ' + \
+           '4-epimerase/UDP-galactose 4-epimerase/Galactowaldenase',
+   },
+}
+
+SAMPLE_DNA = {
+  'At1g02000.1': {
+      'structure': 'GAE2',#an image, diff. from 'gene' page
+      'sequence': 'MSHLDDIPSTPGKFKMMDKSPFFLHRTRWQ',
+      'features': '''PFAM	39..129
+                     /description="tRNA pseudouridine synthase"
+                     /evalue="8.9"
+                     /family="PseudoU_synth_1"
+                     PFAM	52..143
+                     /description="MerE protein"
+                     /evalue="2.3"
+                     /family="MerE"''',
+   },
+}
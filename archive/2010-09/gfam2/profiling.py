@@ -0,0 +1,242 @@
+"""
+Request profiling for the gfam2 and navigator sites.
+
+ProfilingMiddleware times a sample of the requests (a fraction
+settings.PROFILING_SAMPLE_RATE of them) and splits their wall time into
+
+    sql         time in cursor.execute() / executemany(), and query count
+    template    time in Template.render(), less the queries it ran
+    subprocess  time waiting for child processes (the Perl renderer)
+
+Queries slower than settings.PROFILING_SLOW_QUERY seconds are logged to
+the 'gfam.profiling' logger with the line of site code that ran them.
+
+The last PROFILING_WINDOW samples are kept per URL pattern of urls.py,
+and settings.PROFILING_STATS_URL (/_stats) answers requests from
+INTERNAL_IPS with their p50, p95 and p99 as JSON.
+
+A response that streams its content (the FASTA downloads) is timed up
+to the return of its view, not while it is sent.
+
+The timers are installed when the middleware is loaded, and only do
+anything for sampled requests.  With a sample rate of 0 the middleware
+removes itself and nothing is installed.  Both projects use it by
+adding 'gfam2.profiling.ProfilingMiddleware' first in MIDDLEWARE_CLASSES:
+gfam2/settings.py does, and gfam/settings_profiling.py has the lines to
+add to the navigator's settings.py.
+"""
+
+import logging
+import os.path
+import random
+import subprocess
+import threading
+import time
+import traceback
+from collections import deque
+
+import django
+from django.conf import settings
+from django.core import urlresolvers
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends import BaseDatabaseWrapper
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template import Template
+from django.utils import simplejson
+
+SAMPLE_RATE = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+SLOW_QUERY = getattr(settings, 'PROFILING_SLOW_QUERY', 0.5)
+WINDOW = getattr(settings, 'PROFILING_WINDOW', 1000)
+STATS_URL = getattr(settings, 'PROFILING_STATS_URL', '/_stats')
+
+KINDS = ('sql', 'template', 'subprocess')
+PERCENTILES = (50, 95, 99)
+
+log = logging.getLogger('gfam.profiling')
+
+_local = threading.local()
+
+# URL pattern -> deque of (wall, sql, queries, template, subprocess)
+samples = {}
+
+_DJANGO = os.path.dirname(os.path.abspath(django.__file__))
+
+
+class Profile(object):
+    """Times of one request, by kind, without the time of nested kinds."""
+    def __init__(self):
+        self.start = time.time()
+        self.times = dict.fromkeys(KINDS, 0.0)
+        self.queries = 0
+        self.stack = []     # [kind, time of nested sections]
+
+    def enter(self, kind):
+        self.stack.append([kind, 0.0])
+
+    def leave(self, elapsed):
+        kind, nested = self.stack.pop()
+        self.times[kind] += elapsed - nested
+        if self.stack:
+            self.stack[-1][1] += elapsed
+
+    def active(self, kind):
+        for section in self.stack:
+            if section[0] == kind:
+                return True
+        return False
+
+
+def timed(kind, func):
+    """Wrap func to count its time as kind in the current Profile."""
+    def wrapper(*args, **kwargs):
+        profile = getattr(_local, 'profile', None)
+        if profile is None or profile.active(kind):
+            return func(*args, **kwargs)
+        profile.enter(kind)
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.leave(time.time() - start)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.profiled = True
+    return wrapper
+
+
+def call_site():
+    """'file:line in function' of the innermost caller outside Django."""
+    here = os.path.splitext(os.path.abspath(__file__))[0]
+    for path, line, function, text in reversed(traceback.extract_stack()):
+        path = os.path.abspath(path)
+        if not path.startswith(_DJANGO) and \
+          os.path.splitext(path)[0] != here:
+            return "%s:%d in %s" % (path, line, function)
+    return "?"
+
+
+class ProfilingCursor(object):
+    def __init__(self, cursor, profile):
+        self.cursor = cursor
+        self.profile = profile
+
+    def _timed(self, method, sql, params, count):
+        profile = self.profile
+        profile.enter('sql')
+        start = time.time()
+        try:
+            return method(sql, params)
+        finally:
+            elapsed = time.time() - start
+            profile.leave(elapsed)
+            profile.queries += count
+            if elapsed > SLOW_QUERY:
+                log.warning("%.3f s: %s %r at %s", elapsed, sql, params,
+                  call_site())
+
+    def execute(self, sql, params=()):
+        return self._timed(self.cursor.execute, sql, params, 1)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list, 1)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def _cursor(func):
+    def cursor(self):
+        cursor = func(self)
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            return cursor
+        return ProfilingCursor(cursor, profile)
+    cursor.profiled = True
+    return cursor
+
+
+def install():
+    """Wrap the database cursor, template rendering and subprocesses."""
+    if getattr(BaseDatabaseWrapper.cursor, 'profiled', False):
+        return
+    BaseDatabaseWrapper.cursor = _cursor(BaseDatabaseWrapper.cursor)
+    Template.render = timed('template', Template.render)
+    for name in ('communicate', 'wait'):
+        setattr(subprocess.Popen, name,
+          timed('subprocess', getattr(subprocess.Popen, name)))
+
+
+def _url_pattern(patterns, path):
+    for pattern in patterns:
+        match = pattern.regex.search(path)
+        if match is None:
+            continue
+        if isinstance(pattern, urlresolvers.RegexURLResolver):
+            rest = _url_pattern(pattern.url_patterns, path[match.end():])
+            if rest is not None:
+                return pattern.regex.pattern + rest
+        else:
+            return pattern.regex.pattern
+    return None
+
+
+def url_pattern(path):
+    """The urls.py pattern that matches path, or None."""
+    resolver = urlresolvers.get_resolver(None)
+    match = resolver.regex.search(path)
+    return match and _url_pattern(resolver.url_patterns, path[match.end():])
+
+
+def record(pattern, profile):
+    wall = time.time() - profile.start
+    rows = samples.get(pattern)
+    if rows is None:
+        rows = samples.setdefault(pattern, deque(maxlen=WINDOW))
+    rows.append((wall, profile.times['sql'], profile.queries,
+      profile.times['template'], profile.times['subprocess']))
+
+
+def percentiles(values):
+    values = sorted(values)
+    return dict(("p%d" % p, values[min(len(values) - 1,
+      len(values) * p // 100)]) for p in PERCENTILES)
+
+
+def stats():
+    """{pattern: {'count': n, 'wall': {'p50': ...}, 'sql': ...}}"""
+    result = {}
+    for pattern, rows in samples.items():
+        rows = list(rows)
+        columns = zip(*rows)
+        result[pattern] = dict(zip(
+          ('wall', 'sql', 'queries', 'template', 'subprocess'),
+          [percentiles(column) for column in columns]))
+        result[pattern]['count'] = len(rows)
+    return result
+
+
+class ProfilingMiddleware(object):
+    def __init__(self):
+        if not SAMPLE_RATE:
+            raise MiddlewareNotUsed
+        install()
+
+    def process_request(self, request):
+        _local.profile = None
+        if request.path_info == STATS_URL:
+            if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+                return HttpResponseForbidden()
+            return HttpResponse(simplejson.dumps(stats(), indent=1,
+              sort_keys=True), mimetype='application/json')
+        if random.random() < SAMPLE_RATE:
+            _local.profile = Profile()
+
+    def process_response(self, request, response):
+        profile = getattr(_local, 'profile', None)
+        if profile is not None:
+            _local.profile = None
+            record(url_pattern(request.path_info) or '(none)', profile)
+        return response
@@ -62,13 +62,21 @@ ADMIN_MEDIA_PREFIX = '/media/'
 ###SECRET_KEY = 'DELETED'
 
 # List of callables that know how to import templates from various sources.
+# The cached loader keeps every compiled template for the life of the process.
 TEMPLATE_LOADERS = (
-    'django.template.loaders.filesystem.Loader',
-    'django.template.loaders.app_directories.Loader',
-#     'django.template.loaders.eggs.Loader',
+    ('django.template.loaders.cached.Loader', (
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    #     'django.template.loaders.eggs.Loader',
+    )),
 )
 
+# Backend for the {% cache %} fragments (family navigation, member tables).
+# Fragment keys include the catalog version, see gfam2/catalog.py.
+CACHE_BACKEND = 'locmem://?max_entries=5000'
+
 MIDDLEWARE_CLASSES = (
+    'gfam2.profiling.ProfilingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -76,6 +84,13 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
 )
 
+# Request profiling, see gfam2/profiling.py.  A sample rate of 0 turns the
+# middleware off; the stats page answers INTERNAL_IPS only.
+PROFILING_SAMPLE_RATE = 0.05
+PROFILING_SLOW_QUERY = 0.5      # seconds
+PROFILING_STATS_URL = '/_stats'
+INTERNAL_IPS = ('127.0.0.1',)
+
 ROOT_URLCONF = 'gfam2.urls'
 
 TEMPLATE_DIRS = (
@@ -96,3 +111,18 @@ INSTALLED_APPS = (
     # Uncomment the next line to enable admin documentation:
     # 'django.contrib.admindocs',
 )
+
+# Directory of <family> XML files (e.g. web/Cellwall/data/families) that
+# gfam2/catalog.py loads at startup. The built-in sample families are
+# used when this is not set.
+#GFAM2_FAMILIES_DIR = ''
+
+# Directory of family alignments (<family>.mul, .fasta or .aln, aligned
+# FASTA) that gfam2/trees.py builds the tree drawings from, and where it
+# keeps the Newick trees it built.
+#GFAM2_ALIGNMENTS_DIR = ''
+#GFAM2_TREE_DIR = '/var/cache/gfam2/trees'
+
+# Where gfam2/alignments.py keeps the alignments converted for
+# /alignment/<family>.json and .fasta, which serve windows of them.
+#GFAM2_ALIGNMENT_STORE = '/var/cache/gfam2/alignments'
@@ -0,0 +1,365 @@
+"""
+Family trees built from the family alignments.
+
+The alignment of a family is <abbrev>.mul, .fasta or .aln (aligned
+FASTA, as the Perl site's clustalw search writes to Align/) in
+settings.GFAM2_ALIGNMENTS_DIR.  Its tree is built with
+
+    distances  Kimura-corrected p-distance over the columns where both
+               sequences have a residue, from one-hot products in NumPy
+    topology   fast neighbor joining, O(n) NumPy work per step
+
+and stored as Newick in settings.GFAM2_TREE_DIR under the SHA-1 of the
+alignment, so it is only built again when the alignment changes.
+
+The SVG drawing is made when the tree page first asks for it and kept in
+the Django cache under tree_key(), which holds the catalog version and
+the size and mtime of the alignment; later requests are a cache read.
+"""
+
+import hashlib
+import math
+import os
+import re
+import tempfile
+from xml.sax.saxutils import escape
+
+import numpy
+
+from django.conf import settings
+from django.core.cache import cache
+
+ALIGNMENTS_DIR = getattr(settings, 'GFAM2_ALIGNMENTS_DIR', None)
+TREE_DIR = getattr(settings, 'GFAM2_TREE_DIR',
+                   os.path.join(tempfile.gettempdir(), 'gfam2-trees'))
+EXTENSIONS = ('.mul', '.fasta', '.aln')
+
+# Part of the Newick file names and cache keys; bump when the method or
+# the drawing changes
+TREE_VERSION = 1
+
+CACHE_TIMEOUT = 30 * 24 * 60 * 60
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+COLUMNS = 256
+
+# Rows of the NJ criterion computed at a time for the first partners
+NJ_ROWS = 256
+
+# Distance of sequences too different to correct (p above about 0.85)
+MAX_DISTANCE = 5.0
+
+WIDTH = 600
+ROW = 14
+PAD = 10
+CHAR = 7
+
+
+# -- alignments --------------------------------------------------------------
+
+def alignment_path(abbrev):
+    """The alignment file of a family, or None."""
+    if not ALIGNMENTS_DIR:
+        return None
+    for extension in EXTENSIONS:
+        path = os.path.join(ALIGNMENTS_DIR, abbrev + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_alignment(data):
+    """(names, rows) of aligned FASTA text; names are header first words."""
+    names, rows = [], []
+    for record in data.split('>')[1:]:
+        header, _, sequence = record.partition('\n')
+        names.append((header.split() or [''])[0])
+        rows.append(''.join(sequence.split()).upper())
+    return names, rows
+
+
+def _code_table():
+    table = numpy.zeros(256, numpy.uint8)
+    for i, residue in enumerate(AMINO_ACIDS):
+        table[ord(residue)] = i + 1
+    table[[ord(c) for c in 'BJOUXZ*']] = len(AMINO_ACIDS) + 1
+    return table
+
+CODES = _code_table()
+
+
+def encode(rows):
+    """uint8 residue codes: 0 gap, 21 for residues that never match."""
+    width = max(len(row) for row in rows)
+    codes = numpy.zeros((len(rows), width), numpy.uint8)
+    for i, row in enumerate(rows):
+        codes[i, :len(row)] = CODES[numpy.frombuffer(row, numpy.uint8)]
+    return codes
+
+
+def _one_hot(codes):
+    """float32 indicators of the (column, residue) pairs in codes."""
+    n, width = codes.shape
+    keys = codes.astype(numpy.int32) + \
+        numpy.arange(width, dtype=numpy.int32) * (len(AMINO_ACIDS) + 2)
+    known = (codes > 0) & (codes <= len(AMINO_ACIDS))
+    present, index = numpy.unique(keys[known], return_inverse=True)
+    hot = numpy.zeros((n, len(present)), numpy.float32)
+    hot[numpy.nonzero(known)[0], index] = 1
+    return hot
+
+
+def distances(codes, columns=COLUMNS):
+    """Kimura protein distances between all rows of codes."""
+    n, width = codes.shape
+    aligned = numpy.zeros((n, n), numpy.float32)
+    identical = numpy.zeros((n, n), numpy.float32)
+    for start in xrange(0, width, columns):
+        chunk = codes[:, start:start + columns]
+        residues = (chunk > 0).astype(numpy.float32)
+        aligned += numpy.dot(residues, residues.T)
+        hot = _one_hot(chunk)
+        identical += numpy.dot(hot, hot.T)
+    p = 1 - identical.astype(numpy.float64) / numpy.maximum(aligned, 1)
+    p[aligned == 0] = 1
+    d = -numpy.log(numpy.maximum(1 - p - 0.2 * p * p,
+                                 math.exp(-MAX_DISTANCE)))
+    numpy.fill_diagonal(d, 0)
+    return d
+
+
+# -- neighbor joining --------------------------------------------------------
+
+# A node is [name, branch length, children]
+
+def _criterion(d, sums, n, rows):
+    """The NJ criterion of rows against the first n nodes."""
+    q = d[rows, :n] * (n - 2)
+    q -= sums[:n]
+    q -= sums[rows, None]
+    return q
+
+
+def neighbor_joining(d, names):
+    """
+    The NJ tree of distance matrix d, rooted on the midpoint of its last
+    branch.  Each node keeps the partner with which its criterion was
+    least when it was made, and a step joins the best of those pairs
+    (Elias and Lagergren's fast neighbor joining): O(n) work per step
+    instead of a scan of the whole matrix, and the same tree as NJ when
+    the distances fit a tree.
+    """
+    nodes = [[name, None, []] for name in names]
+    n = len(nodes)
+    if n == 1:
+        return nodes[0]
+    sums = numpy.array(d, numpy.float64).sum(axis=1)
+    d = numpy.array(d, numpy.float32)
+    numpy.fill_diagonal(d, numpy.inf)
+    nearest = numpy.empty(n, numpy.intp)
+    for start in xrange(0, n, NJ_ROWS):
+        rows = numpy.arange(start, min(start + NJ_ROWS, n))
+        nearest[rows] = _criterion(d, sums, n, rows).argmin(axis=1)
+
+    while n > 2:
+        rows = numpy.arange(n)
+        q = (n - 2) * d[rows, nearest[:n]] - sums[:n] - sums[nearest[:n]]
+        k = int(q.argmin())
+        i, j = sorted((k, int(nearest[k])))
+        di = d[i, :n].astype(numpy.float64)
+        dj = d[j, :n].astype(numpy.float64)
+        di[i] = dj[j] = 0
+        dij = di[j]
+        li = 0.5 * dij + (sums[i] - sums[j]) / (2 * (n - 2))
+        nodes[i][1], nodes[j][1] = li, dij - li
+        new = 0.5 * (di + dj - dij)
+        sums[:n] += new - di - dj
+        sums[i] = new.sum() - new[j]
+        d[i, :n] = d[:n, i] = new
+        d[i, i] = numpy.inf
+        nodes[i] = [None, None, [nodes[i], nodes[j]]]
+
+        # The last node takes the place of j
+        last = n - 1
+        if j != last:
+            d[j, :n] = d[last, :n]
+            d[:n, j] = d[:n, last]
+            d[j, j] = numpy.inf
+            sums[j] = sums[last]
+            nearest[j] = nearest[last]
+            nodes[j] = nodes[last]
+        n -= 1
+
+        # Partners of i or j now pair with the new node
+        near = nearest[:n]
+        joined = (near == i) | (near == j)
+        if j != last:
+            near[near == last] = j
+        near[joined] = i
+        if n > 2:
+            nearest[i] = _criterion(d, sums, n, [i])[0].argmin()
+
+    nodes[0][1] = nodes[1][1] = 0.5 * float(d[0, 1])
+    return [None, None, [nodes[0], nodes[1]]]
+
+
+# -- Newick ------------------------------------------------------------------
+
+_LABEL = re.compile(r"^[^\s(),:;'\[\]]+$")
+_TOKEN = re.compile(r"\s*('(?:[^']|'')*'|[(),:;]|[^\s(),:;]+)")
+
+
+def _label(name):
+    if name is None:
+        return ''
+    if _LABEL.match(name):
+        return name
+    return "'%s'" % name.replace("'", "''")
+
+
+def to_newick(root):
+    out = []
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, basestring):
+            out.append(item)
+            continue
+        name, length, children = item
+        tail = _label(name)
+        if length is not None:
+            tail += ':%.5f' % max(length, 0.0)
+        if children:
+            out.append('(')
+            stack.append(')' + tail)
+            for k in xrange(len(children) - 1, -1, -1):
+                stack.append(children[k])
+                if k:
+                    stack.append(',')
+        else:
+            out.append(tail)
+    return ''.join(out) + ';'
+
+
+def parse_newick(text):
+    root = node = [None, None, []]
+    parents = []
+    length = False
+    for token in _TOKEN.findall(text):
+        if token == '(':
+            child = [None, None, []]
+            node[2].append(child)
+            parents.append(node)
+            node = child
+        elif token == ',':
+            node = [None, None, []]
+            parents[-1][2].append(node)
+        elif token == ')':
+            node = parents.pop()
+        elif token == ':':
+            length = True
+            continue
+        elif token == ';':
+            break
+        elif length:
+            node[1] = float(token)
+        elif token.startswith("'"):
+            node[0] = token[1:-1].replace("''", "'")
+        else:
+            node[0] = token
+        length = False
+    return root
+
+
+def build_tree(data):
+    """Newick of the NJ tree of aligned FASTA text."""
+    names, rows = read_alignment(data)
+    if not rows:
+        return ';'
+    return to_newick(neighbor_joining(distances(encode(rows)), names))
+
+
+def family_newick(path):
+    """The Newick tree of an alignment file, built once per content."""
+    data = open(path, 'rb').read()
+    digest = hashlib.sha1(data).hexdigest()
+    tree_path = os.path.join(TREE_DIR, '%s.v%d.nwk' % (digest, TREE_VERSION))
+    if os.path.exists(tree_path):
+        return open(tree_path).read()
+    newick = build_tree(data)
+    if not os.path.isdir(TREE_DIR):
+        os.makedirs(TREE_DIR)
+    fd, tmp = tempfile.mkstemp(dir=TREE_DIR)
+    with os.fdopen(fd, 'w') as f:
+        f.write(newick)
+    os.rename(tmp, tree_path)
+    return newick
+
+
+# -- drawing -----------------------------------------------------------------
+
+def render_svg(root):
+    """A rectangular phylogram of a tree, leaves one ROW apart."""
+    # Depth first: x of every node, y of the leaves
+    x, y, order = {}, {}, []
+    leaves = 0
+    stack = [(root, 0.0)]
+    while stack:
+        node, depth = stack.pop()
+        depth += max(node[1] or 0.0, 0.0)
+        x[id(node)] = depth
+        order.append(node)
+        if node[2]:
+            stack.extend((child, depth) for child in reversed(node[2]))
+        else:
+            y[id(node)] = PAD + leaves * ROW + ROW / 2
+            leaves += 1
+    for node in reversed(order):
+        if node[2]:
+            y[id(node)] = (y[id(node[2][0])] + y[id(node[2][-1])]) / 2.0
+
+    scale = WIDTH / (max(x.values()) or 1.0)
+    names = [node[0] or '' for node in order if not node[2]]
+    width = PAD * 2 + WIDTH + CHAR * max([len(n) for n in names] or [0])
+    height = PAD * 2 + leaves * ROW
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+           'font-family="sans-serif" font-size="11">' % (width, height),
+           '<g stroke="black" fill="none">']
+    labels = []
+    for node in order:
+        nx, ny = PAD + x[id(node)] * scale, y[id(node)]
+        if node[2]:
+            out.append('<path d="M%.1f %.1fV%.1f"/>' % (nx,
+                       y[id(node[2][0])], y[id(node[2][-1])]))
+            for child in node[2]:
+                out.append('<path d="M%.1f %.1fH%.1f"/>' % (nx,
+                           y[id(child)], PAD + x[id(child)] * scale))
+        else:
+            labels.append('<text x="%.1f" y="%.1f">%s</text>' % (nx + 4,
+                          ny + 4, escape(node[0] or '')))
+    out.append('</g>')
+    out.extend(labels)
+    out.append('</svg>')
+    return '\n'.join(out)
+
+
+def tree_key(abbrev, version):
+    """Cache key of the drawing of a family's tree, or None if it has none."""
+    path = alignment_path(abbrev)
+    if path is None:
+        return None
+    st = os.stat(path)
+    return 'gfam2.tree.v%d.%s.%s.%d.%d' % (TREE_VERSION, version, abbrev,
+                                           st.st_size, st.st_mtime)
+
+
+def family_svg(abbrev, version):
+    """SVG of a family's tree, drawn once per tree_key(); None if none."""
+    key = tree_key(abbrev, version)
+    if key is None:
+        return None
+    svg = cache.get(key)
+    if svg is None:
+        svg = render_svg(parse_newick(family_newick(alignment_path(abbrev))))
+        cache.set(key, svg, CACHE_TIMEOUT)
+    return svg
@@ -21,7 +21,9 @@ urlpatterns = patterns('',
     (r'^families/?$', families),
     (r'^summary/([a-z,A-Z,0-9]*)$', summary),
     (r'^tree/([a-z,A-Z,0-9]*)$', tree),
+    (r'^tree/([a-z,A-Z,0-9]*)\.svg$', tree_svg),
     (r'^structure/([a-z,A-Z,0-9]*)$', structure),
+    (r'^alignment/([a-z,A-Z,0-9]*)\.(json|fasta)$', alignment_window),
 
     (r'^([a-z,A-Z,0-9,.]*)()$', gene), # Default is protein
     (r'^([a-z,A-Z,0-9]*)/(protein)$', gene),
@@ -1,166 +1,186 @@
+from django.conf import settings
 from django.template.loader import get_template
 from django.template import Context
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render_to_response
+from django.utils.cache import patch_cache_control
+from django.utils import simplejson
+from django.views.decorators.http import condition
+
+from gfam2 import alignments, trees
+from gfam2.catalog import load as load_catalog
 
 ALIGNMENTS_URL_PREFIX = \
   "http://biocluster.ucr.edu/~alevchuk/sasha/020-sasha/examples" #to Alignment page
 
-families_data = {
-     'S1K': {'name': 'Sugar 1-kiases', },
-     'UGP': {'name': 'UDP-glucose pyrophosphorylases', },
-     'GMP': {'name': 'GDP-mannose pyrophosphorylase', },
-   }
-
-tree_data = {
-     'S1K': {'tree': 'S1K tree image', },
-     'UGP': {'tree': 'UDP-tree image', },
-     'GMP': {'tree': 'GDP-tree image', },
-   }
-
-structure_data = {
-  'structure': {
-     'At1g02000': 'GAE2',
-     'At1g08200': 'AXS2',
-     'At1g12780': 'UGE1',
-   },
-} 
-
-members_data = {
-  'S1K': 
-    {
-      'At1g02000': {
-          'name': 'GAE2',
-          'species': 'Arabidopsis thaliana',
-          'description': 'NAD-dependent epimerase/dehydratase family protein'},
-         
-       'At1g08200': {
-          'name': 'AXS2',
-          'species': 'Arabidopsis thaliana',
-          'description': 'expressed protein'},
-    },
-
-  'GMP':
-    {
-      'At1g12780': {
-         'name': 'UGE1',
-         'length': '1781',
-         'fullname': 'UDP-D-GLUCURONATE 4-EPIMERASE 2',
-         'structure': 'Image of GAE2 gene structure',
-         'sequence': 'AGAAAGGAAAGGAAAGAAAGAAAACAAAAG',
-         'species': 'Arabidopsis thaliana',
-         'description': 'UDP-glucose ' + \
-           '4-epimerase/UDP-galactose 4-epimerase/Galactowaldenase'},
-    },
-
-  'UGP':
-    {
-    },
-} 
-
-gene_to_family_data = {
-  'At1g12780': ['GMP'],
-  'At1234567': [],
-  'At1g08200': ['S1K', 'NSI'],
-  'At1g02000': ['S1K', 'NSI'],
-}
-
-gene_data = {
-  'At1g02000': {
-      'name': 'GAE2',
-      'length': '1781',
-      'fullname': 'UDP-D-GLUCURONATE 4-EPIMERASE 2',
-      'structure': 'Image of GAE2 gene structure',
-      'sequence': 'AGAAAGGAAAGGAAAGAAAGAAAACAAAAG',
-      'species':  'Arabidopsis thaliana',
-      'IDs': '[51779.t00015; 68414.m00118; 68414.t00105; At1g02000.1; ' + \
-	   'F22M8.13; GAE2]',
-      'description': 'UDP-glucose ' + \
-           '4-epimerase/UDP-galactose 4-epimerase/Galactowaldenase',
-#      'Features': '''1..1781	
-#			/GO="ID: 0003824; Type: function; catalytic activity"
-#   		/GO="ID: 0009225; Type: process; nucleotide-sugar metabolism"
-#  		/chromosome="1"
-#   		/clone="68414"
-#   		/clone_name="CHR1v01212004"
-#   		/end3="347592"
-#   		/end5="345812"
-#   		/strand="positive"''',
-#     'MODEL': '''241..1545	
-#   		/cdna_support="DBXRef: GSLTFB23ZC03; 
-#   			-Matching gene and cDNA alignment are identical."''',
-#     'EXON': '''1..1781	
-#   		/model="68414.m00118"''',
-#     'CDS': '''241..1545	
-#   		/PFAM="39..129 PseudoU_synth_1 8.9 tRNA pseudouridine synthase"
-#   		/PFAM="52..143 MerE 2.3 MerE protein"''',
-#     'LEFT_UTR': '''1..240	
-#   		/model="68414.m00118"''',
-#     'RIGHT_UTR': '''1546..1781	
-#   		/model="68414.m00118"''',
-   },
-}
-
-dna_data = {
-  'At1g02000.1': {	 
-      'structure': 'GAE2',#an image, diff. from 'gene' page
-      'sequence': 'MSHLDDIPSTPGKFKMMDKSPFFLHRTRWQ',
-      'features': '''PFAM	39..129	
-                     /description="tRNA pseudouridine synthase"
-                     /evalue="8.9"
-                     /family="PseudoU_synth_1"
-                     PFAM	52..143	
-                     /description="MerE protein"
-                     /evalue="2.3"
-                     /family="MerE"''',
-   },
-} 
- 
+# Where the navigator (gfam/) is served, for its similar sequences pages
+NAVIGATOR_URL = getattr(settings, 'GFAM2_NAVIGATOR_URL', '')
+
+# Loaded once per process; views pass templates only what they render
+catalog = load_catalog()
+
+# Pages only change when the catalog does, and their ETag is its version
+CACHE_MAX_AGE = getattr(settings, 'GFAM2_CACHE_MAX_AGE', 24 * 3600)
+
+# Largest alignment window, in residues, and the default one
+ALIGNMENT_MAX_CELLS = getattr(settings, 'GFAM2_ALIGNMENT_MAX_CELLS', 250000)
+ALIGNMENT_ROWS = 100
+ALIGNMENT_COLUMNS = 200
+
+class LazyList(object):
+    """
+    A list that is only built when a template iterates over it, so that
+    lists inside {% cache %} fragments cost nothing on a cache hit.
+    """
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __iter__(self):
+        return iter(self.func(*self.args))
+
+def render(template_name, context):
+    """Render a template with the family navigation in its context."""
+    context['families'] = LazyList(catalog.families)
+    context['catalog_version'] = catalog.version
+    t = get_template(template_name)
+    return HttpResponse(t.render(Context(context)))
+
+def catalog_page(view):
+    """
+    Answer conditional GETs for a view from the catalog version and
+    timestamp, without calling it, and let clients cache its pages.
+    """
+    conditional = condition(lambda request, *args: catalog.version,
+                            lambda request, *args: catalog.timestamp)(view)
+    def wrapper(request, *args):
+        response = conditional(request, *args)
+        if response.status_code in (200, 304):
+            patch_cache_control(response, public=True, max_age=CACHE_MAX_AGE)
+        return response
+    wrapper.__name__ = view.__name__
+    return wrapper
+
+def get_family(abbrev):
+    family = catalog.family(abbrev)
+    if family is None:
+        raise Http404("No such family: %s" % abbrev)
+    return family
+
+@catalog_page
 def families(request):
 
-    t = get_template('families.html')
-    html = t.render(Context({'families': families_data}))
-    return HttpResponse(html)
+    return render('families.html', {})
 
+@catalog_page
 def summary(request, abbrev):
 
-    t = get_template('summary.html')
-    html = t.render(Context({
+    family = get_family(abbrev)
+    return render('summary.html', {
                              'ALIGNMENTS_URL_PREFIX': ALIGNMENTS_URL_PREFIX,
-                             'families': families_data,
-                             'members': members_data[abbrev],
-                             'FamilyName': families_data[abbrev]['name'],
+                             'members': LazyList(catalog.members, abbrev),
+                             'FamilyName': family.name,
                              'FamilyAbbrev': abbrev,
-                             },
-                   ))
-    return HttpResponse(html)
+                             })
 
+@catalog_page
 def tree(request, abbrev):
  
-    t = get_template('tree.html')
-    html = t.render(Context({
+    family = get_family(abbrev)
+    return render('tree.html', {
                              'ALIGNMENTS_URL_PREFIX': ALIGNMENTS_URL_PREFIX,
-                             'families': families_data,
-                             'FamilyName': families_data[abbrev]['name'],
+                             'FamilyName': family.name,
                              'FamilyAbbrev': abbrev,
-                             'FamilyTree': tree_data[abbrev]['tree'],
-			     },
-                   ))
-    return HttpResponse(html)
-
+                             'FamilyTree': family.tree,
+			     })
+
+def tree_etag(request, abbrev):
+    return trees.tree_key(abbrev, catalog.version)
+
+@condition(etag_func=tree_etag)
+def tree_svg(request, abbrev):
+    """The family tree drawing, built from its alignment on first use."""
+    get_family(abbrev)
+    svg = trees.family_svg(abbrev, catalog.version)
+    if svg is None:
+        raise Http404("No alignment for family: %s" % abbrev)
+    response = HttpResponse(svg, mimetype='image/svg+xml')
+    patch_cache_control(response, public=True, max_age=CACHE_MAX_AGE)
+    return response
+
+def window_range(request, name, default, total):
+    """
+    The slice of a 'first-last' parameter (1-based, inclusive, clipped to
+    total), or None when it is malformed or starts after total.
+    """
+    value = request.GET.get(name)
+    if value is None:
+        return slice(0, min(default, total))
+    try:
+        first, last = [int(i) for i in value.split('-')]
+    except ValueError:
+        return None
+    if first < 1 or last < first or first > total:
+        return None
+    return slice(first - 1, min(last, total))
+
+def alignment_etag(request, abbrev, format):
+    return alignments.store_key(abbrev)
+
+@condition(etag_func=alignment_etag)
+def alignment_window(request, abbrev, format):
+    """
+    A window of a family alignment: ?rows=1-100&columns=1-200 (the
+    defaults), as FASTA or as JSON with the consensus and conservation
+    of its columns.
+    """
+    get_family(abbrev)
+    alignment = alignments.family_alignment(abbrev)
+    if alignment is None:
+        raise Http404("No alignment for family: %s" % abbrev)
+    rows = window_range(request, 'rows', ALIGNMENT_ROWS, alignment.rows)
+    columns = window_range(request, 'columns', ALIGNMENT_COLUMNS,
+                           alignment.columns)
+    if rows is None or columns is None:
+        return HttpResponseBadRequest("Expected rows and columns as "
+                                      "first-last within %d x %d" %
+                                      (alignment.rows, alignment.columns))
+    if (rows.stop - rows.start) * (columns.stop - columns.start) > \
+            ALIGNMENT_MAX_CELLS:
+        return HttpResponseBadRequest("Expected up to %d residues" %
+                                      ALIGNMENT_MAX_CELLS)
+
+    window = alignment.window(rows, columns)
+    if format == 'fasta':
+        response = HttpResponse(''.join('>%s\n%s\n' % row for row in window),
+                                mimetype='text/plain')
+    else:
+        response = HttpResponse(simplejson.dumps({
+            'family': abbrev,
+            'rows': alignment.rows,
+            'columns': alignment.columns,
+            'first_row': rows.start + 1,
+            'first_column': columns.start + 1,
+            'names': [name for name, residues in window],
+            'sequences': [residues for name, residues in window],
+            'consensus': alignment.consensus[columns],
+            'conservation': alignment.conservation[columns],
+            }), mimetype='application/json')
+    patch_cache_control(response, public=True, max_age=CACHE_MAX_AGE)
+    return response
+
+@catalog_page
 def structure(request, abbrev):
 
-    t = get_template('structure.html')
-    html = t.render(Context({
+    family = get_family(abbrev)
+    return render('structure.html', {
                              'ALIGNMENTS_URL_PREFIX': ALIGNMENTS_URL_PREFIX,
-                             'families': families_data,
-                             'members': members_data[abbrev],
-                             'FamilyName': families_data[abbrev]['name'],
+                             'members': LazyList(catalog.members, abbrev),
+                             'FamilyName': family.name,
                              'FamilyAbbrev': abbrev,
-			     },
-                   ))
-    return HttpResponse(html)
+			     })
 
+@catalog_page
 def gene(request, geneid, protein_or_dna):
 
     if protein_or_dna != "" and \
@@ -174,20 +194,23 @@ def gene(request, geneid, protein_or_dna):
     else:
     	print "Protein\n"
 
-    if not (geneid in gene_data  or geneid in dna_data):
-	return HttpResponse("%s is not found in this database" % geneid)
-
-    t = get_template('gene.html')
-    html = t.render(Context({
-                             'gene': gene_data,
+    gene = catalog.gene(geneid)
+    if gene is None:
+        # A partial or differently cased accession: list the ones it starts
+        candidates = catalog.accessions_with_prefix(geneid)
+        if not candidates:
+            return HttpResponse("%s is not found in this database" % geneid)
+        return render('gene_candidates.html', {
+                                 'GeneID': geneid,
+                                 'candidates': candidates,
+                                  })
+
+    return render('gene.html', {
                              'GeneID': geneid,
-                             'GeneName': gene_data[geneid]['name'],
-                             'families_data': families_data,
-                             'families_for_this_gene': 
-                               gene_to_family_data[geneid],
-                             'members': members_data,
-                             'OtherIDs': gene_data[geneid]['IDs'],
-                             'GeneDescrip': gene_data[geneid]['description'],
-                              },
-                   ))
-    return HttpResponse(html)
+                             'GeneName': gene.name,
+                             'families_for_this_gene':
+                               catalog.families_for(geneid),
+                             'OtherIDs': gene.ids,
+                             'GeneDescrip': gene.description,
+                             'NavigatorURL': NAVIGATOR_URL,
+                              })
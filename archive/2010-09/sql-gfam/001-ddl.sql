@@ -49,12 +49,21 @@ create table gfam.family_tree_instance (
        family_tree_node_id integer not null, 
        rank                integer not null, 
        family_tree_id      integer not null,
-       preorder_code       varchar
+       preorder_code       varchar,
+       preorder_left       integer,
+       preorder_right      integer,
+       depth               integer
 ) tablespace gfam_ts;
 
+-- preorder_left/preorder_right are nested-set intervals: a node's subtree is every node of the same
+-- family_tree whose preorder_left lies between the node's preorder_left and preorder_right
+-- (maintained by navigator/tree.py when a tree is loaded)
+
 alter table gfam.family_tree_instance add constraint pk_family_tree_instance primary key(instance_node_id);
 alter table gfam.family_tree_instance add constraint uk_family_tree_instance unique(parent_node_id, rank);
 
+create index ix_family_tree_instance_preorder on gfam.family_tree_instance(family_tree_id, preorder_left, preorder_right);
+
 alter table gfam.family_tree_instance add constraint fk_family_tree_instance_family_tree 
       foreign key (family_tree_id) references gfam.family_tree(family_tree_id) on update cascade on delete cascade;
 
@@ -125,6 +134,30 @@ alter table gfam.sequence add constraint uk_sequence unique(seguid);
 
 -------------------------------------------------------------------------------------------------------------------------------------------------------------
 
+-- sequence_residues -----------------------------------------------------------------------------------------------------------------------------------------
+
+-- residues of gfam.sequence, packed by navigator/residues.py; the packed column
+-- is stored uncompressed so that substr() on it reads only the chunks it needs
+
+drop table if exists gfam.sequence_residues cascade;
+
+create table gfam.sequence_residues (
+       sequence_id integer not null,
+       encoding    varchar not null,
+       length      integer not null,
+       exceptions  varchar not null default '',
+       packed      bytea not null
+) tablespace gfam_ts;
+
+alter table gfam.sequence_residues alter column packed set storage external;
+
+alter table gfam.sequence_residues add constraint pk_sequence_residues primary key(sequence_id);
+
+alter table gfam.sequence_residues add constraint fk_sequence_residues_sequence
+      foreign key (sequence_id) references gfam.sequence(sequence_id) on update cascade on delete cascade;
+
+-------------------------------------------------------------------------------------------------------------------------------------------------------------
+
 -- family_member --------------------------------------------------------------------------------------------------------------------------------------------
 
 drop table if exists gfam.family_member cascade;
@@ -153,6 +186,37 @@ alter table gfam.family_member add constraint fk_family_member_sequence
 
 -------------------------------------------------------------------------------------------------------------------------------------------------------------
 
+-- family_summary -------------------------------------------------------------------------------------------------------------------------------------------
+
+-- one row per family of a build, filled in once when the build is loaded
+-- (see navigator/summary.py); the families page reads only this table
+
+drop table if exists gfam.family_summary cascade;
+drop sequence if exists gfam.family_summary_seq;
+
+create sequence gfam.family_summary_seq;
+
+create table gfam.family_summary (
+       family_summary_id      integer not null default nextval('gfam.family_summary_seq'),
+       family_build_id        integer not null,
+       instance_node_id       integer not null,
+       preorder_code          varchar,
+       family_tree_node_abrev varchar,
+       family_tree_node_name  varchar,
+       member_count           integer not null
+) tablespace gfam_ts;
+
+alter table gfam.family_summary add constraint pk_family_summary primary key(family_summary_id);
+alter table gfam.family_summary add constraint uk_family_summary unique(family_build_id, instance_node_id);
+
+alter table gfam.family_summary add constraint fk_family_summary_family_build
+      foreign key (family_build_id) references gfam.family_build(family_build_id) on update cascade on delete cascade;
+
+alter table gfam.family_summary add constraint fk_family_summary_family_tree_instance
+      foreign key (instance_node_id) references gfam.family_tree_instance(instance_node_id) on update cascade on delete cascade;
+
+-------------------------------------------------------------------------------------------------------------------------------------------------------------
+
 -- genome ---------------------------------------------------------------------------------------------------------------------------------------------------
 
 drop table if exists gfam.genome cascade;
@@ -350,6 +414,43 @@ alter table gfam.sequence_location add constraint fk_sequence_location_sequence_
 
 -------------------------------------------------------------------------------------------------------------------------------------------------------------
 
+-- feature_track --------------------------------------------------------------------------------------------------------------------------------------------
+
+-- features, locations and tags of a sequence as one JSON row, written by
+-- manage.py build_feature_tracks after features are loaded (navigator/tracks.py)
+
+drop table if exists gfam.feature_track cascade;
+
+create table gfam.feature_track (
+       sequence_id integer not null,
+       track       varchar not null
+) tablespace gfam_ts;
+
+alter table gfam.feature_track add constraint pk_feature_track primary key(sequence_id);
+
+alter table gfam.feature_track add constraint fk_feature_track_sequence
+      foreign key (sequence_id) references gfam.sequence(sequence_id) on update cascade on delete cascade;
+
+-------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+-- pfam_scan ------------------------------------------------------------------------------------------------------------------------------------------------
+
+-- the Pfam release each sequence checksum was last scanned against, written
+-- by manage.py annotate_pfam (navigator/annotate.py); the hits are PFAM
+-- sequence features
+
+drop table if exists gfam.pfam_scan cascade;
+
+create table gfam.pfam_scan (
+       seguid    varchar not null,
+       release   varchar not null,
+       domains   integer not null
+) tablespace gfam_ts;
+
+alter table gfam.pfam_scan add constraint pk_pfam_scan primary key(seguid);
+
+-------------------------------------------------------------------------------------------------------------------------------------------------------------
+
 -- db_link --------------------------------------------------------------------------------------------------------------------------------------------------
 
 drop table if exists gfam.dblink cascade;
@@ -0,0 +1,8 @@
+"""
+Python side of the cellwall refresh (see plan.md).
+
+The step scripts in code/NNN-*/ are run from the root of the project
+dir; the ones written in Python call into this package with
+
+    PYTHONPATH=code python -m refresh.<module> ...
+"""
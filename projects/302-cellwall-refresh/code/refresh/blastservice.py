@@ -0,0 +1,412 @@
+"""
+A BLAST search service for the navigator's "similar sequences" links.
+
+    PYTHONPATH=code python -m refresh.blastservice serve \
+        --db full=data/120-download-uniprot/uniprot_sprot_plus_trembl.fasta \
+        --db GH43=data/610-blast-service/families/GH43.fasta \
+        [--port 8017] [--workers 4] [--queue 32] [--cache-dir DIR]
+
+    curl 'http://localhost:8017/search?db=full&sequence=MKV...'
+    curl 'http://localhost:8017/status'
+
+Running blastp for every page view would read the database from disk
+again each time.  The service instead keeps every database it serves
+memory-mapped (all the files makeblastdb wrote) and touches their pages
+at start and then every --rewarm seconds, so blastp finds them in the
+page cache.
+
+Searches go through a bounded queue to --workers blastp processes; when
+the queue is full the service answers 503 instead of piling up work.
+Results are cached by a hash of the database, the options and the query
+residues, in memory and in --cache-dir, and a search that is already
+running is not started a second time: repeat queries are answered from
+the cache.
+
+For development and tests, --blastp "python -m refresh.blaststandin"
+searches a plain FASTA file as the database, no BLAST+ needed.
+"""
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import glob
+import hashlib
+import json
+import mmap
+import optparse
+import os
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+from collections import OrderedDict
+
+BLASTP = os.path.join(os.path.expanduser(
+    os.environ.get('BLAST_BIN', '~/opt/ncbi-blast/bin')), 'blastp')
+EVALUE = 1e-5
+MAX_HITS = 50
+PAGE_SIZE = mmap.PAGESIZE
+BLAST_FILE = re.compile(r'\.(\d+\.)?p[a-z]{2}$')
+
+# sseqid pident length evalue bitscore stitle
+OUTFMT = '6 sseqid pident length evalue bitscore stitle'
+HIT_KEYS = ['accession', 'identity', 'length', 'evalue', 'bitscore', 'title']
+HIT_TYPES = [str, float, int, float, float, str]
+
+
+class Busy(Exception):
+    """The request queue is full."""
+
+
+class SearchError(Exception):
+    pass
+
+
+def clean_sequence(text):
+    """Residues of a raw or FASTA formatted query, upper case."""
+    lines = text.strip().splitlines()
+    if lines and lines[0].startswith('>'):
+        lines = lines[1:]
+    return ''.join(''.join(lines).split()).upper().rstrip('*')
+
+
+def parse_hits(output):
+    hits = []
+    for line in output.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t', len(HIT_KEYS) - 1)
+        fields += [''] * (len(HIT_KEYS) - len(fields))
+        hits.append(dict((k, t(v)) for k, t, v in
+                         zip(HIT_KEYS, HIT_TYPES, fields)))
+    return hits
+
+
+# -- databases ---------------------------------------------------------------
+
+class Database(object):
+    """The files of one BLAST database, kept mapped into memory."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        # makeblastdb output (.pin, .phr, .psq, ... and numbered volumes),
+        # or the FASTA file itself for the stand-in
+        self.files = sorted(p for p in glob.glob(path + '.*')
+                            if BLAST_FILE.search(p)) or \
+            [p for p in [path] if os.path.isfile(p)]
+        if not self.files:
+            raise IOError("No database files at %s" % path)
+        self.maps = []
+        for p in self.files:
+            if os.path.getsize(p):
+                with open(p, 'rb') as f:
+                    self.maps.append(mmap.mmap(f.fileno(), 0,
+                                               access=mmap.ACCESS_READ))
+        self.size = sum(len(m) for m in self.maps)
+        # Part of the cache keys, so a rebuilt database gets new results
+        self.version = repr([(p, os.path.getsize(p), os.path.getmtime(p))
+                             for p in self.files])
+        self.warmed = None
+
+    def warm(self):
+        """Read one byte of every page, so they are in the page cache."""
+        total = 0
+        for m in self.maps:
+            for i in xrange(0, len(m), PAGE_SIZE):
+                total += ord(m[i])
+        self.warmed = time.time()
+        return total
+
+    def close(self):
+        for m in self.maps:
+            m.close()
+
+
+# -- cache -------------------------------------------------------------------
+
+class ResultCache(object):
+    """Search results by key, the last `entries` in memory, all on disk."""
+
+    def __init__(self, directory=None, entries=1000):
+        self.directory = directory
+        self.entries = entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory[key] = self.memory.pop(key)
+                self.hits += 1
+                return self.memory[key]
+        if self.directory:
+            try:
+                with open(self._path(key)) as f:
+                    result = json.load(f)
+            except (IOError, ValueError):
+                pass
+            else:
+                self._remember(key, result)
+                with self.lock:
+                    self.hits += 1
+                return result
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self.directory:
+            path = self._path(key)
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(result, f)
+            os.rename(tmp, path)
+
+    def _remember(self, key, result):
+        with self.lock:
+            self.memory[key] = result
+            while len(self.memory) > self.entries:
+                self.memory.popitem(last=False)
+
+
+# -- searching ---------------------------------------------------------------
+
+class Job(object):
+    def __init__(self, key, database, sequence):
+        self.key = key
+        self.database = database
+        self.sequence = sequence
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Service(object):
+    def __init__(self, databases, workers=4, queue_size=32, blastp=BLASTP,
+                 cache=None, evalue=EVALUE, max_hits=MAX_HITS,
+                 threads_per_job=1, rewarm=600):
+        self.databases = dict((d.name, d) for d in databases)
+        self.blastp = shlex.split(blastp)
+        self.cache = cache or ResultCache()
+        self.search_options = ['-evalue', str(evalue), '-max_target_seqs',
+                               str(max_hits)]
+        self.options = self.search_options + ['-num_threads',
+                                              str(threads_per_job)]
+        self.queue = Queue.Queue(queue_size)
+        self.running = {}           # key -> Job, queued or running
+        self.lock = threading.Lock()
+        self.searches = 0
+        for d in databases:
+            d.warm()
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='blast-%d' % i)
+            t.daemon = True
+            t.start()
+        if rewarm:
+            t = threading.Thread(target=self._rewarm, args=(rewarm,))
+            t.daemon = True
+            t.start()
+
+    def key(self, name, sequence):
+        h = hashlib.sha1()
+        h.update(repr((name, self.databases[name].version,
+                       self.search_options, sequence)))
+        return h.hexdigest()
+
+    def search(self, name, sequence, timeout=None):
+        """
+        Hits of sequence in database name, as a dict with 'hits' and
+        'cached'.  Raises KeyError for an unknown database, Busy when
+        the queue is full and SearchError when blastp fails.
+        """
+        if name not in self.databases:
+            raise KeyError(name)
+        sequence = clean_sequence(sequence)
+        if not sequence:
+            raise SearchError("Empty query sequence")
+        key = self.key(name, sequence)
+        hits = self.cache.get(key)
+        if hits is not None:
+            return {'hits': hits, 'cached': True}
+
+        with self.lock:
+            job = self.running.get(key)
+            if job is None:
+                job = Job(key, self.databases[name], sequence)
+                try:
+                    self.queue.put_nowait(job)
+                except Queue.Full:
+                    raise Busy("%d searches waiting" % self.queue.qsize())
+                self.running[key] = job
+        if not job.done.wait(timeout):
+            raise SearchError("Search timed out")
+        if job.error:
+            raise SearchError(job.error)
+        return {'hits': job.result, 'cached': False}
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.result = self._blast(job)
+                self.cache.put(job.key, job.result)
+            except Exception, e:
+                job.error = str(e)
+            finally:
+                with self.lock:
+                    self.running.pop(job.key, None)
+                    self.searches += 1
+                job.done.set()
+
+    def _blast(self, job):
+        command = self.blastp + ['-db', job.database.path, '-outfmt',
+                                 OUTFMT] + self.options
+        p = subprocess.Popen(command, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate('>query\n%s\n' % job.sequence)
+        if p.returncode != 0:
+            raise SearchError("blastp failed: %s" % err.strip())
+        return parse_hits(out)
+
+    def _rewarm(self, interval):
+        while True:
+            time.sleep(interval)
+            for d in self.databases.values():
+                d.warm()
+
+    def status(self):
+        return {
+            'databases': dict((d.name, {'path': d.path, 'bytes': d.size,
+                                        'warmed': d.warmed})
+                              for d in self.databases.values()),
+            'queued': self.queue.qsize(),
+            'running': len(self.running),
+            'searches': self.searches,
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+        }
+
+
+# -- HTTP --------------------------------------------------------------------
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    service = None
+    timeout_seconds = 300
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.answer(url.path, urlparse.parse_qs(url.query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self.answer(urlparse.urlparse(self.path).path,
+                    urlparse.parse_qs(self.rfile.read(length)))
+
+    def answer(self, path, params):
+        if path == '/status':
+            return self.reply(200, self.service.status())
+        if path != '/search':
+            return self.reply(404, {'error': 'Not found'})
+        name = params.get('db', ['full'])[0]
+        sequence = params.get('sequence', [''])[0]
+        start = time.time()
+        try:
+            result = self.service.search(name, sequence,
+                                         self.timeout_seconds)
+        except KeyError:
+            return self.reply(400, {'error': 'No database %s' % name})
+        except Busy, e:
+            return self.reply(503, {'error': str(e)})
+        except SearchError, e:
+            return self.reply(500, {'error': str(e)})
+        result['db'] = name
+        result['seconds'] = round(time.time() - start, 3)
+        self.reply(200, result)
+
+    def reply(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s %s\n" % (self.log_date_time_string(),
+                                      format % args))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(service, host='', port=8017):
+    class ServiceHandler(Handler):
+        pass
+    ServiceHandler.service = service
+    server = Server((host, port), ServiceHandler)
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog serve --db NAME=PATH [--db NAME=PATH ...] [options]")
+    parser.add_option("--db", action="append", default=[],
+                      help="database to serve, as NAME=PATH")
+    parser.add_option("--host", default='')
+    parser.add_option("--port", type="int", default=8017)
+    parser.add_option("--workers", type="int", default=4,
+                      help="blastp processes at once [default: %default]")
+    parser.add_option("--threads", type="int", default=1,
+                      help="blastp -num_threads [default: %default]")
+    parser.add_option("--queue", type="int", default=32,
+                      help="searches that may wait [default: %default]")
+    parser.add_option("--cache-dir", help="keep results here too")
+    parser.add_option("--cache-entries", type="int", default=1000,
+                      help="results kept in memory [default: %default]")
+    parser.add_option("--rewarm", type="int", default=600,
+                      help="seconds between page cache warm-ups "
+                           "[default: %default]")
+    parser.add_option("-E", dest="evalue", type="float", default=EVALUE)
+    parser.add_option("--max-hits", type="int", default=MAX_HITS)
+    parser.add_option("--blastp", default=BLASTP,
+                      help="blastp command [default: %default]")
+    options, args = parser.parse_args(argv)
+    if args != ['serve'] or not options.db:
+        parser.error("expected serve and at least one --db NAME=PATH")
+
+    databases = []
+    for spec in options.db:
+        if '=' not in spec:
+            parser.error("expected --db NAME=PATH, got %s" % spec)
+        name, path = spec.split('=', 1)
+        databases.append(Database(name, path))
+        print >> sys.stderr, "%s: %s, %.0f MB" % (
+            name, path, databases[-1].size / 1e6)
+    service = Service(databases, options.workers, options.queue,
+                      options.blastp,
+                      ResultCache(options.cache_dir, options.cache_entries),
+                      options.evalue, options.max_hits, options.threads,
+                      options.rewarm)
+    print >> sys.stderr, "Serving on port %d" % options.port
+    serve(service, options.host, options.port)
+
+
+if __name__ == '__main__':
+    main()
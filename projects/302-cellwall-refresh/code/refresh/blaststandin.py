@@ -0,0 +1,93 @@
+"""
+A stand-in for blastp that searches a plain FASTA file.
+
+    PYTHONPATH=code python -m refresh.blaststandin -db FASTA \
+        -outfmt '6 sseqid pident length evalue bitscore stitle' < query.fasta
+
+It takes the options refresh.blastservice passes to blastp and writes
+the same tabular columns, so the service can be run and tested on a
+small database without BLAST+.  Records are scored by the 3-mers they
+share with the query, which is enough to rank near-identical sequences
+first; the numbers are not BLAST statistics.
+"""
+
+import math
+import sys
+
+K = 3
+
+
+def read_fasta(f):
+    header = None
+    lines = []
+    for line in f:
+        line = line.rstrip('\n')
+        if line.startswith('>'):
+            if header is not None:
+                yield header, ''.join(lines)
+            header = line[1:]
+            lines = []
+        else:
+            lines.append(line.strip())
+    if header is not None:
+        yield header, ''.join(lines)
+
+
+def kmers(sequence):
+    return set(sequence[i:i + K] for i in xrange(len(sequence) - K + 1))
+
+
+def search(query, records, evalue, max_hits):
+    words = kmers(query)
+    size = 0
+    scored = []
+    for header, sequence in records:
+        size += len(sequence)
+        shared = len(words & kmers(sequence.upper()))
+        if shared:
+            scored.append((shared, header, sequence))
+    hits = []
+    for shared, header, sequence in sorted(scored, reverse=True):
+        bits = 2.0 * shared
+        e = len(query) * max(size, 1) * math.pow(2, -bits)
+        if e > evalue:
+            continue
+        identity = 100.0 * shared / max(len(words), 1)
+        hits.append((header.split()[0], identity,
+                     min(len(query), len(sequence)), e, bits, header))
+        if len(hits) == max_hits:
+            break
+    return hits
+
+
+def parse_args(argv):
+    """blastp style "-name value" options, as a dict."""
+    options = {}
+    for i in range(0, len(argv) - 1, 2):
+        if not argv[i].startswith('-'):
+            raise ValueError("Unexpected argument %s" % argv[i])
+        options[argv[i][1:]] = argv[i + 1]
+    return options
+
+
+def main(argv=None):
+    try:
+        options = parse_args(sys.argv[1:] if argv is None else argv)
+    except ValueError, e:
+        sys.exit("%s; usage: -db FASTA [-evalue E] [-max_target_seqs N] "
+                 "< query.fasta" % e)
+    if 'db' not in options:
+        sys.exit("-db is required")
+
+    query = open(options['query']) if 'query' in options else sys.stdin
+    sequence = ''.join(s for h, s in read_fasta(query)).upper()
+    with open(options['db']) as f:
+        hits = search(sequence, read_fasta(f),
+                      float(options.get('evalue', 10.0)),
+                      int(options.get('max_target_seqs', 500)))
+    for hit in hits:
+        print "%s\t%.2f\t%d\t%.2g\t%.1f\t%s" % hit
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,413 @@
+"""
+Offset index and random-access reader for large FASTA files.
+
+    PYTHONPATH=code python -m refresh.fastaindex build FASTA
+    PYTHONPATH=code python -m refresh.fastaindex get FASTA [ACCESSION...] \
+        [--list FILE] [--file-order]
+
+The index (FASTA.idx by default) maps the first word of every header to
+the byte offset and length of its record.  It is a sorted array of
+fixed-width entries, so it is memory-mapped and binary searched instead
+of being loaded, and building it needs memory for RUN_SIZE entries only
+(sorted runs are merged on disk).
+
+Records are returned as zero-copy buffers into the memory-mapped FASTA.
+fetch() reads a batch of accessions in file order, which keeps reads
+from a 50+ GB file sequential.
+
+Indexes written by refresh.normalize also hold the SEGUID of every
+record (version 2), so entries() gives accession and checksum pairs in
+accession order without reading any sequence.
+"""
+
+import base64
+import bisect
+import hashlib
+import heapq
+import mmap
+import optparse
+import os
+import struct
+import sys
+import tempfile
+
+MAGIC = 'FASTAIDX'
+VERSION = 1
+SEGUID_VERSION = 2
+KEY_WIDTH = 24
+RUN_SIZE = 1000000
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# magic, version, key width, entry count, size of the indexed FASTA
+HEADER = struct.Struct('>8sIIQQ')
+
+
+def entry_struct(key_width, checksums=False):
+    # Big-endian so that entries sort by (accession, offset) as bytes
+    if checksums:
+        return struct.Struct('>%dsQI20s' % key_width)
+    return struct.Struct('>%dsQI' % key_width)
+
+
+def index_path(fasta_path):
+    return fasta_path + '.idx'
+
+
+def accession(header):
+    """The index key of a header line (without the '>')."""
+    return header.split(None, 1)[0] if header.strip() else ''
+
+
+def seguid_digest(sequence):
+    """The SHA-1 digest a SEGUID is made of."""
+    return hashlib.sha1(sequence.upper()).digest()
+
+
+def seguid(digest):
+    """SEGUID checksum of a seguid_digest(), as in the seguid columns."""
+    return base64.b64encode(digest).rstrip('=')
+
+
+# -- building ----------------------------------------------------------------
+
+def scan_headers(f, block_size=BLOCK_SIZE):
+    """
+    Yield (offset, header) for every record of a FASTA file, where
+    offset is the position of its '>' and header the rest of that line.
+    Only headers are looked at, a block at a time.
+    """
+    buf = '\n'          # a virtual newline before the first byte
+    base = -1           # file offset of buf[0]
+    while True:
+        data = f.read(block_size)
+        buf += data
+        i = 0
+        while True:
+            j = buf.find('\n>', i)
+            if j < 0:
+                break
+            k = buf.find('\n', j + 2)
+            if k < 0:
+                if data:
+                    break
+                k = len(buf)
+            yield base + j + 1, buf[j + 2:k].rstrip('\r')
+            i = k
+        if not data:
+            return
+        if j >= 0:
+            keep = j            # header continues in the next block
+        else:
+            keep = len(buf) - 1
+        base += keep
+        buf = buf[keep:]
+
+
+class IndexWriter(object):
+    """
+    Collects (accession, offset, length) entries in any order and writes
+    the sorted index on close().  Used by build() and by the normalizer,
+    which knows the offsets and checksums of the records it writes.
+    """
+
+    def __init__(self, path, fasta_size=None, key_width=KEY_WIDTH,
+                 run_size=RUN_SIZE, checksums=False):
+        self.path = path
+        self.fasta_size = fasta_size
+        self.key_width = key_width
+        self.run_size = run_size
+        self.checksums = checksums
+        self.version = checksums and SEGUID_VERSION or VERSION
+        self.entry = entry_struct(key_width, checksums)
+        self.run = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, accession, offset, length, digest=None):
+        if len(accession) > self.key_width:
+            raise ValueError("Accession longer than %d characters: %r"
+                             % (self.key_width, accession))
+        if self.checksums:
+            entry = self.entry.pack(accession, offset, length, digest)
+        else:
+            entry = self.entry.pack(accession, offset, length)
+        self.run.append(entry)
+        self.count += 1
+        if len(self.run) >= self.run_size:
+            self._flush_run()
+
+    def _flush_run(self):
+        self.run.sort()
+        f = tempfile.TemporaryFile(dir=os.path.dirname(self.path) or '.')
+        f.write(''.join(self.run))
+        f.seek(0)
+        self.runs.append(f)
+        self.run = []
+
+    def _read_run(self, f):
+        size = self.entry.size
+        while True:
+            data = f.read(size * 4096)
+            if not data:
+                return
+            for i in xrange(0, len(data), size):
+                yield data[i:i + size]
+
+    def close(self, fasta_size=None):
+        if fasta_size is not None:
+            self.fasta_size = fasta_size
+        self.run.sort()
+        entries = heapq.merge(self.run, *[self._read_run(f) for f in self.runs])
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, self.version, self.key_width, 0, 0))
+            count = 0
+            last = None
+            for e in entries:
+                # Keep the first record of a duplicated accession
+                key = e[:self.key_width]
+                if key == last:
+                    continue
+                last = key
+                out.write(e)
+                count += 1
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, self.version, self.key_width, count,
+                                  self.fasta_size or 0))
+        os.rename(tmp, self.path)
+        for f in self.runs:
+            f.close()
+        self.run = self.runs = []
+        return count
+
+
+def build(fasta_path, path=None, key_width=KEY_WIDTH, run_size=RUN_SIZE):
+    """Index a FASTA file in one pass; returns the number of records."""
+    size = os.path.getsize(fasta_path)
+    writer = IndexWriter(path or index_path(fasta_path), size, key_width,
+                         run_size)
+    last = None
+    with open(fasta_path, 'rb') as f:
+        for offset, header in scan_headers(f):
+            if last is not None:
+                writer.add(last[0], last[1], offset - last[1])
+            last = (accession(header), offset)
+    if last is not None:
+        writer.add(last[0], last[1], size - last[1])
+    return writer.close()
+
+
+# -- reading -----------------------------------------------------------------
+
+class _Keys(object):
+    """The accession column of the index, as a sequence for bisect."""
+
+    def __init__(self, index):
+        self.mm = index.idx
+        self.start = HEADER.size
+        self.size = index.entry.size
+        self.width = index.key_width
+        self.count = index.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        offset = self.start + i * self.size
+        return self.mm[offset:offset + self.width]
+
+
+class FastaIndex(object):
+    """
+    Random access to the records of an indexed FASTA file:
+
+        with FastaIndex('uniprot_sprot_plus_trembl.fasta') as fasta:
+            header, sequence = fasta.get('P12345')
+            for accession, record in fasta.fetch(hits):
+                out.write(record)
+    """
+
+    def __init__(self, fasta_path, path=None):
+        self.fasta_path = fasta_path
+        path = path or index_path(fasta_path)
+        with open(path, 'rb') as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.key_width, self.count, fasta_size = \
+            HEADER.unpack(self.idx[:HEADER.size])
+        if magic != MAGIC or version not in (VERSION, SEGUID_VERSION):
+            raise ValueError("%s is not a FASTA index" % path)
+        if fasta_size != os.path.getsize(fasta_path):
+            raise ValueError("%s is out of date, rebuild it" % path)
+        self.checksums = version == SEGUID_VERSION
+        self.entry = entry_struct(self.key_width, self.checksums)
+        self.keys = _Keys(self)
+        with open(fasta_path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if fasta_size else ''
+
+    def close(self):
+        self.idx.close()
+        if self.mm:
+            self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, accession):
+        return self.locate(accession) is not None
+
+    def _find(self, accession, lo=0):
+        """Position of accession in the index, or -1, and the bisect point."""
+        key = accession.ljust(self.key_width, '\0')
+        i = bisect.bisect_left(self.keys, key, lo)
+        if i < self.count and self.keys[i] == key and \
+           len(accession) <= self.key_width:
+            return i, i
+        return -1, i
+
+    def _entry(self, i):
+        offset = HEADER.size + i * self.entry.size
+        return self.entry.unpack(self.idx[offset:offset + self.entry.size])
+
+    def locate(self, accession):
+        """(offset, length) of the record of accession, or None."""
+        i, lo = self._find(accession)
+        if i < 0:
+            return None
+        return self._entry(i)[1:3]
+
+    def seguid(self, accession):
+        """SEGUID of the sequence of accession, from a version 2 index."""
+        if not self.checksums:
+            raise ValueError("%s has no checksums" % self.fasta_path)
+        i, lo = self._find(accession)
+        if i < 0:
+            raise KeyError(accession)
+        return seguid(self._entry(i)[3])
+
+    def entries(self):
+        """
+        Yield (accession, offset, length, SEGUID or None) for every
+        record, in accession order.
+        """
+        size = self.entry.size
+        start = HEADER.size
+        for i in xrange(self.count):
+            e = self.entry.unpack(self.idx[start:start + size])
+            start += size
+            yield (e[0].rstrip('\0'), e[1], e[2],
+                   self.checksums and seguid(e[3]) or None)
+
+    def locate_many(self, accessions):
+        """
+        Look up many accessions at once, sorted so each one is found by
+        bisecting only the part of the index after the previous one.
+        Returns ([(offset, length, accession)] sorted by offset, [missing]).
+        """
+        found = []
+        missing = []
+        lo = 0
+        for a in sorted(set(accessions)):
+            i, lo = self._find(a, lo)
+            if i < 0:
+                missing.append(a)
+            else:
+                e = self._entry(i)
+                found.append((e[1], e[2], a))
+        found.sort()
+        return found, missing
+
+    def record(self, accession):
+        """The whole record, header line included, as a buffer."""
+        where = self.locate(accession)
+        if where is None:
+            raise KeyError(accession)
+        return buffer(self.mm, *where)
+
+    def get(self, accession):
+        """(header, sequence) of accession."""
+        return parse_record(self.record(accession))
+
+    def fetch(self, accessions):
+        """
+        Yield (accession, record buffer) for accessions in file order.
+        Raises KeyError naming the missing accessions before reading any.
+        """
+        found, missing = self.locate_many(accessions)
+        if missing:
+            raise KeyError("%d accessions are not in %s, e.g. %s" % (
+                len(missing), self.fasta_path, ", ".join(missing[:5])))
+        for offset, length, a in found:
+            yield a, buffer(self.mm, offset, length)
+
+    def iter_records(self, accessions):
+        """Yield (accession, record buffer) in the order of accessions."""
+        for a in accessions:
+            where = self.locate(a)
+            if where is None:
+                raise KeyError("%s is not in %s" % (a, self.fasta_path))
+            yield a, buffer(self.mm, *where)
+
+
+def parse_record(record):
+    """Split a FASTA record into (header, sequence)."""
+    record = str(record)
+    end = record.find('\n')
+    if end < 0:
+        return record[1:].rstrip(), ''
+    return record[1:end].rstrip('\r'), \
+        ''.join(record[end + 1:].split())
+
+
+# -- command line ------------------------------------------------------------
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog build FASTA\n"
+              "       %prog get FASTA [ACCESSION...] [--list FILE]")
+    parser.add_option("--index", help="index file (default FASTA.idx)")
+    parser.add_option("--key-width", type="int", default=KEY_WIDTH,
+                      help="longest accession the index can hold "
+                           "[default: %default]")
+    parser.add_option("--list", help="read accessions from FILE, one per "
+                                     "line ('-' for stdin)")
+    parser.add_option("--file-order", action="store_true",
+                      help="write records in FASTA file order, which is "
+                           "faster for large lists")
+    options, args = parser.parse_args(argv)
+    if len(args) < 2 or args[0] not in ('build', 'get'):
+        parser.error("expected build or get and a FASTA file")
+    command, fasta_path = args[0], args[1]
+
+    if command == 'build':
+        count = build(fasta_path, options.index, options.key_width)
+        print >> sys.stderr, "Indexed %d records" % count
+        return
+
+    accessions = args[2:]
+    if options.list:
+        f = sys.stdin if options.list == '-' else open(options.list)
+        accessions.extend(line.strip() for line in f if line.strip())
+    with FastaIndex(fasta_path, options.index) as fasta:
+        if options.file_order:
+            records = fasta.fetch(accessions)
+        else:
+            records = fasta.iter_records(accessions)
+        try:
+            for a, record in records:
+                sys.stdout.write(record)
+                if record[-1:] != '\n':
+                    sys.stdout.write('\n')
+        except KeyError, e:
+            sys.exit("ERROR: %s" % e.args[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+hmmsearch over record-aligned shards of a big FASTA file.
+
+    PYTHONPATH=code python -m refresh.hmmsearch shard FASTA --shards 32
+    PYTHONPATH=code python -m refresh.hmmsearch search FASTA HMM... \
+        [--shards 32] [--cpus 16] [-E 0.1] [--tblout OUT | --out-dir DIR]
+
+The FASTA file is cut into --shards pieces at record boundaries, once;
+FASTA.shards/manifest.json records the sizes and record counts, and the
+shards are reused until the FASTA file changes.  Every (HMM, shard) pair
+is one single-threaded hmmsearch, run --cpus at a time, and the --tblout
+tables of the shards are merged into one table per HMM, ranked by
+E-value.
+
+hmmsearch computes sequence E-values from the number of sequences it
+searched, so every job gets -Z set to the record count of the whole
+FASTA file; the sequence E-values, the -E cut-off and so the set of hits
+then come out as in one hmmsearch over the whole file.  The conditional
+domain E-values, and with them the domain inclusion and the rep and inc
+columns, use domZ, which hmmsearch sets to the number of targets it
+reported.  A shard that reported fewer than all the hits is searched
+again, over its hit records only, with --domZ set to the number of hits
+of all shards, so the merged table matches a single run.
+
+Per-shard tables are kept in OUT.parts/ until the merge, so an
+interrupted search only reruns the shards it had not finished.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import mmap
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from refresh import fastaindex
+
+HMMSEARCH = os.path.join(os.path.expanduser(
+    os.environ.get('HMMER_BIN', '~/opt/hmmer-3.1b1/bin')), 'hmmsearch')
+COPY_SIZE = 16 * 1024 * 1024
+EVALUE = 0.1
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def shard_dir(fasta):
+    return fasta + '.shards'
+
+
+# -- shards ------------------------------------------------------------------
+
+def boundaries(fasta, n):
+    """Offsets that cut fasta into n record-aligned pieces of similar size."""
+    size = os.path.getsize(fasta)
+    cuts = [0]
+    if size:
+        with open(fasta, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for i in range(1, n):
+                    start = max(size * i // n, cuts[-1])
+                    j = mm.find('\n>', start)
+                    if j < 0:
+                        break
+                    if j + 1 > cuts[-1]:
+                        cuts.append(j + 1)
+            finally:
+                mm.close()
+    cuts.append(size)
+    return zip(cuts, cuts[1:])
+
+
+def copy_range(src, dst, start, end):
+    """Copy bytes [start, end) of src to dst; returns the records copied."""
+    records = 0
+    last = '\n'
+    with open(src, 'rb') as f, open(dst, 'wb') as out:
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            data = f.read(min(COPY_SIZE, left))
+            if not data:
+                break
+            records += data.count('\n>') + (last == '\n' and
+                                             data.startswith('>'))
+            last = data[-1]
+            out.write(data)
+            left -= len(data)
+    return records
+
+
+def make_shards(fasta, n, directory=None):
+    """
+    Cut fasta into n shards in directory (FASTA.shards by default), or
+    reuse the ones there if they were made from this version of fasta.
+    Returns the manifest: {'records': total, 'shards': [{'path',
+    'records', 'bytes'}], ...}.
+    """
+    directory = directory or shard_dir(fasta)
+    _makedirs(directory)
+    st = os.stat(fasta)
+    source = {'fasta': os.path.abspath(fasta), 'size': st.st_size,
+              'mtime': st.st_mtime, 'n': n}
+    path = os.path.join(directory, 'manifest.json')
+
+    # Several searches may start at once; one makes the shards
+    with open(os.path.join(directory, 'lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest['source'] == source and all(
+                    os.path.getsize(s['path']) == s['bytes']
+                    for s in manifest['shards']):
+                return manifest
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        shards = []
+        for i, (start, end) in enumerate(boundaries(fasta, n)):
+            shard = os.path.join(directory, 'shard-%03d.fasta' % i)
+            records = copy_range(fasta, shard, start, end)
+            shards.append({'path': shard, 'records': records,
+                           'bytes': end - start})
+        manifest = {'source': source, 'shards': shards,
+                    'records': sum(s['records'] for s in shards)}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.rename(path + '.tmp', path)
+        return manifest
+
+
+# -- tblout ------------------------------------------------------------------
+
+def read_tblout(path):
+    """(comment lines before the hits, hit lines, comment lines after)."""
+    head, rows, tail = [], [], []
+    with open(path) as f:
+        for line in f:
+            if not line.startswith('#'):
+                rows.append(line)
+            elif rows or tail or (head and head[-1].startswith('#-')):
+                tail.append(line)
+            else:
+                head.append(line)
+    return head, rows, tail
+
+
+def complete(path):
+    """True if path is a tblout that hmmsearch finished writing."""
+    try:
+        with open(path) as f:
+            f.seek(max(0, os.path.getsize(path) - 64))
+            return f.read().rstrip().endswith('[ok]')
+    except (IOError, OSError):
+        return False
+
+
+def extract(fasta, names, out):
+    """Copy the records of fasta whose accession is in names to out."""
+    with open(fasta, 'rb') as f:
+        starts = [(offset, fastaindex.accession(header))
+                  for offset, header in fastaindex.scan_headers(f)]
+    ends = [offset for offset, name in starts[1:]] + \
+        [os.path.getsize(fasta)]
+    with open(fasta, 'rb') as f, open(out, 'wb') as o:
+        for (offset, name), end in zip(starts, ends):
+            if name in names:
+                f.seek(offset)
+                o.write(f.read(end - offset))
+
+
+def rank_key(line):
+    fields = line.split(None, 6)
+    return float(fields[4]), -float(fields[5]), fields[0]
+
+
+def merge_tblout(parts, out, target=None):
+    """
+    Merge per-shard tblout files into out, ranked by E-value.  target
+    replaces the shard in the "# Target file:" line.
+    """
+    head = tail = None
+    rows = []
+    for part in parts:
+        h, r, t = read_tblout(part)
+        if head is None:
+            head, tail = h, t
+        rows.extend(r)
+    head = head or []
+    tail = tail or []
+    if target:
+        tail = [line.startswith('# Target file:') and
+                '# Target file:     %s\n' % target or line for line in tail]
+    rows.sort(key=rank_key)
+    tmp = out + '.tmp'
+    with open(tmp, 'w') as f:
+        f.writelines(head)
+        f.writelines(rows)
+        f.writelines(tail)
+    os.rename(tmp, out)
+    return len(rows)
+
+
+# -- searching ---------------------------------------------------------------
+
+def _run(job):
+    command, part, hits = job
+    if hits:
+        extract(*hits)
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen(command, stdout=devnull, stderr=subprocess.PIPE)
+        err = p.communicate()[1]
+    if p.returncode != 0 or not complete(part):
+        return "%s failed: %s" % (" ".join(command), err.strip())
+    return None
+
+
+def _run_all(jobs, cpus):
+    pool = ThreadPool(cpus)
+    try:
+        errors = [e for e in pool.imap_unordered(_run, jobs) if e]
+    finally:
+        pool.close()
+        pool.join()
+    if errors:
+        raise RuntimeError("%d of %d hmmsearch jobs failed, e.g. %s"
+                           % (len(errors), len(jobs), errors[0]))
+
+
+def job_key(hmm, manifest, evalue, options):
+    h = hashlib.sha1(open(hmm, 'rb').read())
+    h.update(repr((manifest['source'], manifest['records'], evalue,
+                   options)))
+    return h.hexdigest()
+
+
+def search(fasta, hmms, outputs, shards=None, cpus=None, evalue=EVALUE,
+           hmmsearch=HMMSEARCH, z=None, options=(), manifest=None):
+    """
+    Search every HMM against all shards of fasta and write the merged
+    table of hmms[i] to outputs[i].  z defaults to the number of records
+    in fasta.  Returns the number of hits per output.
+
+    Shards are searched with -Z z; then the shards holding some but not
+    all of the hits of an HMM are searched again over those hits with
+    --domZ set to the total (see above).
+    """
+    cpus = cpus or cpu_count()
+    manifest = manifest or make_shards(fasta, shards or cpus)
+    z = z or manifest['records']
+    jobs = []
+    parts = []
+    for hmm, out in zip(hmms, outputs):
+        parts_dir = out + '.parts'
+        key = job_key(hmm, manifest, evalue, (z,) + tuple(options))
+        key_path = os.path.join(parts_dir, 'key')
+        if not os.path.exists(key_path) or open(key_path).read() != key:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+            _makedirs(parts_dir)
+            with open(key_path, 'w') as f:
+                f.write(key)
+        out_parts = []
+        for i, shard in enumerate(manifest['shards']):
+            if not shard['records']:
+                # hmmsearch refuses empty files
+                continue
+            part = os.path.join(parts_dir, 'shard-%03d.tblout' % i)
+            command = [hmmsearch, '--cpu', '1', '--noali', '-E', str(evalue),
+                       '-Z', str(z)] + list(options)
+            out_parts.append((part, shard['path'], command + [hmm]))
+            if not complete(part):
+                jobs.append((command + ['--tblout', part, hmm,
+                                        shard['path']], part, None))
+        parts.append((out, parts_dir, out_parts))
+    _run_all(jobs, cpus)
+
+    # domZ: what one search would have reported
+    jobs = []
+    merges = []
+    for out, parts_dir, out_parts in parts:
+        hits = [[row.split(None, 1)[0] for row in read_tblout(part)[1]]
+                for part, shard, command in out_parts]
+        total = sum(len(names) for names in hits)
+        final = []
+        for (part, shard, command), names in zip(out_parts, hits):
+            if len(names) == total:
+                final.append(part)
+                continue
+            if not names:
+                continue
+            base = os.path.splitext(part)[0]
+            dom_part = base + '.domz.tblout'
+            final.append(dom_part)
+            if not complete(dom_part):
+                hits_fasta = base + '.hits.fasta'
+                jobs.append((command[:-1] + ['--domZ', str(total),
+                                             '--tblout', dom_part,
+                                             command[-1], hits_fasta],
+                             dom_part, (shard, set(names), hits_fasta)))
+        merges.append((out, parts_dir, final or
+                       [part for part, shard, command in out_parts]))
+    _run_all(jobs, cpus)
+
+    counts = []
+    for out, parts_dir, final in merges:
+        counts.append(merge_tblout(final, out, fasta))
+        shutil.rmtree(parts_dir)
+    return counts
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog shard FASTA [--shards N]\n"
+              "       %prog search FASTA HMM... [options]")
+    parser.add_option("--shards", type="int",
+                      help="number of shards [default: --cpus]")
+    parser.add_option("--cpus", type="int", default=cpu_count(),
+                      help="hmmsearch jobs to run at once [default: %default]")
+    parser.add_option("-E", dest="evalue", type="float", default=EVALUE,
+                      help="report hits with E-values up to this "
+                           "[default: %default]")
+    parser.add_option("-Z", dest="z", type="int",
+                      help="database size for E-values [default: records "
+                           "in FASTA]")
+    parser.add_option("--tblout", help="merged table, for one HMM")
+    parser.add_option("--out-dir", help="write HMM_NAME.tblout here")
+    parser.add_option("--hmmsearch", default=HMMSEARCH,
+                      help="[default: %default]")
+    options, args = parser.parse_args(argv)
+    if len(args) < 2 or args[0] not in ('shard', 'search'):
+        parser.error("expected shard or search and a FASTA file")
+
+    fasta = args[1]
+    if args[0] == 'shard':
+        manifest = make_shards(fasta, options.shards or options.cpus)
+        print >> sys.stderr, "%d records in %d shards" % (
+            manifest['records'], len(manifest['shards']))
+        return
+
+    hmms = args[2:]
+    if not hmms:
+        parser.error("no HMM given")
+    if options.tblout and len(hmms) == 1:
+        outputs = [options.tblout]
+    elif options.out_dir:
+        _makedirs(options.out_dir)
+        outputs = [os.path.join(options.out_dir, os.path.splitext(
+            os.path.basename(h))[0] + '.tblout') for h in hmms]
+    else:
+        parser.error("expected --tblout with one HMM, or --out-dir")
+
+    counts = search(fasta, hmms, outputs, options.shards, options.cpus,
+                    options.evalue, options.hmmsearch, options.z)
+    for out, count in zip(outputs, counts):
+        print >> sys.stderr, "%s: %d hits" % (out, count)
+
+
+if __name__ == '__main__':
+    main()
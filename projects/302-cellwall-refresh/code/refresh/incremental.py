@@ -0,0 +1,142 @@
+"""
+Incremental refresh between two UniProt releases.
+
+    PYTHONPATH=code python -m refresh.incremental delta PREVIOUS CURRENT --out DIR
+    PYTHONPATH=code python -m refresh.incremental search DIR HMM... [--cpus 16]
+
+PREVIOUS and CURRENT are normalized FASTA files with the SEGUID indexes
+refresh.normalize writes.  "delta" walks both indexes in accession order
+and writes
+
+    DIR/delta.tsv     added, removed or changed, and the accession
+    DIR/delta.fasta   the added and changed records of CURRENT, read in
+                      file order FETCH_SIZE accessions at a time
+    DIR/delta.json    counts, and the number of records in CURRENT
+
+"search" runs the family HMMs against delta.fasta only, sharded like a
+full search, with -Z set to the size of CURRENT so that E-values match a
+search of the whole release.  It writes DIR/NAME.tblout per HMM.
+
+The navigator's load_hmmsearch_delta command then makes a new family
+build from the previous one: members whose accessions were removed or
+changed are dropped, and the hits in the tblout files are added.
+"""
+
+import json
+import optparse
+import os
+import sys
+from multiprocessing import cpu_count
+
+from refresh import fastaindex, hmmsearch
+
+ADDED, REMOVED, CHANGED = 'added', 'removed', 'changed'
+
+# Accessions of delta.fasta held in memory at once
+FETCH_SIZE = 100000
+
+
+def delta(previous, current):
+    """
+    Yield (status, accession) for every accession that differs between
+    two FastaIndex objects with checksums, in accession order.
+    """
+    for index in previous, current:
+        if not index.checksums:
+            raise ValueError("%s has no checksums; write it with "
+                             "refresh.normalize" % index.fasta_path)
+    old = previous.entries()
+    new = current.entries()
+    a = next(old, None)
+    b = next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield REMOVED, a[0]
+            a = next(old, None)
+        elif a is None or b[0] < a[0]:
+            yield ADDED, b[0]
+            b = next(new, None)
+        else:
+            if a[3] != b[3]:
+                yield CHANGED, b[0]
+            a = next(old, None)
+            b = next(new, None)
+
+
+def _write_records(index, accessions, f):
+    for accession, record in index.fetch(accessions):
+        f.write(record)
+        if record[-1:] != '\n':
+            f.write('\n')
+
+
+def write_delta(previous_path, current_path, out_dir):
+    """Write delta.tsv, delta.fasta and delta.json; returns the counts."""
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    counts = {ADDED: 0, REMOVED: 0, CHANGED: 0}
+    with fastaindex.FastaIndex(previous_path) as previous, \
+            fastaindex.FastaIndex(current_path) as current:
+        with open(os.path.join(out_dir, 'delta.tsv'), 'w') as tsv, \
+                open(os.path.join(out_dir, 'delta.fasta'), 'wb') as fasta:
+            search = []
+            for status, accession in delta(previous, current):
+                tsv.write("%s\t%s\n" % (status, accession))
+                counts[status] += 1
+                if status != REMOVED:
+                    search.append(accession)
+                    if len(search) >= FETCH_SIZE:
+                        _write_records(current, search, fasta)
+                        search = []
+            _write_records(current, search, fasta)
+        counts['records'] = len(current)
+    counts['previous'] = os.path.abspath(previous_path)
+    counts['current'] = os.path.abspath(current_path)
+    with open(os.path.join(out_dir, 'delta.json'), 'w') as f:
+        json.dump(counts, f, indent=1)
+    return counts
+
+
+def search(out_dir, hmms, cpus=None, evalue=hmmsearch.EVALUE,
+           program=hmmsearch.HMMSEARCH):
+    """Search delta.fasta with every HMM; returns the tblout paths."""
+    with open(os.path.join(out_dir, 'delta.json')) as f:
+        counts = json.load(f)
+    outputs = [os.path.join(out_dir, os.path.splitext(os.path.basename(h))[0]
+                            + '.tblout') for h in hmms]
+    hmmsearch.search(os.path.join(out_dir, 'delta.fasta'), hmms, outputs,
+                     cpus=cpus, evalue=evalue, hmmsearch=program,
+                     z=counts['records'])
+    return outputs
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog delta PREVIOUS CURRENT --out DIR\n"
+              "       %prog search DIR HMM... [options]")
+    parser.add_option("--out", help="directory for the delta files")
+    parser.add_option("--cpus", type="int", default=cpu_count(),
+                      help="hmmsearch jobs to run at once [default: %default]")
+    parser.add_option("-E", dest="evalue", type="float",
+                      default=hmmsearch.EVALUE,
+                      help="report hits with E-values up to this "
+                           "[default: %default]")
+    parser.add_option("--hmmsearch", default=hmmsearch.HMMSEARCH,
+                      help="[default: %default]")
+    options, args = parser.parse_args(argv)
+
+    if args[:1] == ['delta'] and len(args) == 3 and options.out:
+        counts = write_delta(args[1], args[2], options.out)
+        print >> sys.stderr, "%(added)d added, %(changed)d changed, " \
+            "%(removed)d removed of %(records)d" % counts
+    elif args[:1] == ['search'] and len(args) > 2:
+        for out in search(args[1], args[2:], options.cpus, options.evalue,
+                          options.hmmsearch):
+            print >> sys.stderr, out
+    else:
+        parser.error("expected delta PREVIOUS CURRENT --out DIR, "
+                     "or search DIR HMM...")
+
+
+if __name__ == '__main__':
+    main()
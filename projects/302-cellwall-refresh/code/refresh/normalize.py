@@ -0,0 +1,155 @@
+"""
+One-pass UniProt FASTA normalizer.
+
+    PYTHONPATH=code python -m refresh.normalize -o uniprot_sprot_plus_trembl.fasta \
+        uniprot_trembl.fasta.gz uniprot_sprot.fasta.gz
+
+Replaces gunzip_and_fix_fasta and the concatenation in
+download-uniport-and-makeblastdb.  The inputs are decompressed in
+blocks and written one after the other into the output, with the header
+lines rewritten the way the three perl passes did: pipes become spaces
+and the "tr"/"sp" prefixes go, so
+
+    >sp|P12345|AATM_RABIT Aspartate aminotransferase ...
+    >P12345 AATM_RABIT Aspartate aminotransferase ...
+
+Sequence lines are copied as they are.  In the same pass the records'
+offsets and SEGUIDs go to the version 2 refresh.fastaindex index of the
+output (OUTPUT.idx), which later steps use for hit extraction and to
+find the sequences that changed between releases.
+"""
+
+import optparse
+import os
+import sys
+import time
+import zlib
+
+from refresh import fastaindex
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def normalize_header(header):
+    """Rewrite a header line, given without its '>'."""
+    header = header.replace('|', ' ')
+    if header.startswith('tr ') or header.startswith('sp '):
+        header = header[3:]
+    return header
+
+
+def read_blocks(path, block_size=BLOCK_SIZE):
+    """Yield the contents of a plain or gzipped file a block at a time."""
+    with open(path, 'rb') as f:
+        if not path.endswith('.gz'):
+            for block in iter(lambda: f.read(block_size), ''):
+                yield block
+            return
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for raw in iter(lambda: f.read(block_size), ''):
+            block = d.decompress(raw)
+            while d.unused_data:
+                # Concatenated gzip members
+                rest = d.unused_data
+                block += d.flush()
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                block += d.decompress(rest)
+            if block:
+                yield block
+        block = d.flush()
+        if block:
+            yield block
+
+
+def records(blocks):
+    """
+    Yield (header, body) for every record in a stream of blocks, where
+    body is the sequence lines as they are, without the last newline.
+    """
+    tail = ''
+    first = True
+    for block in blocks:
+        if first:
+            if not block.startswith('>'):
+                raise ValueError("Not a FASTA file: %r" % block[:40])
+            block = block[1:]
+            first = False
+        pieces = (tail + block).split('\n>')
+        tail = pieces.pop()
+        for piece in pieces:
+            end = piece.find('\n')
+            if end < 0:
+                yield piece, ''
+            else:
+                yield piece[:end], piece[end + 1:]
+    if tail:
+        tail = tail.rstrip('\n')
+        end = tail.find('\n')
+        if end < 0:
+            yield tail, ''
+        else:
+            yield tail[:end], tail[end + 1:]
+
+
+def normalize(inputs, output, key_width=fastaindex.KEY_WIDTH,
+              block_size=BLOCK_SIZE, log=None):
+    """
+    Write the normalized records of all inputs to output and its index.
+    Returns the number of records.
+    """
+    tmp = output + '.tmp'
+    index = fastaindex.IndexWriter(fastaindex.index_path(output),
+                                   key_width=key_width, checksums=True)
+    digest = fastaindex.seguid_digest
+    offset = 0
+    count = 0
+    with open(tmp, 'wb') as out:
+        for path in inputs:
+            started = time.time()
+            buf = []
+            size = 0
+            for header, body in records(read_blocks(path, block_size)):
+                header = normalize_header(header)
+                if body:
+                    record = '>%s\n%s\n' % (header, body)
+                    sequence = body.replace('\n', '').replace('\r', '')
+                else:
+                    record = '>%s\n' % header
+                    sequence = ''
+                index.add(fastaindex.accession(header), offset, len(record),
+                          digest(sequence))
+                offset += len(record)
+                buf.append(record)
+                size += len(record)
+                count += 1
+                if size >= block_size:
+                    out.write(''.join(buf))
+                    buf = []
+                    size = 0
+            out.write(''.join(buf))
+            if log:
+                log.write("%s: %d records so far, %.0fs\n"
+                          % (path, count, time.time() - started))
+    os.rename(tmp, output)
+    index.close(os.path.getsize(output))
+    return count
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog -o OUTPUT INPUT[.gz]...")
+    parser.add_option("-o", "--output", help="normalized FASTA to write")
+    parser.add_option("--key-width", type="int",
+                      default=fastaindex.KEY_WIDTH,
+                      help="longest accession the index can hold "
+                           "[default: %default]")
+    options, args = parser.parse_args(argv)
+    if not options.output or not args:
+        parser.error("expected -o OUTPUT and at least one input")
+    count = normalize(args, options.output, options.key_width,
+                      log=sys.stderr)
+    print >> sys.stderr, "Wrote %d records to %s" % (count, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+All-against-all outlier filter for a family alignment (plan.md step 2.1,
+the "blast all-against-all" option), in one process instead of GUIDANCE.
+
+    PYTHONPATH=code python -m refresh.outliers \
+        [--min-identity 0.2] [--min-coverage 0.5] [--report FILE] \
+        ALIGNMENT.fasta filtered.fasta
+
+code/130-build-msa/run-outlier-filter aligns GH43 with MAFFT and runs
+this on the result.  For every pair of sequences i, j of the alignment
+
+    aligned   columns where neither has a gap
+    identity  identical residues / aligned
+    coverage  aligned / residues of the longer of i and j
+
+A sequence is an outlier when its mean identity to the pairs it overlaps,
+or its mean coverage by all the others, is below the thresholds.  The
+kept sequences are written without gaps, ready to be aligned again
+(step 2.2); --report writes the numbers of every sequence.
+
+Residues are encoded as small integers (numpy.uint8, 0 for gaps).  For
+a block of BLOCK_ROWS sequences against all of them, taken COLUMNS
+columns at a time, the aligned counts are a product of gap masks.  The
+identical counts are a product of one-hot indicators of the (column,
+residue) pairs most sequences share, plus the pairs within each group of
+sequences sharing a rarer residue.  Memory grows with the size of the
+alignment and the blocks, never with the number of pairs, so families
+of 10,000+ sequences fit on one machine.
+"""
+
+import optparse
+import sys
+
+import numpy
+
+from refresh.blaststandin import read_fasta
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+GAPS = '-.'
+
+# Codes: 0 gap, 1-20 AMINO_ACIDS, UNKNOWN for any other letter, which is
+# aligned but never counted as identical
+UNKNOWN = len(AMINO_ACIDS) + 1
+
+BLOCK_ROWS = 1024
+COLUMNS = 256
+
+# (column, residue) pairs shared by more than this fraction of the
+# sequences are counted with a matrix product, the rarer ones pair by pair
+DENSE = 0.15
+
+MIN_IDENTITY = 0.2
+MIN_COVERAGE = 0.5
+
+
+def _code_table():
+    table = numpy.empty(256, numpy.uint8)
+    table.fill(UNKNOWN)
+    for i, residue in enumerate(AMINO_ACIDS):
+        table[ord(residue)] = table[ord(residue.lower())] = i + 1
+    for gap in GAPS:
+        table[ord(gap)] = 0
+    return table
+
+CODES = _code_table()
+
+
+def encode(sequences):
+    """Alignment rows as an (n, columns) uint8 array of residue codes."""
+    width = len(sequences[0]) if sequences else 0
+    codes = numpy.empty((len(sequences), width), numpy.uint8)
+    for i, sequence in enumerate(sequences):
+        if len(sequence) != width:
+            raise ValueError("Row %d has %d columns, expected %d" %
+                             (i + 1, len(sequence), width))
+        codes[i] = CODES[numpy.frombuffer(sequence, numpy.uint8)]
+    return codes
+
+
+def _features(codes):
+    """
+    The (column, residue) pairs of codes that two or more sequences
+    share, as float32 indicator columns for the common ones and as
+    sorted arrays of sequence numbers for the rest.
+    """
+    n, width = codes.shape
+    keys = codes.astype(numpy.int32) + \
+        numpy.arange(width, dtype=numpy.int32) * (UNKNOWN + 1)
+    known = (codes > 0) & (codes < UNKNOWN)
+    sequences = numpy.nonzero(known)[0]
+    keys = keys[known]
+    order = numpy.argsort(keys, kind='mergesort')
+    keys, sequences = keys[order], sequences[order]
+    starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+    sizes = numpy.diff(numpy.r_[starts, len(keys)])
+
+    common = sizes > DENSE * n
+    feature = numpy.repeat(numpy.arange(len(sizes)), sizes)
+    column = numpy.cumsum(common) - 1
+    hot = numpy.zeros((n, common.sum()), numpy.float32)
+    dense = common[feature]
+    hot[sequences[dense], column[feature[dense]]] = 1
+    rare = ~common & (sizes > 1)
+    groups = [sequences[start:start + size]
+              for start, size in zip(starts[rare], sizes[rare])]
+    return hot, groups
+
+
+def column_blocks(codes, columns=COLUMNS):
+    """
+    [(gap mask, common indicators, rare groups)] of codes, COLUMNS
+    columns at a time; together about the size of codes as float32.
+    """
+    blocks = []
+    for start in xrange(0, codes.shape[1], columns):
+        chunk = codes[:, start:start + columns]
+        blocks.append(((chunk > 0).astype(numpy.float32),) + _features(chunk))
+    return blocks
+
+
+def pair_counts(blocks, rows):
+    """
+    (aligned, identical): float32 arrays of the pairs of sequences
+    rows (a slice) with every sequence, summed over column_blocks().
+    """
+    n = len(blocks[0][0]) if blocks else 0
+    aligned = numpy.zeros((rows.stop - rows.start, n), numpy.float32)
+    identical = numpy.zeros((rows.stop - rows.start, n), numpy.float32)
+    for residues, hot, groups in blocks:
+        aligned += numpy.dot(residues[rows], residues.T)
+        identical += numpy.dot(hot[rows], hot.T)
+        # Rare residues: add the pairs of each group directly
+        for group in groups:
+            first, last = numpy.searchsorted(group, [rows.start, rows.stop])
+            if first < last:
+                identical[numpy.ix_(group[first:last] - rows.start,
+                                    group)] += 1
+    return aligned, identical
+
+
+def scores(codes, block_rows=BLOCK_ROWS, columns=COLUMNS):
+    """
+    (mean identity, mean coverage) of every sequence against the
+    others.  Identity is averaged over the sequences it overlaps; one
+    that overlaps no other gets 0.
+    """
+    n = len(codes)
+    lengths = (codes > 0).sum(axis=1).astype(numpy.float32)
+    identity = numpy.zeros(n)
+    coverage = numpy.zeros(n)
+    if n < 2:
+        return numpy.ones(n), numpy.ones(n)
+    blocks = column_blocks(codes, columns)
+    for start in xrange(0, n, block_rows):
+        rows = slice(start, min(start + block_rows, n))
+        aligned, identical = pair_counts(blocks, rows)
+        # A sequence is not compared with itself
+        diagonal = numpy.arange(rows.stop - rows.start)
+        aligned[diagonal, diagonal + start] = 0
+        identical[diagonal, diagonal + start] = 0
+
+        pairs = (aligned > 0).sum(axis=1)
+        identity[rows] = (identical / numpy.maximum(aligned, 1)) \
+            .sum(axis=1) / numpy.maximum(pairs, 1)
+        longer = numpy.maximum(lengths[rows, None], lengths[None, :])
+        coverage[rows] = (aligned / numpy.maximum(longer, 1)).sum(axis=1) / \
+            (n - 1)
+    return identity, coverage
+
+
+def outliers(codes, min_identity=MIN_IDENTITY, min_coverage=MIN_COVERAGE,
+             block_rows=BLOCK_ROWS, columns=COLUMNS):
+    """(is outlier, identity, coverage) arrays, one entry per sequence."""
+    identity, coverage = scores(codes, block_rows, columns)
+    return (identity < min_identity) | (coverage < min_coverage), \
+        identity, coverage
+
+
+def filter_alignment(alignment, out, min_identity=MIN_IDENTITY,
+                     min_coverage=MIN_COVERAGE, report=None,
+                     block_rows=BLOCK_ROWS, columns=COLUMNS):
+    """
+    Write the sequences of alignment (a file) that are not outliers to
+    out, without gaps, and a tab-separated line per sequence to report.
+    Returns (kept, removed) counts.
+    """
+    records = list(read_fasta(alignment))
+    codes = encode([sequence for header, sequence in records])
+    flags, identity, coverage = outliers(codes, min_identity, min_coverage,
+                                         block_rows, columns)
+    if report is not None:
+        report.write("name\tresidues\tidentity\tcoverage\toutlier\n")
+    for i, (header, sequence) in enumerate(records):
+        if report is not None:
+            report.write("%s\t%d\t%.3f\t%.3f\t%s\n" % (
+                header.split()[0], (codes[i] > 0).sum(), identity[i],
+                coverage[i], flags[i] and 'yes' or 'no'))
+        if not flags[i]:
+            residues = sequence.translate(None, GAPS)
+            out.write(">%s\n" % header)
+            for j in xrange(0, len(residues), 60):
+                out.write(residues[j:j + 60] + "\n")
+    removed = int(flags.sum())
+    return len(records) - removed, removed
+
+
+# -- command line ------------------------------------------------------------
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog [options] ALIGNMENT OUT.fasta")
+    parser.add_option("--min-identity", type="float", default=MIN_IDENTITY,
+                      help="lowest mean identity to overlapping sequences "
+                           "[default: %default]")
+    parser.add_option("--min-coverage", type="float", default=MIN_COVERAGE,
+                      help="lowest mean share of the longer sequence of "
+                           "its pairs that is aligned [default: %default]")
+    parser.add_option("--report", help="write per-sequence scores to FILE")
+    parser.add_option("--block-rows", type="int", default=BLOCK_ROWS,
+                      help="sequences compared at a time; memory grows "
+                           "with it [default: %default]")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error("expected an alignment and an output file")
+
+    report = options.report and open(options.report, 'w')
+    with open(args[0]) as alignment:
+        with open(args[1], 'w') as out:
+            kept, removed = filter_alignment(alignment, out,
+                options.min_identity, options.min_coverage, report or None,
+                options.block_rows)
+    if report:
+        report.close()
+    print >> sys.stderr, "Kept %d sequences, removed %d outliers" % (
+        kept, removed)
+
+
+if __name__ == '__main__':
+    main()
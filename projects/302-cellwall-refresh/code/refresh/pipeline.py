@@ -0,0 +1,413 @@
+"""
+Runs the refresh steps of plan.md for many families at once.
+
+    PYTHONPATH=code python -m refresh.pipeline run [--cpus 16] [FAMILY...]
+    PYTHONPATH=code python -m refresh.pipeline report
+
+Every family (by default one per web/Cellwall/www/HMMER/*.hmm) gets the
+chain of STAGES below, the same steps as the GH43 scripts in code/NNN-*/
+with the family name filled in.  Families are independent, so their
+stages run side by side as subprocesses, as many as fit in --cpus.
+
+A stage is skipped when a stamp in data/pipeline/stamps/ shows it ran
+with the same command and the same input file contents, and its outputs
+are still there.  A failed stage leaves no stamp, so running again
+resumes from it.  Content hashes of big inputs like the UniProt FASTA
+are cached by size and mtime (data/pipeline/hashes.json).
+
+Wall time of every stage that ran is appended to
+data/pipeline/timings.tsv; "report" sums it up per stage.
+"""
+
+import errno
+import glob
+import hashlib
+import json
+import multiprocessing
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+STATE_DIR = 'data/pipeline'
+HMM_DIR = '../../web/Cellwall/www/HMMER'
+UNIPROT = 'data/120-download-uniprot/uniprot_sprot_plus_trembl.fasta'
+
+# Fixed so that all families share one set of uniprot shards
+SHARDS = multiprocessing.cpu_count()
+
+TOOLS = {
+    'guidance': os.environ.get('GUIDANCE',
+                               '~/src/guidance.v1.41/www/Guidance/guidance.pl'),
+    'mafft': os.environ.get('MAFFT',
+                            '~/src/mafft-7.130-with-extensions/scripts/mafft'),
+    'hmmer': os.environ.get('HMMER_BIN', '~/opt/hmmer-3.1b1/bin'),
+    'python': sys.executable,
+}
+
+
+class Stage(object):
+    """
+    One step of the refresh.  command, inputs and outputs are format
+    strings over the family name, the cpus given to the stage, the
+    uniprot path, SHARDS and TOOLS.
+    """
+
+    def __init__(self, name, command, inputs=(), outputs=(), deps=(), cpus=1):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = deps
+        self.cpus = cpus
+
+
+STAGES = [
+    # 1.3 and 2.1
+    Stage('msa',
+          '{guidance} --msaProgram MAFFT --seqType aa --mafft {mafft} '
+          '--proc_num {cpus} '
+          '--seqFile data/110-one-family/cwn-2005/{family}.fasta '
+          '--outDir data/130-build-msa/{family}',
+          inputs=['data/110-one-family/cwn-2005/{family}.fasta'],
+          outputs=['data/130-build-msa/{family}/MSA.MAFFT.aln.With_Names'],
+          cpus=4),
+    # 2.3
+    Stage('hmmbuild',
+          '{hmmer}/hmmbuild --amino --cpu {cpus} -n {family} '
+          'data/230-build-hmm/{family}.hmm '
+          'data/130-build-msa/{family}/MSA.MAFFT.aln.With_Names '
+          '> data/230-build-hmm/{family}.hmm.log',
+          inputs=['data/130-build-msa/{family}/MSA.MAFFT.aln.With_Names'],
+          outputs=['data/230-build-hmm/{family}.hmm'],
+          deps=['msa']),
+    # 2.7, over SHARDS pieces of uniprot (see refresh.hmmsearch)
+    Stage('hmmsearch',
+          'PYTHONPATH=code {python} -m refresh.hmmsearch search '
+          '--shards {shards} --cpus {cpus} --hmmsearch {hmmer}/hmmsearch '
+          '-E 0.1 '
+          '--tblout data/240-find-matches-in-uniprot/{family}-uniprot-hits '
+          '{uniprot} data/230-build-hmm/{family}.hmm',
+          inputs=['data/230-build-hmm/{family}.hmm', '{uniprot}'],
+          outputs=['data/240-find-matches-in-uniprot/{family}-uniprot-hits'],
+          deps=['hmmbuild'], cpus=8),
+    Stage('list-hits',
+          "awk '$3 == \"{family}\" {{print $1}}' "
+          'data/240-find-matches-in-uniprot/{family}-uniprot-hits '
+          '> data/250-add-to-family/{family}-hit-accessions',
+          inputs=['data/240-find-matches-in-uniprot/{family}-uniprot-hits'],
+          outputs=['data/250-add-to-family/{family}-hit-accessions'],
+          deps=['hmmsearch']),
+    Stage('extract-hits',
+          'PYTHONPATH=code {python} -m refresh.fastaindex get --file-order '
+          '--list data/250-add-to-family/{family}-hit-accessions {uniprot} '
+          '> data/250-add-to-family/{family}-uniprot-hits.fasta',
+          inputs=['data/250-add-to-family/{family}-hit-accessions',
+                  '{uniprot}.idx'],
+          outputs=['data/250-add-to-family/{family}-uniprot-hits.fasta'],
+          deps=['list-hits']),
+    # 2.2 for the new members
+    Stage('realign',
+          '{guidance} --msaProgram MAFFT --seqType aa --mafft {mafft} '
+          '--proc_num {cpus} '
+          '--seqFile data/250-add-to-family/{family}-uniprot-hits.fasta '
+          '--outDir data/260-re-align-msa/{family}',
+          inputs=['data/250-add-to-family/{family}-uniprot-hits.fasta'],
+          outputs=['data/260-re-align-msa/{family}/MSA.MAFFT.aln.With_Names'],
+          deps=['extract-hits'], cpus=4),
+]
+
+
+def families(hmm_dir=HMM_DIR):
+    return sorted(os.path.splitext(os.path.basename(p))[0]
+                  for p in glob.glob(os.path.join(hmm_dir, '*.hmm')))
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class HashCache(object):
+    """SHA-1 of file contents, cached by path, size and mtime."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.hashes = json.load(f)
+        except IOError:
+            self.hashes = {}
+
+    def get(self, path):
+        st = os.stat(path)
+        known = self.hashes.get(path)
+        if known and known[:2] == [st.st_size, st.st_mtime]:
+            return known[2]
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                h.update(block)
+        self.hashes[path] = [st.st_size, st.st_mtime, h.hexdigest()]
+        return h.hexdigest()
+
+    def save(self):
+        _makedirs(os.path.dirname(self.path))
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.hashes, f, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+
+# Task states
+PENDING, RUNNING, DONE, SKIPPED, FAILED, BLOCKED = \
+    'pending', 'running', 'done', 'skipped', 'failed', 'blocked'
+
+
+class Task(object):
+    """A stage of one family."""
+
+    def __init__(self, family, stage, cpus, params):
+        self.family = family
+        self.stage = stage
+        self.cpus = cpus
+        params = dict(params, family=family, cpus=cpus)
+        self.command = stage.command.format(**params)
+        # What the stamp records: the command minus the cpus it got
+        self.signature = stage.command.format(**dict(params, cpus='-'))
+        self.inputs = [i.format(**params) for i in stage.inputs]
+        self.outputs = [o.format(**params) for o in stage.outputs]
+        self.deps = []
+        self.state = PENDING
+        self.key = None
+
+    def __str__(self):
+        return "%s/%s" % (self.family, self.stage.name)
+
+
+def plan(names, cpus, stages=STAGES, uniprot=UNIPROT):
+    """Tasks for every family and stage, with their deps filled in."""
+    params = dict(TOOLS, uniprot=uniprot, shards=SHARDS)
+    tasks = []
+    for family in names:
+        by_name = {}
+        for stage in stages:
+            task = Task(family, stage, min(stage.cpus, cpus), params)
+            task.deps = [by_name[d] for d in stage.deps]
+            by_name[stage.name] = task
+            tasks.append(task)
+    return tasks
+
+
+class Runner(object):
+    def __init__(self, tasks, cpus, state_dir=STATE_DIR, force=False,
+                 dry_run=False, out=sys.stdout):
+        self.tasks = tasks
+        self.cpus = cpus
+        self.state_dir = state_dir
+        self.force = force
+        self.dry_run = dry_run
+        self.out = out
+        self.hashes = HashCache(os.path.join(state_dir, 'hashes.json'))
+        self.running = {}       # Popen -> (task, start time, log file)
+        self.free = cpus
+
+    def log(self, task, message):
+        self.out.write("%s %-22s %s\n" % (time.strftime('%H:%M:%S'),
+                                          task, message))
+        self.out.flush()
+
+    # -- stamps --------------------------------------------------------------
+
+    def stamp_path(self, task):
+        return os.path.join(self.state_dir, 'stamps', task.family,
+                            task.stage.name + '.json')
+
+    def input_key(self, task):
+        h = hashlib.sha1(task.signature)
+        for path in task.inputs:
+            h.update('\0%s\0%s' % (path, self.hashes.get(path)))
+        return h.hexdigest()
+
+    def up_to_date(self, task):
+        if self.force or not all(os.path.exists(o) for o in task.outputs):
+            return False
+        try:
+            with open(self.stamp_path(task)) as f:
+                return json.load(f)['key'] == task.key
+        except (IOError, ValueError, KeyError):
+            return False
+
+    def finish(self, task, seconds, ok):
+        path = self.stamp_path(task)
+        if ok:
+            _makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                json.dump({'key': task.key, 'command': task.command,
+                           'seconds': round(seconds, 3),
+                           'finished': time.strftime('%Y-%m-%d %H:%M:%S')}, f)
+        elif os.path.exists(path):
+            os.remove(path)
+        with open(os.path.join(self.state_dir, 'timings.tsv'), 'a') as f:
+            f.write("%s\t%s\t%s\t%.3f\t%s\n" % (
+                time.strftime('%Y-%m-%d %H:%M:%S'), task.family,
+                task.stage.name, seconds, ok and 'ok' or 'failed'))
+        self.hashes.save()
+
+    # -- scheduling ----------------------------------------------------------
+
+    def start_ready(self):
+        """Start or skip every task that can go now; True if any did."""
+        changed = False
+        for task in self.tasks:
+            if task.state != PENDING:
+                continue
+            if any(d.state in (FAILED, BLOCKED) for d in task.deps):
+                task.state = BLOCKED
+                self.log(task, "blocked")
+                changed = True
+                continue
+            if not all(d.state in (DONE, SKIPPED) for d in task.deps):
+                continue
+
+            # In a dry run, stages after one that would run would run too
+            if not (self.dry_run and any(d.state == DONE for d in task.deps)):
+                missing = [i for i in task.inputs if not os.path.exists(i)]
+                if missing:
+                    task.state = FAILED
+                    self.log(task, "failed: missing %s" % ", ".join(missing))
+                    changed = True
+                    continue
+                task.key = self.input_key(task)
+                if self.up_to_date(task):
+                    task.state = SKIPPED
+                    self.log(task, "up to date")
+                    changed = True
+                    continue
+
+            if task.cpus > self.free:
+                continue
+            changed = True
+            if self.dry_run:
+                task.state = DONE
+                self.log(task, task.command)
+                continue
+            self.start(task)
+        return changed
+
+    def start(self, task):
+        log_path = os.path.join(self.state_dir, 'logs', task.family,
+                                task.stage.name + '.log')
+        _makedirs(os.path.dirname(log_path))
+        for o in task.outputs:
+            _makedirs(os.path.dirname(o))
+        log = open(log_path, 'w')
+        p = subprocess.Popen(['/bin/bash', '-c', 'set -e -o pipefail\n' +
+                              task.command], stdout=log, stderr=log)
+        task.state = RUNNING
+        self.free -= task.cpus
+        self.running[p] = (task, time.time(), log)
+        self.log(task, "started on %d cpus" % task.cpus)
+
+    def reap(self):
+        for p in self.running.keys():
+            if p.poll() is None:
+                continue
+            task, started, log = self.running.pop(p)
+            log.close()
+            self.free += task.cpus
+            seconds = time.time() - started
+            ok = p.returncode == 0 and \
+                all(os.path.exists(o) for o in task.outputs)
+            task.state = ok and DONE or FAILED
+            self.finish(task, seconds, ok)
+            self.log(task, "%s in %.1fs" % (ok and "done" or "FAILED (see %s)"
+                                            % log.name, seconds))
+
+    def run(self):
+        """Run everything; returns the tasks that failed."""
+        _makedirs(self.state_dir)
+        while True:
+            while self.start_ready():
+                pass
+            if not self.running:
+                break
+            time.sleep(0.2)
+            self.reap()
+        self.hashes.save()
+        return [t for t in self.tasks if t.state == FAILED]
+
+
+def report(state_dir=STATE_DIR, out=sys.stdout):
+    """Print wall time per stage and per family from timings.tsv."""
+    stages = {}
+    fams = {}
+    with open(os.path.join(state_dir, 'timings.tsv')) as f:
+        for line in f:
+            when, family, stage, seconds, status = line.rstrip('\n').split('\t')
+            seconds = float(seconds)
+            s = stages.setdefault(stage, [0, 0.0, 0.0, 0])
+            s[0] += 1
+            s[1] += seconds
+            s[2] = max(s[2], seconds)
+            s[3] += status != 'ok'
+            fams[family] = fams.get(family, 0.0) + seconds
+
+    total = sum(s[1] for s in stages.values()) or 1.0
+    out.write("%-14s %5s %10s %9s %9s %6s %7s\n" % (
+        'stage', 'runs', 'total s', 'mean s', 'max s', 'share', 'failed'))
+    for name, (runs, seconds, longest, failed) in \
+            sorted(stages.items(), key=lambda i: -i[1][1]):
+        out.write("%-14s %5d %10.1f %9.1f %9.1f %5.1f%% %7d\n" % (
+            name, runs, seconds, seconds / runs, longest,
+            100 * seconds / total, failed))
+    out.write("\nslowest families:\n")
+    for family, seconds in sorted(fams.items(), key=lambda i: -i[1])[:10]:
+        out.write("  %-10s %10.1f\n" % (family, seconds))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog run [options] [FAMILY...]\n       %prog report")
+    parser.add_option("--cpus", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="CPU budget for all running stages "
+                           "[default: %default]")
+    parser.add_option("--until", metavar="STAGE",
+                      help="stop after this stage ("
+                           + ", ".join(s.name for s in STAGES) + ")")
+    parser.add_option("--force", action="store_true",
+                      help="run stages even if they are up to date")
+    parser.add_option("-n", "--dry-run", action="store_true",
+                      help="print the commands that would run")
+    options, args = parser.parse_args(argv)
+
+    if not os.path.isdir('code') or not os.path.exists('data'):
+        sys.exit("ERROR: You must run this script from the root of the "
+                 "project dir")
+    if not args or args[0] not in ('run', 'report'):
+        parser.error("expected run or report")
+    if args[0] == 'report':
+        report()
+        return
+
+    stages = STAGES
+    if options.until:
+        names = [s.name for s in STAGES]
+        if options.until not in names:
+            parser.error("unknown stage %s" % options.until)
+        stages = STAGES[:names.index(options.until) + 1]
+
+    tasks = plan(args[1:] or families(), options.cpus, stages)
+    failed = Runner(tasks, options.cpus, force=options.force,
+                    dry_run=options.dry_run).run()
+    if failed:
+        sys.exit("ERROR: %d stages failed: %s"
+                 % (len(failed), ", ".join(str(t) for t in failed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,665 @@
+"""
+Tests of the refresh package.
+
+    cd code && python -m unittest refresh.tests
+"""
+
+import base64
+import gzip
+import hashlib
+import os
+import random
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import urllib2
+from cStringIO import StringIO
+
+import numpy
+
+from refresh import blastservice, blaststandin, fastaindex, hmmsearch, \
+    normalize, outliers, pipeline
+
+FAMILY = [
+    ('Q1 X1_ARATH Xylosidase 1', 'MKVLAAGIVGLLSSAWAQDNPYL' * 3),
+    ('Q2 X2_ARATH Xylosidase 2', 'MKVLAAGIVGLLSSAWAQENPYL' * 3),
+    ('Q3 C1_ARATH Cellulose synthase', 'MEHHRSTWGKPCDFLQIRYMNA' * 3),
+]
+
+
+def stand_in():
+    """The blastp command line of the stand-in."""
+    return '%s %s' % (sys.executable,
+                      os.path.splitext(blaststandin.__file__)[0] + '.py')
+
+
+class BlastServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'family.fasta')
+        with open(path, 'w') as f:
+            for header, sequence in FAMILY:
+                f.write('>%s\n%s\n' % (header, sequence))
+        self.database = blastservice.Database('family', path)
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def service(self, workers=1, queue_size=4, cache=None):
+        return blastservice.Service([self.database], workers, queue_size,
+                                    stand_in(), cache, evalue=10.0,
+                                    rewarm=0)
+
+    def test_repeat_searches_come_from_the_cache(self):
+        cache_dir = os.path.join(self.directory, 'cache')
+        service = self.service(cache=blastservice.ResultCache(cache_dir))
+        query = '>query\n' + FAMILY[0][1].lower()
+        first = service.search('family', query, timeout=30)
+        self.assertFalse(first['cached'])
+        self.assertEqual([h['accession'] for h in first['hits']][:2],
+                         ['Q1', 'Q2'])
+        # The same residues, however formatted
+        second = service.search('family', FAMILY[0][1] + '*', timeout=30)
+        self.assertEqual(second, {'hits': first['hits'], 'cached': True})
+        self.assertEqual((service.searches, service.cache.hits), (1, 1))
+
+        # From disk, in a service started later
+        service = self.service(cache=blastservice.ResultCache(cache_dir))
+        self.assertTrue(service.search('family', FAMILY[0][1])['cached'])
+        self.assertEqual(service.searches, 0)
+
+    def test_identical_searches_in_flight_are_coalesced(self):
+        # No worker yet: searches stay queued
+        service = self.service(workers=0, queue_size=1)
+        for i in range(3):
+            self.assertRaises(blastservice.SearchError, service.search,
+                              'family', FAMILY[2][1], 0.01)
+        # One queued job for all three, which fills the queue
+        self.assertEqual((service.queue.qsize(), len(service.running)),
+                         (1, 1))
+        self.assertRaises(blastservice.Busy, service.search, 'family',
+                          FAMILY[1][1], 0.01)
+
+        worker = threading.Thread(target=service._work)
+        worker.daemon = True
+        worker.start()
+        result = service.search('family', FAMILY[2][1], timeout=30)
+        self.assertEqual(result['hits'][0]['accession'], 'Q3')
+        self.assertEqual(service.searches, 1)
+
+    def test_full_queue_answers_503(self):
+        service = self.service(workers=0, queue_size=1)
+        self.assertRaises(blastservice.SearchError, service.search,
+                          'family', FAMILY[0][1], 0.01)
+
+        class ServiceHandler(blastservice.Handler):
+            pass
+        ServiceHandler.service = service
+        ServiceHandler.log_message = lambda self, *args: None
+        server = blastservice.Server(('127.0.0.1', 0), ServiceHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/search?db=family&sequence=%s' % (
+                server.server_address[1], FAMILY[1][1])
+            try:
+                urllib2.urlopen(url, timeout=30)
+            except urllib2.HTTPError, e:
+                self.assertEqual(e.code, 503)
+            else:
+                self.fail("expected 503")
+            self.assertEqual(service.status()['queued'], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def random_alignment(n, width, seed=1):
+    """
+    n rows of width columns: mostly each column's own residue, some
+    other residues, gaps, an X, a row of gaps only and a row of X.
+    """
+    rng = random.Random(seed)
+    consensus = [rng.choice(outliers.AMINO_ACIDS) for i in range(width)]
+    rows = []
+    for i in range(n - 2):
+        row = []
+        for c in consensus:
+            r = rng.random()
+            if r < 0.2:
+                row.append('-')
+            elif r < 0.6:
+                row.append(c)
+            elif r < 0.62:
+                row.append('X')
+            else:
+                row.append(rng.choice(outliers.AMINO_ACIDS[:4]))
+        rows.append(''.join(row))
+    return rows + ['-' * width, 'X' * (width - 3) + '---']
+
+
+def brute_force_scores(rows):
+    """outliers.scores() of rows, by comparing every pair of rows."""
+    n = len(rows)
+    residues = [sum(a not in outliers.GAPS for a in row) for row in rows]
+    identity, coverage = [], []
+    for i in range(n):
+        identities, covered = [], 0.0
+        for j in range(n):
+            if i == j:
+                continue
+            pairs = [(a, b) for a, b in zip(rows[i], rows[j])
+                     if a not in outliers.GAPS and b not in outliers.GAPS]
+            if pairs:
+                identities.append(float(sum(a == b != 'X'
+                                            for a, b in pairs)) / len(pairs))
+            covered += float(len(pairs)) / max(residues[i], residues[j], 1)
+        identity.append(identities and sum(identities) / len(identities)
+                        or 0.0)
+        coverage.append(covered / (n - 1))
+    return identity, coverage
+
+
+class OutliersTest(unittest.TestCase):
+    def test_scores_match_brute_force(self):
+        rows = random_alignment(40, 50)
+        codes = outliers.encode(rows)
+        expected = brute_force_scores(rows)
+        # Blocks of rows and columns that do not divide the alignment,
+        # with common and rare (column, residue) pairs in every block
+        for residues, hot, groups in outliers.column_blocks(codes, 16):
+            self.assertTrue(hot.shape[1] > 0 and len(groups) > 0)
+        for block_rows, columns in [(7, 16), (40, 50), (1, 1)]:
+            identity, coverage = outliers.scores(codes, block_rows, columns)
+            self.assertTrue(numpy.allclose(identity, expected[0]))
+            self.assertTrue(numpy.allclose(coverage, expected[1]))
+        self.assertEqual((identity[-2], coverage[-2]), (0, 0))
+
+    def test_filter_alignment(self):
+        rows = random_alignment(20, 30)[:-2] + ['WWWWWWWWWW' + '-' * 20]
+        alignment = StringIO(''.join('>s%d\n%s\n' % (i, row)
+                                     for i, row in enumerate(rows)))
+        out, report = StringIO(), StringIO()
+        self.assertEqual(outliers.filter_alignment(alignment, out,
+                                                   report=report,
+                                                   block_rows=5, columns=8),
+                         (18, 1))
+        self.assertFalse('>s18\n' in out.getvalue())
+        self.assertTrue(out.getvalue().startswith(
+            '>s0\n%s\n' % rows[0].replace('-', '')))
+        self.assertTrue(report.getvalue().splitlines()[-1].startswith(
+            's18\t10\t'))
+        self.assertTrue(report.getvalue().splitlines()[-1].endswith('\tyes'))
+
+
+RECORDS = [
+    ('Q3 Third', 'MKV\nLAA\n'),
+    ('P1 First\r', 'MEHH\n'),
+    ('Q3 Duplicate of the third', 'WWW\n'),
+    ('A2', ''),
+    ('Z9 Last, no newline', 'GGA'),
+]
+
+
+class FastaIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.directory, 'records.fasta')
+        self.data = ''.join('>%s\n%s' % record for record in RECORDS)
+        with open(self.fasta, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scan_headers_across_blocks(self):
+        offsets = [i for i in range(len(self.data))
+                   if self.data[i] == '>' and (i == 0 or
+                                               self.data[i - 1] == '\n')]
+        expected = zip(offsets, [header.rstrip('\r')
+                                 for header, sequence in RECORDS])
+        for block_size in [1, 2, 3, 5, 8, 64]:
+            self.assertEqual(list(fastaindex.scan_headers(
+                StringIO(self.data), block_size)), expected)
+        self.assertEqual(list(fastaindex.scan_headers(StringIO(''), 4)), [])
+
+    def test_build_merges_runs(self):
+        # Runs of two entries, merged into one sorted index
+        self.assertEqual(fastaindex.build(self.fasta, run_size=2), 4)
+        with fastaindex.FastaIndex(self.fasta) as index:
+            self.assertEqual([e[0] for e in index.entries()],
+                             ['A2', 'P1', 'Q3', 'Z9'])
+            self.assertEqual(index.get('P1'), ('P1 First', 'MEHH'))
+            self.assertEqual(index.get('A2'), ('A2', ''))
+            self.assertEqual(index.get('Z9'), ('Z9 Last, no newline', 'GGA'))
+            # The first record of a duplicated accession
+            self.assertEqual(index.get('Q3'), ('Q3 Third', 'MKVLAA'))
+            self.assertEqual([a for a, record in index.fetch(
+                ['Z9', 'P1', 'Q3', 'P1'])], ['Q3', 'P1', 'Z9'])
+            self.assertEqual(''.join(str(record) for a, record in
+                                     index.iter_records(['Z9', 'A2'])),
+                             '>Z9 Last, no newline\nGGA>A2\n')
+
+    def test_missing_accessions(self):
+        fastaindex.build(self.fasta)
+        with fastaindex.FastaIndex(self.fasta) as index:
+            for accession in ['Q2', 'Q30', '', 'Z99', 'Q3' * 20]:
+                self.assertEqual(index.locate(accession), None)
+                self.assertFalse(accession in index)
+                self.assertRaises(KeyError, index.get, accession)
+            self.assertEqual(index.locate_many(['Z9', 'B1', 'P1', 'A1']),
+                             ([(index.locate('P1')[0],
+                                index.locate('P1')[1], 'P1'),
+                               (index.locate('Z9')[0],
+                                index.locate('Z9')[1], 'Z9')],
+                              ['A1', 'B1']))
+            # Nothing is read when any accession is missing
+            records = index.fetch(['P1', 'B1'])
+            self.assertRaises(KeyError, records.next)
+            self.assertRaises(KeyError, list, index.iter_records(['B1']))
+            self.assertRaises(ValueError, index.seguid, 'P1')
+
+    def test_out_of_date_index(self):
+        fastaindex.build(self.fasta)
+        with open(self.fasta, 'ab') as f:
+            f.write('\n>N1\nM\n')
+        self.assertRaises(ValueError, fastaindex.FastaIndex, self.fasta)
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_dir = os.path.join(self.directory, 'state')
+        for family in ('GH43', 'CWN'):
+            self.write(family + '.in', family.lower())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, data):
+        with open(self.path(name), 'w') as f:
+            f.write(data)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def stages(self):
+        """Two stages per family that note each run in runs.log."""
+        d = self.directory
+        return [
+            pipeline.Stage('copy', 'echo {family} copy >> %s/runs.log; '
+                           'cat %s/{family}.in > %s/{family}.a' % (d, d, d),
+                           inputs=['%s/{family}.in' % d],
+                           outputs=['%s/{family}.a' % d]),
+            pipeline.Stage('upper', 'echo {family} upper >> %s/runs.log; '
+                           'test ! -e %s/{family}.fail; '
+                           "tr a-z A-Z < %s/{family}.a > %s/{family}.b"
+                           % (d, d, d, d),
+                           inputs=['%s/{family}.a' % d],
+                           outputs=['%s/{family}.b' % d], deps=['copy']),
+        ]
+
+    def run_pipeline(self, cpus=4):
+        tasks = pipeline.plan(['GH43', 'CWN'], cpus, self.stages())
+        runner = pipeline.Runner(tasks, cpus, self.state_dir, out=StringIO())
+        failed = runner.run()
+        return [str(t) for t in failed], \
+            dict((str(t), t.state) for t in tasks)
+
+    def runs(self):
+        if not os.path.exists(self.path('runs.log')):
+            return []
+        runs = sorted(self.read('runs.log').splitlines())
+        os.remove(self.path('runs.log'))
+        return runs
+
+    def test_unchanged_stages_are_skipped(self):
+        self.assertEqual(self.run_pipeline()[0], [])
+        self.assertEqual(self.read('GH43.b'), 'GH43')
+        self.assertEqual(len(self.runs()), 4)
+
+        failed, states = self.run_pipeline()
+        self.assertEqual(set(states.values()), set([pipeline.SKIPPED]))
+        self.assertEqual(self.runs(), [])
+
+        # A changed input runs its stage again, and the next only if the
+        # output of that one changed
+        self.write('CWN.in', 'cwn2')
+        failed, states = self.run_pipeline()
+        self.assertEqual(self.runs(), ['CWN copy', 'CWN upper'])
+        self.assertEqual(self.read('CWN.b'), 'CWN2')
+        self.assertEqual(states['GH43/copy'], pipeline.SKIPPED)
+        # The same contents under a new mtime are still up to date
+        self.write('GH43.in', 'gh43')
+        self.run_pipeline()
+        self.assertEqual(self.runs(), [])
+
+    def test_failed_stage_resumes(self):
+        self.write('GH43.fail', '')
+        failed, states = self.run_pipeline()
+        self.assertEqual(failed, ['GH43/upper'])
+        self.assertEqual((states['GH43/copy'], states['CWN/upper']),
+                         (pipeline.DONE, pipeline.DONE))
+        self.assertEqual(len(self.runs()), 4)
+
+        os.remove(self.path('GH43.fail'))
+        failed, states = self.run_pipeline()
+        self.assertEqual(failed, [])
+        self.assertEqual(self.runs(), ['GH43 upper'])
+        self.assertEqual(self.read('GH43.b'), 'GH43')
+
+    def test_cpu_budget(self):
+        d = self.directory
+        stages = [pipeline.Stage(
+            'slow', 'echo start >> %s/events; sleep 0.3; '
+            'echo end >> %s/events; touch %s/{family}.slow' % (d, d, d),
+            outputs=['%s/{family}.slow' % d], cpus=2)]
+        for cpus, most in [(3, 1), (4, 2)]:
+            if os.path.exists(self.path('events')):
+                os.remove(self.path('events'))
+            pipeline.Runner(pipeline.plan(['A', 'B', 'C'], cpus, stages),
+                            cpus, self.state_dir, force=True,
+                            out=StringIO()).run()
+            running = highest = 0
+            for event in self.read('events').split():
+                running += event == 'start' and 1 or -1
+                highest = max(highest, running)
+            self.assertEqual(highest, most)
+
+    def test_timings_report(self):
+        self.write('GH43.fail', '')
+        self.run_pipeline()
+        timings = [line.split('\t') for line in
+                   self.read('state/timings.tsv').splitlines()]
+        self.assertEqual(sorted((t[1], t[2], t[4]) for t in timings), [
+            ('CWN', 'copy', 'ok'), ('CWN', 'upper', 'ok'),
+            ('GH43', 'copy', 'ok'), ('GH43', 'upper', 'failed')])
+        out = StringIO()
+        pipeline.report(self.state_dir, out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('stage'))
+        self.assertEqual(sorted(line.split()[:2] for line in lines[1:3]),
+                         [['copy', '2'], ['upper', '2']])
+        self.assertTrue([line for line in lines if line.startswith('upper')]
+                        [0].endswith(' 1'))
+
+
+TREMBL = (
+    '>tr|A0A001|A0A001_ARATH Uncharacterized protein OS=Arabidopsis\n'
+    'MKVLAAGIVGLLSSAWAQDNPYL\nMKVL\n'
+    '>tr|A0A002|A0A002_ORYSJ Pipe | in the description\n'
+    'MEHHRSTWGKPCDFLQIRYMNA\n'
+    '>tr|A0A003|A0A003_ARATH No residues\n'
+)
+SPROT = (
+    '>sp|P12345|AATM_RABIT Aspartate aminotransferase\n'
+    'msalfaaleqpvaa\nMSALF\n'
+    '>spam|Q1|not a prefix\n'
+    'MK\n'
+)
+
+
+def perl_passes(text):
+    """What gunzip_and_fix_fasta's three perl -p substitutions did."""
+    lines = []
+    for line in text.splitlines(True):
+        line = line.replace('|', ' ')
+        line = re.sub('^>tr ', '>', line)
+        line = re.sub('^>sp ', '>', line)
+        lines.append(line)
+    return ''.join(lines)
+
+
+class NormalizeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def gzip(self, name, *members):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            for member in members:
+                z = gzip.GzipFile(fileobj=f, mode='wb')
+                z.write(member)
+                z.close()
+        return path
+
+    def test_normalize(self):
+        # TrEMBL in two gzip members, as concatenated downloads are
+        trembl = self.gzip('uniprot_trembl.fasta.gz', TREMBL[:70],
+                           TREMBL[70:])
+        sprot = self.gzip('uniprot_sprot.fasta.gz', SPROT)
+        output = os.path.join(self.directory, 'uniprot.fasta')
+        self.assertEqual(normalize.normalize([trembl, sprot], output,
+                                             block_size=7), 5)
+        with open(output) as f:
+            data = f.read()
+        self.assertEqual(data, perl_passes(TREMBL) + perl_passes(SPROT))
+        self.assertTrue(data.startswith('>A0A001 A0A001_ARATH '))
+        self.assertTrue('>spam Q1 not a prefix\n' in data)
+
+        with fastaindex.FastaIndex(output) as index:
+            entries = list(index.entries())
+            self.assertEqual([e[0] for e in entries], [
+                'A0A001', 'A0A002', 'A0A003', 'P12345', 'spam'])
+            for name, offset, length, checksum in entries:
+                record = data[offset:offset + length]
+                self.assertTrue(record.startswith('>' + name + ' '))
+                self.assertTrue(record.endswith('\n') and
+                                '\n>' not in record)
+                sequence = ''.join(record.split('\n')[1:])
+                self.assertEqual(checksum, base64.b64encode(
+                    hashlib.sha1(sequence.upper()).digest()).rstrip('='))
+            self.assertEqual(index.seguid('P12345'),
+                             fastaindex.seguid(fastaindex.seguid_digest(
+                                 'MSALFAALEQPVAAMSALF')))
+
+
+# Scores targets like hmmsearch -Z/--domZ would: every copy of the motif
+# in the HMM file is a domain scoring 5 bits.  The per-sequence E-value
+# uses Z, the domain reporting and inclusion use domZ, which defaults to
+# the number of targets reported.  Appends "FASTA domZ" to the log in the
+# HMM file, and fails on FASTA files named in $STAND_IN_FAIL.
+STAND_IN_HMMSEARCH = """#!%s
+import math, os, sys
+args = sys.argv[1:]
+def option(name, default=None):
+    return name in args and args[args.index(name) + 1] or default
+hmm, fasta = args[-2:]
+name, motif, log = open(hmm).read().split()
+if os.path.basename(fasta) in os.environ.get('STAND_IN_FAIL', '').split():
+    sys.exit("cannot read %%s" %% fasta)
+records = [r.split('\\n', 1) for r in open(fasta).read().split('>')[1:]]
+z = float(option('-Z', len(records)))
+hits = []
+for header, sequence in records:
+    domains = ''.join(sequence.split()).count(motif)
+    evalue = z * math.exp(-5.0 * domains)
+    if evalue <= float(option('-E', 10)):
+        hits.append((evalue, -5.0 * domains, header.split()[0], domains))
+hits.sort()
+domz = float(option('--domZ', len(hits)))
+open(log, 'a').write('%%s %%g\\n' %% (os.path.basename(fasta), domz))
+out = open(option('--tblout'), 'w')
+out.write('#                        --- full sequence ----\\n'
+          '# target name  query name  E-value  score ...\\n'
+          '#------------- ----------- --------- ------\\n')
+for evalue, score, target, domains in hits:
+    conditional = domz * math.exp(-5.0)
+    reported = conditional <= 0.03 and domains or 0
+    included = conditional <= 0.01 and domains or 0
+    out.write('%%-12s - %%s - %%.3g %%.1f 0.0 %%.3g 5.0 0.0 %%.1f %%d 0 0 '
+              '%%d %%d %%d %%d -\\n' %% (target, name, evalue, -score,
+              z * math.exp(-5.0), domains, domains, domains, domains,
+              reported, included))
+out.write('#\\n# Program:         hmmsearch\\n'
+          '# Query file:      %%s\\n# Target file:     %%s\\n# [ok]\\n'
+          %% (hmm, fasta))
+"""
+
+# Records of which 1, 6, 7 and 12 hold the motif, 7 twice
+HMMSEARCH_FASTA = ''.join(
+    '>S%02d protein %d\nMKVLA%sGGAS\nLLSAW\n' % (
+        i, i, {1: 'WWKW', 6: 'WWKW', 7: 'WWKWAWWKW', 12: 'WWKW'}.get(i, ''),
+    ) for i in range(1, 13))
+
+
+class HmmsearchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.program = self.path('hmmsearch')
+        with open(self.program, 'w') as f:
+            f.write(STAND_IN_HMMSEARCH % sys.executable)
+        os.chmod(self.program, stat.S_IRWXU)
+        self.fasta = self.path('uniprot.fasta')
+        with open(self.fasta, 'w') as f:
+            f.write(HMMSEARCH_FASTA)
+        self.hmm = self.path('GH43.hmm')
+        with open(self.hmm, 'w') as f:
+            f.write('GH43 WWKW %s\n' % self.path('runs.log'))
+        os.environ.pop('STAND_IN_FAIL', None)
+
+    def tearDown(self):
+        os.environ.pop('STAND_IN_FAIL', None)
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def runs(self):
+        """The "FASTA domZ" of the searches since the last call."""
+        if not os.path.exists(self.path('runs.log')):
+            return []
+        with open(self.path('runs.log')) as f:
+            runs = sorted(f.read().splitlines())
+        os.remove(self.path('runs.log'))
+        return runs
+
+    def shard_hits(self):
+        """The number of motif records in each of the 4 shards."""
+        hits = []
+        for shard in hmmsearch.make_shards(self.fasta, 4)['shards']:
+            with open(shard['path']) as f:
+                hits.append(len([line for line in f if 'WWKW' in line]))
+        return hits
+
+    def search(self, shards=4):
+        out = self.path('GH43.tblout')
+        count = hmmsearch.search(self.fasta, [self.hmm], [out], shards=shards,
+                                 cpus=2, hmmsearch=self.program)[0]
+        with open(out) as f:
+            return count, f.read()
+
+    def test_shards_are_record_aligned_and_reused(self):
+        manifest = hmmsearch.make_shards(self.fasta, 4)
+        self.assertEqual(manifest['records'], 12)
+        self.assertEqual(len(manifest['shards']), 4)
+        self.assertEqual(sum(s['records'] for s in manifest['shards']), 12)
+        data = ''
+        for shard in manifest['shards']:
+            with open(shard['path']) as f:
+                text = f.read()
+            self.assertTrue(text.startswith('>'))
+            data += text
+        self.assertEqual(data, HMMSEARCH_FASTA)
+
+        mtime = os.path.getmtime(manifest['shards'][0]['path'])
+        os.utime(manifest['shards'][0]['path'], (0, 0))
+        self.assertEqual(hmmsearch.make_shards(self.fasta, 4), manifest)
+        self.assertEqual(os.path.getmtime(manifest['shards'][0]['path']), 0)
+        # Another count of shards, or a changed file, cuts them again
+        self.assertEqual(len(hmmsearch.make_shards(self.fasta, 2)['shards']),
+                         2)
+        with open(self.fasta, 'a') as f:
+            f.write('>S13\nMK\n')
+        self.assertEqual(hmmsearch.make_shards(self.fasta, 2)['records'], 13)
+
+    def test_merge_matches_one_search(self):
+        single = self.path('single.tblout')
+        subprocess.check_call([self.program, '--tblout', single, self.hmm,
+                               self.fasta])
+        self.assertEqual(self.runs(), ['uniprot.fasta 4'])
+        with open(single) as f:
+            expected = f.read()
+
+        count, merged = self.search()
+        self.assertEqual(count, 4)
+        self.assertEqual(merged, expected)
+        # No shard held all four hits: those with some are searched again
+        # over their hits with the domZ of the whole file
+        expected_runs = []
+        for i, shard in enumerate(self.shard_hits()):
+            expected_runs.append('shard-%03d.fasta %d' % (i, shard))
+            if shard:
+                expected_runs.append('shard-%03d.hits.fasta 4' % i)
+        self.assertEqual(self.runs(), sorted(expected_runs))
+        # S07 has the most domains and ranks first
+        rows = [line.split() for line in merged.splitlines()
+                if not line.startswith('#')]
+        self.assertEqual([row[0] for row in rows],
+                         ['S07', 'S01', 'S06', 'S12'])
+        self.assertEqual(set(row[-2] for row in rows), set(['0']))
+
+        # With all hits in one shard, that shard's own domZ is right
+        count, merged = self.search(shards=1)
+        self.assertEqual(merged, expected)
+        self.assertEqual(self.runs(), ['shard-000.fasta 4'])
+
+    def test_resume_from_completed_parts(self):
+        hits = self.shard_hits()
+        os.environ['STAND_IN_FAIL'] = 'shard-001.fasta'
+        self.assertRaises(RuntimeError, self.search)
+        self.assertEqual(self.runs(), ['shard-%03d.fasta %d' % (i, hits[i])
+                                       for i in (0, 2, 3)])
+        self.assertFalse(os.path.exists(self.path('GH43.tblout')))
+
+        del os.environ['STAND_IN_FAIL']
+        count, merged = self.search()
+        self.assertEqual(count, 4)
+        self.assertEqual([run for run in self.runs() if 'hits' not in run],
+                         ['shard-001.fasta %d' % hits[1]])
+        self.assertFalse(os.path.exists(self.path('GH43.tblout.parts')))
+
+        # A new HMM starts over
+        with open(self.hmm, 'w') as f:
+            f.write('GH43 WWKWA %s\n' % self.path('runs.log'))
+        self.assertEqual(self.search()[0], 1)
+
+    def test_merge_tblout_ranks_by_evalue(self):
+        head = '# target name ...\n#--------\n'
+        tail = '#\n# Target file:     shard\n# [ok]\n'
+        parts = []
+        for i, rows in enumerate([['A - q - 1e-5 20.0 x\n',
+                                   'B - q - 0.01 9.0 x\n'],
+                                  ['C - q - 1e-30 99.0 x\n',
+                                   'E - q - 0.01 9.5 x\n',
+                                   'D - q - 0.01 9.5 x\n']]):
+            parts.append(self.path('part-%d' % i))
+            with open(parts[-1], 'w') as f:
+                f.write(head + ''.join(rows) + tail)
+        out = self.path('merged')
+        self.assertEqual(hmmsearch.merge_tblout(parts, out, 'uniprot.fasta'),
+                         5)
+        with open(out) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[:2], head.splitlines())
+        self.assertEqual([line[0] for line in lines[2:7]],
+                         ['C', 'A', 'D', 'E', 'B'])
+        self.assertEqual(lines[8], '# Target file:     uniprot.fasta')
+
+
+if __name__ == '__main__':
+    unittest.main()